@@ -0,0 +1,71 @@
+# Times Authenticator decisions per second against a registry of generated
+# tokens. Compares the old hard-coded check, which built its policy on every
+# call, with registry lookups for a registered, the legacy and an unknown
+# token. Run from the repository root:
+#   python benchmarks/authorizer_decisions.py
+import hashlib
+import importlib.util
+import json
+import os
+import tempfile
+import timeit
+
+registrySize = 10000
+runs = 200000
+
+# The lambda imports boto3, it is not used when the registry is a file. The
+# legacy token is off by default and is turned on to compare it
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('LEGACY_TOKEN_ENABLED', 'true')
+
+tokens = [f'benchmark-token-{number}' for number in range(registrySize)]
+entries = [{'token_sha256': hashlib.sha256(token.encode('utf-8')).hexdigest(),
+            'principal': f'principal-{number}',
+            'tenant': f'tenant-{number % 10}',
+            'routes': ['GET /book', 'GET /books', 'POST /query', 'GET /allqueries']}
+           for number, token in enumerate(tokens)]
+
+with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as registry:
+    json.dump(entries, registry)
+os.environ['TOKEN_REGISTRY_FILE'] = registry.name
+
+functionPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                            'lambda_functions', 'Authenticator', 'lambda_function.py')
+spec = importlib.util.spec_from_file_location('authenticator', functionPath)
+authenticator = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(authenticator)
+
+
+def hard_coded(event, context):
+    auth = 'Deny'
+
+    if event['authorizationToken'] == 'cetm67_test':
+        auth = 'Allow'
+
+    authResponse = {}
+    authResponse['principalId'] = "cetm67_test"
+    authResponse['policyDocument'] = {}
+    authResponse['policyDocument']['Version'] = "2012-10-17"
+    authResponse['policyDocument']['Statement'] = {}
+    authResponse['policyDocument']['Statement']['Action'] = "execute-api:Invoke"
+    authResponse['policyDocument']['Statement']['Resource'] = "arn:aws:execute-api:us-east-1:645243735875:*/*/*"
+    authResponse['policyDocument']['Statement']['Effect'] = auth
+
+    return authResponse
+
+
+registeredEvent = {'authorizationToken': tokens[registrySize // 2]}
+legacyEvent = {'authorizationToken': 'cetm67_test'}
+unknownEvent = {'authorizationToken': 'not-a-registered-token'}
+
+assert authenticator.lambda_handler(registeredEvent, None)['policyDocument']['Statement'][0]['Effect'] == 'Allow'
+assert authenticator.lambda_handler(unknownEvent, None)['policyDocument']['Statement'][0]['Effect'] == 'Deny'
+
+for name, function, event in (('hard-coded check', hard_coded, legacyEvent),
+                              ('registry, registered token', authenticator.lambda_handler, registeredEvent),
+                              ('registry, legacy token', authenticator.lambda_handler, legacyEvent),
+                              ('registry, unknown token', authenticator.lambda_handler, unknownEvent)):
+    seconds = min(timeit.repeat(lambda: function(event, None), number=runs, repeat=3))
+    print(f'{name:<28} {runs / seconds:12,.0f} decisions per second')
+
+os.unlink(registry.name)
@@ -0,0 +1,55 @@
+# Times invoice html generation in StoreInvoices. Compares the old inline
+# f-string, rendering from the cached compiled template, and compiling the
+# template on every call. Run from the repository root:
+#   python benchmarks/template_render.py
+import importlib.util
+import os
+import timeit
+
+# The lambda creates its boto3 clients on import, they are not used here
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+functionPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                            'lambda_functions', 'StoreInvoices', 'lambda_function.py')
+spec = importlib.util.spec_from_file_location('store_invoices', functionPath)
+storeInvoices = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(storeInvoices)
+
+runs = 20000
+forename = 'Jane'
+surname = 'Smith'
+floatAmount = '125.50'
+
+templateData = {}
+templateData['client'] = {'forename': forename, 'surname': surname}
+templateData['yearmonth'] = '202210'
+templateData['amount'] = floatAmount
+templateData['lines'] = [{'description': f'Item {lineNumber}', 'amount': '10.00'} for lineNumber in range(10)]
+
+with open(os.path.join(storeInvoices.templatePath, 'invoice', 'v1.html')) as f:
+    templateSource = f.read()
+
+
+def inline_fstring():
+    return f'<!DOCTYPE html><html> \
+        <head></head> \
+        <body><h3>Invoice</h3><br><h6>Bill to:</h6> \
+        <h6>{forename} {surname}</h6> \
+        <h6>Please pay {floatAmount}</h6></body></html>'
+
+
+def cached_template():
+    return storeInvoices.render_invoice_template('invoice', 'v1', templateData)
+
+
+def compile_every_call():
+    return storeInvoices.InvoiceTemplate(templateSource).render(templateData)
+
+
+cached_template()
+
+for name, function in (('inline f-string', inline_fstring),
+                       ('cached compiled template', cached_template),
+                       ('compile on every call', compile_every_call)):
+    seconds = min(timeit.repeat(function, number=runs, repeat=3))
+    print(f'{name:<26} {seconds / runs * 1000000:8.2f} us per render')
@@ -1,16 +1,957 @@
+import base64
+import csv
+import io
 import json
 import boto3
+import os
+import random
+import time
+import uuid
+import zlib
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Attr
-from decimal import Decimal
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeDeserializer
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
 
 dynamo = boto3.resource("dynamodb")
 table = dynamo.Table("InvoiceDetails")
+summaryTable = dynamo.Table("InvoiceSummary")
+dynamo_client = boto3.client('dynamodb')
+lambda_client = boto3.client('lambda')
+s3 = boto3.client('s3')
 invoicesPath = "/invoices"
+invoiceJobsPath = "/invoices/jobs"
+bulkInvoicesPath = "/invoices/bulk"
+invoiceSummaryPath = "/invoices/summary"
+invoiceTemplateID = "invoice"
+invoiceTemplateVersion = "v1"
+storeInvoicesFunction = 'arn:aws:lambda:us-east-1:645243735875:function:StoreInvoices'
+
+# Asynchronous invoice creation. INVOICE_JOB_QUEUE picks the queue, sqs for
+# the deployed function or local for an in-process queue used in tests
+renderAsyncDefault = os.environ.get('INVOICE_RENDER_ASYNC', 'false').lower() == 'true'
+invoiceJobQueueType = os.environ.get('INVOICE_JOB_QUEUE', 'sqs')
+invoiceJobQueueUrl = os.environ.get('INVOICE_JOB_QUEUE_URL', '')
+invoiceJobTable = os.environ.get('INVOICE_JOB_TABLE', 'InvoiceJobs')
+invoiceJobRetention = 7 * 24 * 60 * 60
+
+# Bulk ingestion settings. BatchWriteItem takes at most 25 items per call
+bulkMaxRows = int(os.environ.get('BULK_MAX_ROWS', '5000'))
+batchWriteSize = 25
+batchWriteAttempts = 8
+batchWriteBaseDelay = 0.05
+batchWriteMaxDelay = 2.0
+bulkInvoiceFields = ('clientid', 'yearmonth', 'forename', 'surname', 'number', 'email', 'status', 'amount')
+
+# Rollups are kept per year_month in InvoiceSummary. Any status other than
+# one of paidStatuses counts as outstanding. seededMonths holds the months
+# whose row this container has already seen, so they are not read again
+paidStatuses = ('paid',)
+summaryTotals = ('billed', 'paid', 'outstanding')
+seededMonths = set()
+
+# Nightly export settings. Each scan segment writes its own gzip csv under
+# exports/{export_id}/ and checkpoints after every uploaded part
+exportBucket = 'lwbespokeinvoices'
+exportPrefix = 'exports/'
+exportPartSize = max(int(os.environ.get('EXPORT_PART_SIZE', str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+exportDefaultSegments = 4
+exportMaxSegments = 64
+exportTimeMargin = 60 * 1000
+
+# Listing settings. The status index is a GSI on invoice_status sorted by year_month
+invoiceStatusIndex = 'invoice_status-index'
+listDefaultLimit = 100
+listMaxLimit = 1000
+# NDJSON bodies stop at about 5MB once encoded, under the 6MB lambda response
+# limit with room for the headers
+ndjsonMaxBytes = int(os.environ.get('NDJSON_MAX_BYTES', str(5 * 1024 * 1024)))
+invoiceAttributes = ('client_id', 'year_month', 'forename', 'surname', 'phone_number',
+                     'email_address', 'invoice_status', 'amount')
+
+
+# Build the event StoreInvoices expects when called from another lambda
+def build_store_invoices_payload(forename, surname, yearmonth, floatAmount):
+    inputToLambda = {}
+
+    inputToLambda['httpMethod'] = 'POST'
+    inputToLambda['path'] = '/createinvoice'
+    inputToLambda['from_lambda'] = True
+    inputToLambda['forename'] = forename
+    inputToLambda['surname'] = surname
+    inputToLambda['yearmonth'] = yearmonth
+
+    # StoreInvoices builds the html from its compiled invoice template
+    inputToLambda['template_id'] = invoiceTemplateID
+    inputToLambda['template_version'] = invoiceTemplateVersion
+    inputToLambda['template_data'] = {}
+    inputToLambda['template_data']['client'] = {'forename': forename, 'surname': surname}
+    inputToLambda['template_data']['yearmonth'] = yearmonth
+    inputToLambda['template_data']['amount'] = str(floatAmount)
+
+    return inputToLambda
+
+
+def invoke_store_invoices(inputToLambda):
+    response = lambda_client.invoke(
+        FunctionName=storeInvoicesFunction,
+        InvocationType='RequestResponse',
+        Payload=json.dumps(inputToLambda)
+        )
+
+    return json.load(response['Payload'])
+
+
+# Job status is kept in DynamoDB so any container can answer GET /invoices/jobs
+class DynamoInvoiceJobStore:
+
+    def __init__(self, tableName):
+        self.table = dynamo.Table(tableName)
+
+    def create(self, job):
+        self.table.put_item(Item=job)
+
+    def create_batch(self, jobs):
+        with self.table.batch_writer() as batch:
+            for job in jobs:
+                batch.put_item(Item=job)
+
+    def update(self, jobID, status, **fields):
+        fields['job_status'] = status
+        fields['updated'] = datetime.now().strftime("%Y%m%d%H%M%S")
+
+        # Attribute names go through placeholders in case any are reserved words
+        updateExpression = "set " + ", ".join(f"#{name}=:{name}" for name in fields)
+        self.table.update_item(Key={'job_id': jobID},
+                               UpdateExpression=updateExpression,
+                               ExpressionAttributeNames={f'#{name}': name for name in fields},
+                               ExpressionAttributeValues={f':{name}': value for name, value in fields.items()})
+
+    def get(self, jobID):
+        return self.table.get_item(Key={'job_id': jobID}).get('Item')
+
+
+class LocalInvoiceJobStore:
+
+    def __init__(self):
+        self.jobs = {}
+
+    def create(self, job):
+        self.jobs[job['job_id']] = dict(job)
+
+    def create_batch(self, jobs):
+        for job in jobs:
+            self.create(job)
+
+    def update(self, jobID, status, **fields):
+        self.jobs[jobID]['job_status'] = status
+        self.jobs[jobID]['updated'] = datetime.now().strftime("%Y%m%d%H%M%S")
+        self.jobs[jobID].update(fields)
+
+    def get(self, jobID):
+        return self.jobs.get(jobID)
+
+
+# Jobs are sent to an SQS queue which has this function as its event source
+class SqsInvoiceJobQueue:
+
+    def __init__(self, queueUrl):
+        self.queueUrl = queueUrl
+        self.sqs_client = boto3.client('sqs')
+
+    def send(self, job):
+        self.sqs_client.send_message(QueueUrl=self.queueUrl,
+                                     MessageBody=json.dumps({'job_id': job['job_id']}))
+
+    # SQS takes at most 10 messages per batch. Returns the ids of any jobs
+    # that could not be sent
+    def send_batch(self, jobs):
+        failedJobs = []
+        for start in range(0, len(jobs), 10):
+            entries = [{'Id': str(number), 'MessageBody': json.dumps({'job_id': job['job_id']})}
+                       for number, job in enumerate(jobs[start:start + 10])]
+            response = self.sqs_client.send_message_batch(QueueUrl=self.queueUrl, Entries=entries)
+            for failed in response.get('Failed', []):
+                failedJobs.append(jobs[start + int(failed['Id'])]['job_id'])
+        return failedJobs
+
+
+# In-process stand in for the SQS queue. Nothing happens until drain is called
+class LocalInvoiceJobQueue:
+
+    def __init__(self):
+        self.pending = deque()
+
+    def send(self, job):
+        self.pending.append({'job_id': job['job_id']})
+
+    def send_batch(self, jobs):
+        for job in jobs:
+            self.send(job)
+        return []
+
+    def drain(self):
+        results = []
+        while self.pending:
+            results.append(process_invoice_job(self.pending.popleft()['job_id']))
+        return results
+
+
+def create_invoice_job_backend(queueType):
+    if queueType == 'local':
+        return LocalInvoiceJobStore(), LocalInvoiceJobQueue()
+    return DynamoInvoiceJobStore(invoiceJobTable), SqsInvoiceJobQueue(invoiceJobQueueUrl)
+
+
+invoiceJobStore, invoiceJobQueue = create_invoice_job_backend(invoiceJobQueueType)
+
+
+def build_invoice_job(clientID, yearmonth, inputToLambda):
+    dateTimeString = datetime.now().strftime("%Y%m%d%H%M%S")
+
+    job = {}
+    job['job_id'] = uuid.uuid4().hex
+    job['job_status'] = 'queued'
+    job['client_id'] = clientID
+    job['year_month'] = yearmonth
+    job['created'] = dateTimeString
+    job['updated'] = dateTimeString
+    job['payload'] = json.dumps(inputToLambda)
+    job['expires_at'] = int(time.time()) + invoiceJobRetention
+    return job
+
+
+# Record the job as queued and hand it to the queue. The StoreInvoices event
+# is kept with the job so the worker does not need to read the invoice again
+def enqueue_invoice_job(clientID, yearmonth, inputToLambda):
+    job = build_invoice_job(clientID, yearmonth, inputToLambda)
+    invoiceJobStore.create(job)
+    invoiceJobQueue.send(job)
+    return job
+
+
+# Render one queued invoice. The job ends up done with the s3 key of the pdf
+# or failed with the reason
+def process_invoice_job(jobID):
+    job = invoiceJobStore.get(jobID)
+    if job is None:
+        return {'job_id': jobID, 'job_status': 'missing'}
+    if job['job_status'] == 'done':
+        return {'job_id': jobID, 'job_status': 'done'}
+
+    invoiceJobStore.update(jobID, 'rendering')
+
+    try:
+        responseFromLambda = invoke_store_invoices(json.loads(job['payload']))
+    except Exception as error:
+        invoiceJobStore.update(jobID, 'failed', error=str(error))
+        raise
+
+    if responseFromLambda['statusCode'] == "200":
+        s3Key = responseFromLambda.get('headers', {}).get('X-Invoice-Key', '')
+        invoiceJobStore.update(jobID, 'done', s3_key=s3Key)
+        return {'job_id': jobID, 'job_status': 'done', 's3_key': s3Key}
+
+    invoiceJobStore.update(jobID, 'failed', error=str(responseFromLambda.get('body')))
+    return {'job_id': jobID, 'job_status': 'failed'}
+
+
+# Worker for the SQS event source. Only jobs that raised are reported back
+# so SQS retries those and deletes the rest of the batch
+def process_invoice_job_records(records):
+    batchItemFailures = []
+
+    for record in records:
+        try:
+            process_invoice_job(json.loads(record['body'])['job_id'])
+        except Exception as error:
+            print(json.dumps({'event': 'invoice_job_failed', 'message_id': record['messageId'], 'error': str(error)}))
+            batchItemFailures.append({'itemIdentifier': record['messageId']})
+
+    return {'batchItemFailures': batchItemFailures}
+
+
+# The change one invoice makes to its month's rollup. sign is 1 when the
+# invoice is added and -1 when it is removed or replaced
+def invoice_summary_delta(item, sign):
+    status = item['invoice_status']
+    amount = Decimal(item['amount']) * sign
+    settled = 'paid' if status.lower() in paidStatuses else 'outstanding'
+
+    return {
+        'billed_amount': amount,
+        'billed_count': sign,
+        f'{settled}_amount': amount,
+        f'{settled}_count': sign,
+        f'status#{status}#amount': amount,
+        f'status#{status}#count': sign
+    }
+
+
+def merge_summary_deltas(deltas, delta):
+    for name, value in delta.items():
+        deltas[name] = deltas.get(name, 0) + value
+    return deltas
+
+
+# Apply the deltas with one atomic ADD so concurrent writers do not lose
+# updates. Names go through placeholders as statuses can be anything. Only
+# an existing row is moved, ADD on a missing one would start from zero and
+# leave out the invoices saved before it
+def apply_summary_deltas(yearmonth, deltas):
+    deltas = {name: value for name, value in deltas.items() if value != 0}
+    if not deltas:
+        return
+
+    names = list(deltas)
+    summaryTable.update_item(
+        Key={'year_month': yearmonth},
+        ConditionExpression=Attr('year_month').exists(),
+        UpdateExpression='ADD ' + ', '.join(f'#a{number} :v{number}' for number in range(len(names))),
+        ExpressionAttributeNames={f'#a{number}': name for number, name in enumerate(names)},
+        ExpressionAttributeValues={f':v{number}': Decimal(deltas[name]) for number, name in enumerate(names)}
+        )
+
+
+# Rollups can always be rebuilt by the reconcile action, so a failure here is
+# logged rather than failing a write that has already succeeded
+def update_invoice_summary(yearmonth, deltas):
+    try:
+        apply_summary_deltas(yearmonth, deltas)
+    except ClientError as error:
+        print(json.dumps({'event': 'invoice_summary_failed', 'year_month': yearmonth, 'error': str(error)}))
+
+
+# Totals for one month counted from InvoiceDetails. The month is not part of
+# the partition key so this is a filtered scan of the whole table
+def count_month_summary(yearmonth):
+    deltas = {}
+    scanArgs = {'ProjectionExpression': 'invoice_status, amount',
+                'FilterExpression': Attr('year_month').eq(yearmonth),
+                'ConsistentRead': True}
+
+    while True:
+        page = table.scan(**scanArgs)
+        for item in page['Items']:
+            merge_summary_deltas(deltas, invoice_summary_delta(item, 1))
+        if 'LastEvaluatedKey' not in page:
+            break
+        scanArgs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+    return deltas
+
+
+# Called before anything is written to a month. The first write to a month
+# makes its row from the invoices already there, including any saved before
+# the rollups existed. The row is only put if no other writer made it first,
+# and every write after that moves it, so nothing is counted twice
+def prepare_invoice_summary(yearmonth):
+    if yearmonth in seededMonths:
+        return
+
+    try:
+        if 'Item' not in summaryTable.get_item(Key={'year_month': yearmonth}, ProjectionExpression='year_month'):
+            summaryItem = {name: Decimal(value) for name, value in count_month_summary(yearmonth).items()}
+            summaryItem['year_month'] = yearmonth
+            try:
+                summaryTable.put_item(Item=summaryItem, ConditionExpression=Attr('year_month').not_exists())
+            except ClientError as error:
+                if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+        seededMonths.add(yearmonth)
+    except ClientError as error:
+        print(json.dumps({'event': 'invoice_summary_seed_failed', 'year_month': yearmonth, 'error': str(error)}))
+
+
+def summary_to_json(summaryItem):
+    summary = {}
+    summary['year_month'] = summaryItem['year_month']
+    for total in summaryTotals:
+        summary[total] = {'amount': str(summaryItem.get(f'{total}_amount', 0)),
+                          'count': int(summaryItem.get(f'{total}_count', 0))}
+
+    summary['statuses'] = {}
+    for name, value in summaryItem.items():
+        if name.startswith('status#'):
+            status, _, field = name[len('status#'):].rpartition('#')
+            summary['statuses'].setdefault(status, {'amount': '0', 'count': 0})
+            summary['statuses'][status][field] = int(value) if field == 'count' else str(value)
+
+    return summary
+
+
+# Read the current version of invoices about to be overwritten by a bulk load
+# so their old amounts can be taken out of the rollups
+def fetch_existing_invoices(items):
+    existing = {}
+    keys = [{'client_id': item['client_id'], 'year_month': item['year_month']} for item in items]
+
+    for start in range(0, len(keys), 100):
+        requestItems = {table.name: {'Keys': keys[start:start + 100],
+                                     'ProjectionExpression': 'client_id, year_month, invoice_status, amount'}}
+        for attempt in range(batchWriteAttempts):
+            response = dynamo.batch_get_item(RequestItems=requestItems)
+            for item in response['Responses'].get(table.name, []):
+                existing[(item['client_id'], item['year_month'])] = item
+            requestItems = response.get('UnprocessedKeys') or {}
+            if not requestItems:
+                break
+            time.sleep(random.uniform(0, min(batchWriteMaxDelay, batchWriteBaseDelay * 2 ** attempt)))
+
+    return existing
+
+
+# Recompute every rollup from a full scan of InvoiceDetails to repair drift,
+# removing months that no longer have any invoices
+def reconcile_invoice_summary():
+    monthDeltas = {}
+    scanArgs = {'ProjectionExpression': 'year_month, invoice_status, amount'}
+
+    while True:
+        page = table.scan(**scanArgs)
+        for item in page['Items']:
+            merge_summary_deltas(monthDeltas.setdefault(item['year_month'], {}), invoice_summary_delta(item, 1))
+        if 'LastEvaluatedKey' not in page:
+            break
+        scanArgs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+    staleMonths = []
+    summaryScanArgs = {'ProjectionExpression': 'year_month'}
+    while True:
+        page = summaryTable.scan(**summaryScanArgs)
+        staleMonths += [item['year_month'] for item in page['Items'] if item['year_month'] not in monthDeltas]
+        if 'LastEvaluatedKey' not in page:
+            break
+        summaryScanArgs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+    with summaryTable.batch_writer() as batch:
+        for yearmonth, deltas in monthDeltas.items():
+            summaryItem = {name: Decimal(value) for name, value in deltas.items()}
+            summaryItem['year_month'] = yearmonth
+            batch.put_item(Item=summaryItem)
+        for yearmonth in staleMonths:
+            batch.delete_item(Key={'year_month': yearmonth})
+
+    return {'months': len(monthDeltas), 'removed': len(staleMonths)}
+
+
+def read_export_checkpoint(exportID, segment):
+    try:
+        checkpointObject = s3.get_object(Bucket=exportBucket,
+                                         Key=f'{exportPrefix}{exportID}/checkpoints/segment-{segment:04d}.json')
+    except ClientError as error:
+        if error.response['Error']['Code'] not in ('NoSuchKey', '404', 'NotFound'):
+            raise
+        return None
+    return json.loads(checkpointObject['Body'].read())
+
+
+def save_export_checkpoint(exportID, segment, checkpoint):
+    s3.put_object(Bucket=exportBucket,
+                  Key=f'{exportPrefix}{exportID}/checkpoints/segment-{segment:04d}.json',
+                  Body=json.dumps(checkpoint).encode('utf-8'),
+                  ContentType='application/json')
+
+
+def invoice_rows_to_csv(items, includeHeader):
+    csvText = io.StringIO()
+    csvWriter = csv.writer(csvText)
+    if includeHeader:
+        csvWriter.writerow(invoiceAttributes)
+    for item in items:
+        csvWriter.writerow([item.get(field, '') for field in invoiceAttributes])
+    return csvText.getvalue()
+
+
+# Export one parallel scan segment to a gzip csv through a multipart upload.
+# Each part is a complete gzip member, and concatenated members are still one
+# valid gzip file, so after every part the checkpoint can record the scan
+# position and a later run can carry on from there with a fresh compressor.
+# Rows read after the last part are simply scanned again on resume
+def export_segment(exportID, segment, totalSegments, pageSize, rcuPerSecond, stillHasTime):
+    checkpoint = read_export_checkpoint(exportID, segment)
+    if checkpoint is None:
+        checkpoint = {'key': f'{exportPrefix}{exportID}/invoices-{segment:04d}.csv.gz',
+                      'upload_id': None,
+                      'parts': [],
+                      'last_evaluated_key': None,
+                      'rows': 0,
+                      'complete': False}
+    if checkpoint['complete']:
+        return checkpoint
+
+    if checkpoint['upload_id'] is None:
+        checkpoint['upload_id'] = s3.create_multipart_upload(Bucket=exportBucket, Key=checkpoint['key'],
+                                                             ContentType='text/csv',
+                                                             ContentEncoding='gzip')['UploadId']
+        save_export_checkpoint(exportID, segment, checkpoint)
+
+    # A plain client is thread safe, unlike the table resource. It returns
+    # typed values, so the checkpointed LastEvaluatedKey stays valid json
+    # and only the rows are converted for the csv
+    deserializer = TypeDeserializer()
+
+    scanArgs = {'TableName': table.name,
+                'Segment': segment,
+                'TotalSegments': totalSegments,
+                'ReturnConsumedCapacity': 'TOTAL'}
+    if pageSize:
+        scanArgs['Limit'] = pageSize
+    lastEvaluatedKey = checkpoint['last_evaluated_key']
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    partBuffer = bytearray()
+    partRows = 0
+    if not checkpoint['parts']:
+        partBuffer += compressor.compress(invoice_rows_to_csv([], True).encode('utf-8'))
+
+    while True:
+        if not stillHasTime():
+            return checkpoint
+
+        if lastEvaluatedKey:
+            scanArgs['ExclusiveStartKey'] = lastEvaluatedKey
+        pageStart = time.monotonic()
+        page = dynamo_client.scan(**scanArgs)
+
+        items = [{name: deserializer.deserialize(value) for name, value in item.items()} for item in page['Items']]
+        partBuffer += compressor.compress(invoice_rows_to_csv(items, False).encode('utf-8'))
+        partRows += len(items)
+        lastEvaluatedKey = page.get('LastEvaluatedKey')
+
+        if len(partBuffer) >= exportPartSize or lastEvaluatedKey is None:
+            partBuffer += compressor.flush()
+            partNumber = len(checkpoint['parts']) + 1
+            part = s3.upload_part(Bucket=exportBucket, Key=checkpoint['key'], UploadId=checkpoint['upload_id'],
+                                  PartNumber=partNumber, Body=bytes(partBuffer))
+            checkpoint['parts'].append({'PartNumber': partNumber, 'ETag': part['ETag']})
+            checkpoint['rows'] += partRows
+            checkpoint['last_evaluated_key'] = lastEvaluatedKey
+
+            if lastEvaluatedKey is None:
+                s3.complete_multipart_upload(Bucket=exportBucket, Key=checkpoint['key'],
+                                             UploadId=checkpoint['upload_id'],
+                                             MultipartUpload={'Parts': checkpoint['parts']})
+                checkpoint['complete'] = True
+                save_export_checkpoint(exportID, segment, checkpoint)
+                return checkpoint
+
+            save_export_checkpoint(exportID, segment, checkpoint)
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            partBuffer = bytearray()
+            partRows = 0
+
+        # Keep this segment's share of the read capacity under its limit
+        if rcuPerSecond:
+            consumed = page.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+            time.sleep(max(0, consumed / rcuPerSecond - (time.monotonic() - pageStart)))
+
+
+# Run a parallel scan export of InvoiceDetails. If the lambda runs short of
+# time the segments stop at their last checkpoint and calling again with the
+# same export_id carries on. The manifest is written once every segment is done
+def export_invoices(exportID, totalSegments, pageSize, maxRcuPerSecond, context):
+    rcuPerSecond = maxRcuPerSecond / totalSegments if maxRcuPerSecond else None
+
+    def stillHasTime():
+        return context is None or context.get_remaining_time_in_millis() > exportTimeMargin
+
+    with ThreadPoolExecutor(max_workers=totalSegments) as executor:
+        checkpoints = list(executor.map(
+            lambda segment: export_segment(exportID, segment, totalSegments, pageSize, rcuPerSecond, stillHasTime),
+            range(totalSegments)))
+
+    exportResult = {}
+    exportResult['export_id'] = exportID
+    exportResult['complete'] = all(checkpoint['complete'] for checkpoint in checkpoints)
+    exportResult['rows'] = sum(checkpoint['rows'] for checkpoint in checkpoints)
+    exportResult['segments'] = [{'segment': segment, 'complete': checkpoint['complete'], 'rows': checkpoint['rows']}
+                                for segment, checkpoint in enumerate(checkpoints)]
+
+    if exportResult['complete']:
+        manifest = {}
+        manifest['export_id'] = exportID
+        manifest['table'] = table.name
+        manifest['created'] = datetime.now().strftime("%Y%m%d%H%M%S")
+        manifest['format'] = 'csv'
+        manifest['compression'] = 'gzip'
+        manifest['columns'] = list(invoiceAttributes)
+        manifest['rows'] = exportResult['rows']
+        manifest['files'] = [{'key': checkpoint['key'], 'rows': checkpoint['rows']} for checkpoint in checkpoints]
+        s3.put_object(Bucket=exportBucket, Key=f'{exportPrefix}{exportID}/manifest.json',
+                      Body=json.dumps(manifest).encode('utf-8'), ContentType='application/json')
+        exportResult['manifest'] = f'{exportPrefix}{exportID}/manifest.json'
+
+    return exportResult
+
+
+# Read the rows of a bulk request. The body is either a JSON array of invoices
+# or NDJSON with one invoice per line. Rows that can not be parsed are kept as
+# errors so they still get a result
+def read_bulk_rows(event):
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
+
+    if body.lstrip().startswith('['):
+        try:
+            return list(enumerate(json.loads(body), start=1))
+        except ValueError as error:
+            raise ValueError(f'Body is not a valid JSON array: {error}')
+
+    rows = []
+    for lineNumber, line in enumerate(body.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            rows.append((lineNumber, json.loads(line)))
+        except ValueError:
+            rows.append((lineNumber, ValueError('Line is not valid JSON')))
+    return rows
+
+
+# Check a bulk row has the same fields as a single POST and build the item
+def validate_bulk_row(row):
+    if isinstance(row, ValueError):
+        raise row
+    if not isinstance(row, dict):
+        raise ValueError('Row must be a JSON object')
+
+    for field in bulkInvoiceFields:
+        if field not in row or str(row[field]).strip() == '':
+            raise ValueError(f'{field} field not supplied')
+
+    try:
+        floatAmount = Decimal(str(row['amount']))
+    except InvalidOperation:
+        raise ValueError('amount must be a number')
+    if not floatAmount.is_finite():
+        raise ValueError('amount must be a number')
+
+    return {
+        'client_id': str(row['clientid']),
+        'year_month': str(row['yearmonth']),
+        'forename': str(row['forename']),
+        'surname': str(row['surname']),
+        'phone_number': str(row['number']),
+        'email_address': str(row['email']),
+        'invoice_status': str(row['status']),
+        'amount': floatAmount
+    }
+
+
+# Write up to 25 items with BatchWriteItem, retrying whatever DynamoDB leaves
+# unprocessed with full jitter backoff. Returns the items never written
+def batch_write_invoices(items):
+    pending = [{'PutRequest': {'Item': item}} for item in items]
+
+    for attempt in range(batchWriteAttempts):
+        try:
+            response = dynamo.batch_write_item(RequestItems={table.name: pending})
+            pending = response.get('UnprocessedItems', {}).get(table.name, [])
+        except ClientError as error:
+            if error.response['Error']['Code'] not in ('ProvisionedThroughputExceededException',
+                                                       'ThrottlingException', 'RequestLimitExceeded'):
+                raise
+
+        if not pending:
+            return []
+
+        time.sleep(random.uniform(0, min(batchWriteMaxDelay, batchWriteBaseDelay * 2 ** attempt)))
+
+    return [request['PutRequest']['Item'] for request in pending]
+
+
+# Validate every row, write the valid ones in 25 item chunks and optionally
+# queue pdf creation for everything written. Each row gets its own result
+def ingest_invoices(rows, generatePdfs):
+    results = []
+    validItems = []
+    rowForKey = {}
+
+    for rowNumber, row in rows:
+        result = {'row': rowNumber}
+        results.append(result)
+
+        try:
+            item = validate_bulk_row(row)
+        except ValueError as error:
+            result['status'] = 'invalid'
+            result['error'] = str(error)
+            continue
+
+        # BatchWriteItem rejects a chunk with the same key twice, and a later
+        # row would overwrite the earlier one anyway
+        itemKey = (item['client_id'], item['year_month'])
+        if itemKey in rowForKey:
+            result['status'] = 'duplicate'
+            result['error'] = f"Same clientid and yearmonth as row {rowForKey[itemKey]['row']}"
+            continue
+
+        rowForKey[itemKey] = result
+        validItems.append(item)
+
+    existingItems = fetch_existing_invoices(validItems)
+    for yearmonth in set(item['year_month'] for item in validItems):
+        prepare_invoice_summary(yearmonth)
+
+    writtenItems = []
+    for start in range(0, len(validItems), batchWriteSize):
+        chunk = validItems[start:start + batchWriteSize]
+        try:
+            unwritten = batch_write_invoices(chunk)
+            failedError = 'Not written after retries'
+        except ClientError as error:
+            unwritten = chunk
+            failedError = error.response['Error']['Message']
+
+        unwrittenKeys = set((item['client_id'], item['year_month']) for item in unwritten)
+        for item in chunk:
+            result = rowForKey[(item['client_id'], item['year_month'])]
+            if (item['client_id'], item['year_month']) in unwrittenKeys:
+                result['status'] = 'failed'
+                result['error'] = failedError
+            else:
+                result['status'] = 'written'
+                writtenItems.append(item)
+
+    # One rollup update per month for the whole load, taking out the old
+    # version of any invoice that was overwritten
+    monthDeltas = {}
+    for item in writtenItems:
+        itemKey = (item['client_id'], item['year_month'])
+        deltas = monthDeltas.setdefault(item['year_month'], {})
+        merge_summary_deltas(deltas, invoice_summary_delta(item, 1))
+        if itemKey in existingItems:
+            merge_summary_deltas(deltas, invoice_summary_delta(existingItems[itemKey], -1))
+    for yearmonth, deltas in monthDeltas.items():
+        update_invoice_summary(yearmonth, deltas)
+
+    if generatePdfs and writtenItems:
+        jobs = []
+        for item in writtenItems:
+            inputToLambda = build_store_invoices_payload(item['forename'], item['surname'],
+                                                         item['year_month'], item['amount'])
+            job = build_invoice_job(item['client_id'], item['year_month'], inputToLambda)
+            rowForKey[(item['client_id'], item['year_month'])]['job_id'] = job['job_id']
+            jobs.append(job)
+
+        invoiceJobStore.create_batch(jobs)
+        failedJobs = set(invoiceJobQueue.send_batch(jobs))
+        for item in writtenItems:
+            result = rowForKey[(item['client_id'], item['year_month'])]
+            if result['job_id'] in failedJobs:
+                result['job_error'] = 'Failed to queue pdf creation'
+
+    return results
+
+
+# Cursors are the LastEvaluatedKey of the previous page, base64 encoded so
+# clients treat them as opaque
+def encode_cursor(lastEvaluatedKey):
+    return base64.urlsafe_b64encode(json.dumps(lastEvaluatedKey).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        lastEvaluatedKey = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError:
+        raise ValueError('Invalid cursor supplied')
+    if (not isinstance(lastEvaluatedKey, dict)
+            or not all(name in invoiceAttributes and isinstance(value, str)
+                       for name, value in lastEvaluatedKey.items())):
+        raise ValueError('Invalid cursor supplied')
+    return lastEvaluatedKey
+
+
+# Work out the cheapest read for the filters supplied. A client id uses the
+# table key, a status uses the status index, and a year month narrows either
+# of those through the year_month sort key. Only a year month on its own, or
+# no filter at all, has to fall back to a scan
+def build_invoice_listing(queryParameters):
+    clientID = queryParameters.get('clientid')
+    yearmonth = queryParameters.get('yearmonth')
+    status = queryParameters.get('status')
+
+    try:
+        limit = int(queryParameters.get('limit', listDefaultLimit))
+    except ValueError:
+        limit = 0
+    if limit < 1 or limit > listMaxLimit:
+        raise ValueError(f'limit must be between 1 and {listMaxLimit}')
+
+    listArgs = {'Limit': limit}
+
+    if queryParameters.get('cursor'):
+        listArgs['ExclusiveStartKey'] = decode_cursor(queryParameters['cursor'])
+
+    # fields is a comma separated list of the attributes to return
+    if queryParameters.get('fields'):
+        fields = [field.strip() for field in queryParameters['fields'].split(',') if field.strip()]
+        unknownFields = [field for field in fields if field not in invoiceAttributes]
+        if unknownFields or not fields:
+            raise ValueError(f"fields can only contain {', '.join(invoiceAttributes)}")
+        listArgs['ProjectionExpression'] = ', '.join(f'#p{number}' for number in range(len(fields)))
+        listArgs['ExpressionAttributeNames'] = {f'#p{number}': field for number, field in enumerate(fields)}
+
+    if clientID:
+        keyCondition = Key('client_id').eq(clientID)
+        if yearmonth:
+            keyCondition = keyCondition & Key('year_month').begins_with(yearmonth)
+        listArgs['KeyConditionExpression'] = keyCondition
+        if status:
+            listArgs['FilterExpression'] = Attr('invoice_status').eq(status)
+        return table.query, listArgs
+
+    if status:
+        keyCondition = Key('invoice_status').eq(status)
+        if yearmonth:
+            keyCondition = keyCondition & Key('year_month').begins_with(yearmonth)
+        listArgs['IndexName'] = invoiceStatusIndex
+        listArgs['KeyConditionExpression'] = keyCondition
+        return table.query, listArgs
+
+    if yearmonth:
+        listArgs['FilterExpression'] = Attr('year_month').begins_with(yearmonth)
+    return table.scan, listArgs
+
+
+# Decimal values from DynamoDB are written as strings, which is how amounts
+# have always been returned, so items no longer need converting before encoding
+class ResponseEncoder(json.JSONEncoder):
+
+    def default(self, value):
+        if isinstance(value, Decimal):
+            return str(value)
+        return super().default(value)
+
+
+responseEncoder = ResponseEncoder()
+
+
+# gzip is used when the client lists it in Accept-Encoding without q=0
+def client_accepts_gzip(event):
+    headers = event.get('headers') or {}
+    for name, value in headers.items():
+        if name.lower() != 'accept-encoding' or not value:
+            continue
+        for encoding in value.split(','):
+            encodingName, _, parameters = encoding.strip().partition(';')
+            if encodingName.strip().lower() in ('gzip', '*') and parameters.replace(' ', '') != 'q=0':
+                return True
+    return False
+
+
+# NDJSON is picked with format=ndjson or an Accept header asking for it
+def client_wants_ndjson(event, queryParameters):
+    if queryParameters.get('format', '').lower() == 'ndjson':
+        return True
+    headers = event.get('headers') or {}
+    return any(name.lower() == 'accept' and 'application/x-ndjson' in (value or '')
+               for name, value in headers.items())
+
+
+# Collects the response body as it is written. With gzip each piece is
+# compressed as it arrives so only the compressed body is held in memory
+class ResponseWriter:
+
+    def __init__(self, useGzip):
+        self.useGzip = useGzip
+        self.parts = []
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if useGzip else None
+        self.size = 0
+
+    # size tracks what the body adds to the lambda response, where plain text
+    # is json escaped and gzip is base64 encoded. Returns False, writing
+    # nothing, if the text would take the body over maxSize. The text is
+    # compressed on a copy of the compressor so a refused write leaves the
+    # stream as it was
+    def write(self, text, maxSize=None):
+        if self.useGzip:
+            compressor = self.compressor.copy()
+            part = compressor.compress(text.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            partSize = (len(part) + 2) // 3 * 4
+        else:
+            part = text
+            partSize = len(text.encode('utf-8')) + text.count('"') + text.count('\\') + text.count('\n')
+
+        if maxSize is not None and self.size + partSize > maxSize:
+            return False
+
+        if self.useGzip:
+            self.compressor = compressor
+        self.parts.append(part)
+        self.size += partSize
+        return True
+
+    # Build the API Gateway response. Binary media types must be enabled on
+    # the API for the base64 gzip body to be decoded before it is sent
+    def response(self, statusCode, contentType, headers=None):
+        responseObject = {}
+        responseObject['statusCode'] = statusCode
+        responseObject['headers'] = dict(headers or {})
+        responseObject['headers']['Content-Type'] = contentType
+
+        if self.useGzip:
+            self.parts.append(self.compressor.flush())
+            responseObject['headers']['Content-Encoding'] = 'gzip'
+            responseObject['isBase64Encoded'] = True
+            responseObject['body'] = base64.b64encode(b''.join(self.parts)).decode('ascii')
+        else:
+            responseObject['body'] = ''.join(self.parts)
+
+        return responseObject
+
+
+# Write items one per line while following LastEvaluatedKey, so each page is
+# serialised and released before the next is read. A page that would take the
+# body over maxBytes is left for the next request, so the key it was read from
+# is returned to carry on from. The first page is always written
+def write_ndjson_pages(writer, listOperation, listArgs, maxBytes):
+    listArgs = dict(listArgs)
+    firstPage = True
+
+    while True:
+        page = listOperation(**listArgs)
+        lines = ''.join(responseEncoder.encode(item) + '\n' for item in page['Items'])
+        if not writer.write(lines, None if firstPage else maxBytes):
+            return listArgs['ExclusiveStartKey']
+        firstPage = False
+
+        if 'LastEvaluatedKey' not in page:
+            return None
+        listArgs['ExclusiveStartKey'] = page['LastEvaluatedKey']
 
 
 def lambda_handler(event, context):
 
+    # Queued invoice jobs delivered by SQS
+    if 'Records' in event:
+        return process_invoice_job_records(event['Records'])
+
+    # Nightly export to s3. export_id defaults to today so a re-run the same
+    # day resumes the unfinished export rather than starting again
+    if event.get('action') == 'export_invoices':
+        try:
+            exportID = str(event.get('export_id') or datetime.now().strftime("%Y%m%d"))
+            totalSegments = int(event.get('segments', exportDefaultSegments))
+            pageSize = int(event['page_size']) if event.get('page_size') else None
+            maxRcuPerSecond = float(event['max_rcu_per_second']) if event.get('max_rcu_per_second') else None
+        except (TypeError, ValueError):
+            return {'error': 'segments, page_size and max_rcu_per_second must be numbers'}
+
+        if totalSegments < 1 or totalSegments > exportMaxSegments or '/' in exportID:
+            return {'error': f'segments must be between 1 and {exportMaxSegments} and export_id can not contain /'}
+
+        return export_invoices(exportID, totalSegments, pageSize, maxRcuPerSecond, context)
+
+    # Scheduled repair of the InvoiceSummary rollups
+    if event.get('action') == 'reconcile_invoice_summary':
+        return reconcile_invoice_summary()
+
     # Ensure calling method and api paths supplied are correct
     if event['httpMethod'] == "POST" and event['path'] == invoicesPath:
 
@@ -104,6 +1045,12 @@ def lambda_handler(event, context):
 
         floatAmount = Decimal(amount)
 
+        # async is optional and returns straight after the insert with a job id
+        renderAsync = renderAsyncDefault
+        if 'async' in event['queryStringParameters']:
+            renderAsync = event['queryStringParameters']['async'].upper() == "TRUE"
+
+        prepare_invoice_summary(yearmonth)
         response = table.put_item(Item={
             'client_id': clientID,
             'year_month': yearmonth,
@@ -113,34 +1060,37 @@ def lambda_handler(event, context):
             'email_address': contactEmail,
             'invoice_status': status,
             'amount': floatAmount
-        })
+        }, ReturnValues='ALL_OLD')
 
         if response['ResponseMetadata']['HTTPStatusCode'] == 200:
 
+            # Add the invoice to its month's rollup, taking out the invoice it
+            # replaced if there was already one for this client and month
+            deltas = invoice_summary_delta({'invoice_status': status, 'amount': floatAmount}, 1)
+            if 'Attributes' in response:
+                merge_summary_deltas(deltas, invoice_summary_delta(response['Attributes'], -1))
+            update_invoice_summary(yearmonth, deltas)
+
+            inputToLambda = build_store_invoices_payload(forename, surname, yearmonth, floatAmount)
+
+            # In async mode the pdf is created by the job worker and the caller
+            # polls GET /invoices/jobs with the job id returned here
+            if renderAsync:
+                job = enqueue_invoice_job(clientID, yearmonth, inputToLambda)
+
+                message = {}
+                message['job_id'] = job['job_id']
+                message['job_status'] = job['job_status']
+
+                responseObject = {}
+                responseObject['statusCode'] = '202'
+                responseObject['headers'] = {}
+                responseObject['body'] = json.dumps(message)
+                return responseObject
+
             # The below will called the StoreInvoices lambda to create the
             # invoice pdf from the data supplied
-            lambda_client = boto3.client('lambda')
-            inputToLambda = {}
-
-            inputToLambda['httpMethod'] = 'POST'
-            inputToLambda['path'] = '/createinvoice'
-            inputToLambda['from_lambda'] = True
-            inputToLambda['forename'] = forename
-            inputToLambda['surname'] = surname
-            inputToLambda['yearmonth'] = yearmonth
-            inputToLambda['html_string'] = f'<!DOCTYPE html><html> \
-                <head></head> \
-                <body><h3>Invoice</h3><br><h6>Bill to:</h6> \
-                <h6>{forename} {surname}</h6> \
-                <h6>Please pay {floatAmount}</h6></body></html>'
-
-            response = lambda_client.invoke(
-                FunctionName='arn:aws:lambda:us-east-1:645243735875:function:StoreInvoices',
-                InvocationType='RequestResponse',
-                Payload=json.dumps(inputToLambda)
-                )
-
-            responseFromLambda = json.load(response['Payload'])
+            responseFromLambda = invoke_store_invoices(inputToLambda)
 
             if responseFromLambda['statusCode'] == "200":
 
@@ -163,6 +1113,46 @@ def lambda_handler(event, context):
 
             return responseObject
 
+    if event['httpMethod'] == "POST" and event['path'] == bulkInvoicesPath:
+
+        try:
+            rows = read_bulk_rows(event)
+        except ValueError as error:
+            message = str(error)
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
+
+        if len(rows) == 0 or len(rows) > bulkMaxRows:
+            message = f"Between 1 and {bulkMaxRows} invoices must be supplied"
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
+
+        # generatepdfs is optional and queues pdf creation for every row written
+        queryParameters = event.get('queryStringParameters') or {}
+        generatePdfs = queryParameters.get('generatepdfs', 'false').upper() == "TRUE"
+
+        results = ingest_invoices(rows, generatePdfs)
+
+        message = {}
+        message['written'] = sum(1 for result in results if result['status'] == 'written')
+        message['failed'] = len(results) - message['written']
+        message['results'] = results
+
+        # 207 tells the caller to check the results as some rows were not written
+        responseObject = {}
+        responseObject['statusCode'] = '200' if message['failed'] == 0 else '207'
+        responseObject['headers'] = {}
+        responseObject['body'] = json.dumps(message)
+        return responseObject
+
     if event['httpMethod'] == "PATCH" and event['path'] == invoicesPath:
 
         try:
@@ -200,12 +1190,14 @@ def lambda_handler(event, context):
 
         # Update the status but on an existing record. DynamoDB would just
         # enter a new record if it does not already exist without the check
+        prepare_invoice_summary(yearMonth)
         try:
             response = table.update_item(
                 Key={'client_id': clientID, 'year_month': yearMonth},
                 ConditionExpression=Attr("client_id").exists() & Attr("year_month").exists(),
                 UpdateExpression="set invoice_status=:statussupplied",
-                ExpressionAttributeValues={':statussupplied': updateTo}
+                ExpressionAttributeValues={':statussupplied': updateTo},
+                ReturnValues='ALL_OLD'
                 )
         except ClientError as error:
             if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
@@ -215,6 +1207,14 @@ def lambda_handler(event, context):
                 responseObject['body'] = "Supplied input does not exist. Failed to update invoice status"
                 return responseObject
 
+        # Move the amount between statuses only if the status really changed
+        previous = response.get('Attributes', {})
+        if 'invoice_status' in previous and previous['invoice_status'] != updateTo:
+            deltas = invoice_summary_delta(previous, -1)
+            merge_summary_deltas(deltas, invoice_summary_delta({'invoice_status': updateTo,
+                                                                'amount': previous['amount']}, 1))
+            update_invoice_summary(yearMonth, deltas)
+
         if response['ResponseMetadata']['HTTPStatusCode'] == 200:
 
             responseObject = {}
@@ -231,22 +1231,111 @@ def lambda_handler(event, context):
 
             return responseObject
 
-    if event['httpMethod'] == "GET" and event['path'] == invoicesPath:
+    if event['httpMethod'] == "GET" and event['path'] == invoiceSummaryPath:
+
+        queryParameters = event.get('queryStringParameters') or {}
+
+        # yearmonth is optional, without it every month's totals are returned
+        if queryParameters.get('yearmonth'):
+            summaryItem = summaryTable.get_item(Key={'year_month': queryParameters['yearmonth']}).get('Item')
+            if summaryItem is None:
+                summaryItem = {'year_month': queryParameters['yearmonth']}
+            message = summary_to_json(summaryItem)
+        else:
+            message = []
+            scanArgs = {}
+            while True:
+                page = summaryTable.scan(**scanArgs)
+                message += [summary_to_json(summaryItem) for summaryItem in page['Items']]
+                if 'LastEvaluatedKey' not in page:
+                    break
+                scanArgs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+            message.sort(key=lambda summary: summary['year_month'])
+
+        responseObject = {}
+        responseObject['statusCode'] = '200'
+        responseObject['headers'] = {}
+        responseObject['body'] = json.dumps(message)
+        return responseObject
+
+    if event['httpMethod'] == "GET" and event['path'] == invoiceJobsPath:
 
-        allInvoices = table.scan()
+        try:
+            jobID = event['queryStringParameters']['jobid']
+        except:
+            message = "jobid field not supplied"
 
-        returnQueries = allInvoices['Items']
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
+
+        job = invoiceJobStore.get(jobID)
+
+        if job is None:
+            message = "Supplied job does not exist"
+
+            responseObject = {}
+            responseObject['statusCode'] = '404'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
 
-        # Require as can't return a Decimal type
-        for amount in returnQueries:
-            amount['amount'] = str(amount['amount'])
+        # queued, rendering, done (with s3_key) or failed (with error)
+        message = {}
+        for field in ('job_id', 'job_status', 'client_id', 'year_month', 'created', 'updated', 's3_key', 'error'):
+            if field in job:
+                message[field] = job[field]
 
         responseObject = {}
-        responseObject['statusCode'] = 200
+        responseObject['statusCode'] = '200'
         responseObject['headers'] = {}
-        responseObject['body'] = json.dumps(returnQueries)
+        responseObject['body'] = json.dumps(message)
         return responseObject
 
+    if event['httpMethod'] == "GET" and event['path'] == invoicesPath:
+
+        queryParameters = event.get('queryStringParameters') or {}
+
+        # clientid, yearmonth, status, fields, limit and cursor are all optional
+        try:
+            listOperation, listArgs = build_invoice_listing(queryParameters)
+        except ValueError as error:
+            message = str(error)
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
+
+        writer = ResponseWriter(client_accepts_gzip(event))
+
+        # NDJSON follows the cursor itself and streams every matching invoice,
+        # up to ndjsonMaxBytes. X-Next-Cursor is set if there are more to read.
+        # Pages are read at the full 1MB unless the caller asked for a limit
+        if client_wants_ndjson(event, queryParameters):
+            if 'limit' not in queryParameters:
+                listArgs.pop('Limit')
+            lastEvaluatedKey = write_ndjson_pages(writer, listOperation, listArgs, ndjsonMaxBytes)
+
+            headers = {}
+            if lastEvaluatedKey is not None:
+                headers['X-Next-Cursor'] = encode_cursor(lastEvaluatedKey)
+            return writer.response(200, 'application/x-ndjson', headers)
+
+        allInvoices = listOperation(**listArgs)
+
+        message = {}
+        message['invoices'] = allInvoices['Items']
+        message['cursor'] = None
+        if 'LastEvaluatedKey' in allInvoices:
+            message['cursor'] = encode_cursor(allInvoices['LastEvaluatedKey'])
+
+        writer.write(responseEncoder.encode(message))
+        return writer.response(200, 'application/json')
+
     # Return error if called with correct method or path
     error = {}
     error["Code"] = "1"
@@ -1,18 +1,176 @@
-# Simple authenticator function so token is required to access API's which use it
-def lambda_handler(event, context):
+import hashlib
+import json
+import os
+import re
+import time
+import boto3
+
+# Tokens are looked up by their sha256 so the registry never holds a usable
+# token. Entries come from a json file bundled with the function and/or a
+# DynamoDB table, are loaded once per container and refreshed every
+# registryRefreshSeconds. Each entry looks like
+#   {"token_sha256": "<hex>", "principal": "storefront", "tenant": "lw",
+#    "routes": ["GET /book", "GET /books"], "expires": 1767225600}
+# where routes can be "*" for every route and expires is optional
+registryFile = os.environ.get('TOKEN_REGISTRY_FILE', '')
+registryTable = os.environ.get('TOKEN_REGISTRY_TABLE', '')
+registryRefreshSeconds = int(os.environ.get('TOKEN_REGISTRY_REFRESH_SECONDS', '300'))
+registryRetrySeconds = 30
+
+# The original cetm67_test token is off unless LEGACY_TOKEN_ENABLED is true.
+# LEGACY_TOKEN_ROUTES limits it to a comma separated list of routes
+legacyTokenEnabled = os.environ.get('LEGACY_TOKEN_ENABLED', 'false').lower() == 'true'
+legacyTokenRoutes = [route.strip() for route in os.environ.get('LEGACY_TOKEN_ROUTES', '*').split(',') if route.strip()]
+legacyTokenHash = hashlib.sha256(b'cetm67_test').hexdigest()
 
-    auth = 'Deny'
+# API Gateway caches a decision per token for the authorizer TTL. Every Allow
+# covers all of the principal's routes rather than just the method being
+# called, so a cached decision is right for any route. Keep the TTL below
+# the lifetime of the shortest lived token, a cached Allow outlives expires
+apiArnPrefix = os.environ.get('API_ARN_PREFIX', 'arn:aws:execute-api:us-east-1:645243735875:*/*')
+authorizerCacheTtl = int(os.environ.get('AUTHORIZER_CACHE_TTL', '300'))
+routeMethods = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE', '*')
+tokenHashPattern = re.compile(r'[0-9a-f]{64}')
 
-    if event['authorizationToken'] == 'cetm67_test':
-        auth = 'Allow'
 
+def build_policy(principal, effect, resources, policyContext=None):
     authResponse = {}
-    authResponse['principalId'] = "cetm67_test"
+    authResponse['principalId'] = principal
     authResponse['policyDocument'] = {}
     authResponse['policyDocument']['Version'] = "2012-10-17"
-    authResponse['policyDocument']['Statement'] = {}
-    authResponse['policyDocument']['Statement']['Action'] = "execute-api:Invoke"
-    authResponse['policyDocument']['Statement']['Resource'] = "arn:aws:execute-api:us-east-1:645243735875:*/*/*"
-    authResponse['policyDocument']['Statement']['Effect'] = auth
-
+    authResponse['policyDocument']['Statement'] = [{
+        'Action': "execute-api:Invoke",
+        'Resource': resources,
+        'Effect': effect
+    }]
+    if policyContext:
+        authResponse['context'] = policyContext
     return authResponse
+
+
+# Unknown and expired tokens all get the same Deny
+denyResponse = build_policy('anonymous', 'Deny', [apiArnPrefix + '/*'])
+
+
+# "GET /book" becomes the execute-api arn for that method and path
+def route_resource(route):
+    if route == '*':
+        return apiArnPrefix + '/*'
+
+    method, _, path = route.partition(' ')
+    if method.upper() not in routeMethods or not path.startswith('/'):
+        raise ValueError(f'Invalid route {route}')
+    return f'{apiArnPrefix}/{method.upper()}{path}'
+
+
+# Turn a registry entry into everything needed at decision time, including
+# the finished Allow response, so nothing is built per request
+def compile_entry(entry):
+    tokenHash = str(entry.get('token_sha256', '')).lower()
+    if not tokenHashPattern.fullmatch(tokenHash):
+        raise ValueError('token_sha256 must be a sha256 hex digest')
+    if not entry.get('principal'):
+        raise ValueError('principal is required')
+
+    routes = entry.get('routes') or []
+    if isinstance(routes, str):
+        routes = [routes]
+    if not routes:
+        raise ValueError('At least one route is required')
+    resources = sorted(set(route_resource(route) for route in routes))
+
+    expires = int(entry['expires']) if entry.get('expires') else None
+
+    policyContext = {}
+    policyContext['principal'] = str(entry['principal'])
+    policyContext['tenant'] = str(entry.get('tenant', ''))
+    policyContext['expires'] = expires or 0
+    policyContext['cache_ttl'] = authorizerCacheTtl
+
+    compiled = {}
+    compiled['hash'] = tokenHash
+    compiled['expires'] = expires
+    compiled['allow'] = build_policy(str(entry['principal']), 'Allow', resources, policyContext)
+    return compiled
+
+
+def load_registry_entries():
+    entries = []
+
+    if registryFile:
+        with open(registryFile) as f:
+            entries.extend(json.load(f))
+
+    if registryTable:
+        table = boto3.resource('dynamodb').Table(registryTable)
+        scanArgs = {}
+        while True:
+            page = table.scan(**scanArgs)
+            entries.extend(page['Items'])
+            if 'LastEvaluatedKey' not in page:
+                break
+            scanArgs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+    return entries
+
+
+# The legacy token is added first when it is enabled. A bad entry is logged
+# and left out rather than stopping every other token from working
+def compile_registry(entries):
+    registry = {}
+    if legacyTokenEnabled:
+        entries = [{'token_sha256': legacyTokenHash,
+                    'principal': 'cetm67_test',
+                    'tenant': 'cetm67',
+                    'routes': legacyTokenRoutes}] + list(entries)
+
+    for entry in entries:
+        try:
+            compiled = compile_entry(entry)
+        except (ValueError, TypeError) as error:
+            print(json.dumps({'event': 'token_entry_invalid', 'principal': str(entry.get('principal')),
+                              'error': str(error)}))
+            continue
+        registry[compiled['hash']] = compiled
+
+    return registry
+
+
+registryState = {'registry': None, 'loaded': 0.0}
+
+
+# If the registry can not be loaded the last one is kept. With nothing loaded
+# yet only the legacy token works, if enabled, and loading is tried again shortly
+def current_registry():
+    now = time.monotonic()
+    if registryState['registry'] is not None and now - registryState['loaded'] < registryRefreshSeconds:
+        return registryState['registry']
+
+    try:
+        registryState['registry'] = compile_registry(load_registry_entries())
+        registryState['loaded'] = now
+    except Exception as error:
+        print(json.dumps({'event': 'token_registry_load_failed', 'error': str(error)}))
+        if registryState['registry'] is None:
+            registryState['registry'] = compile_registry([])
+        registryState['loaded'] = now - registryRefreshSeconds + registryRetrySeconds
+
+    return registryState['registry']
+
+
+# Token is required to access API's which use this authorizer. The lookup is
+# a single dict get on the token's hash. Only the hash is ever compared, so
+# how long the lookup takes says nothing about the token itself
+def lambda_handler(event, context):
+
+    token = event.get('authorizationToken') or ''
+    tokenHash = hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    entry = current_registry().get(tokenHash)
+    if entry is None:
+        return denyResponse
+
+    if entry['expires'] is not None and entry['expires'] <= time.time():
+        return denyResponse
+
+    return entry['allow']
@@ -1,20 +1,1086 @@
+import base64
+import hashlib
 import json
+import math
+import re
 import boto3
+import os
+import time
+import zlib
 from botocore.exceptions import ClientError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from boto3.dynamodb.conditions import Key
 from boto3.dynamodb.conditions import Attr
 from datetime import datetime
+from decimal import Decimal
 
 dynamo = boto3.resource("dynamodb")
 table = dynamo.Table("BusinessQueries")
+statsTable = dynamo.Table("BusinessQueryStats")
+searchTable = dynamo.Table("BusinessQuerySearch")
+versionTable = dynamo.Table("CollectionVersions")
+queriesCollection = 'queries'
+queryStatsID = 'query_counts'
+sns_client = boto3.client('sns')
 queryPath = "/query"
+bulkQueryPath = "/query/bulk"
 countQueriesPath = "/countqueries"
 allQueriesPath = "/allqueries"
 retreieveOldestPath = "/retrieveoldest"
+searchPath = "/search"
+
+# NDJSON bodies stop at about 5MB once encoded, under the 6MB lambda response
+# limit with room for the headers
+ndjsonMaxBytes = int(os.environ.get('NDJSON_MAX_BYTES', str(5 * 1024 * 1024)))
+
+# Listing settings. email-index is keyed on email_address and date_added
+emailIndex = 'email-index'
+listDefaultLimit = 100
+listMaxLimit = 1000
+queryAttributes = ('query_id', 'date_added', 'forename', 'surname', 'phone_number', 'email_address',
+                   'message', 'answered')
+datePattern = re.compile(r'[0-9]{1,14}')
+
+# Unanswered queries carry outstanding='Y' so they, and only they, appear in
+# this sparse index sorted by date_added
+outstandingIndex = 'outstanding-index'
+oldestFields = ('query_id', 'date_added', 'forename', 'surname', 'phone_number', 'email_address', 'message')
+retrieveMaxLimit = 100
+retrievePageBudget = 10
+claimDefaultLease = 900
+claimMaxLease = 3600
+
+# New query emails to staff. The default queue mode publishes from the SQS
+# consumer instead of during POST /query, sync publishes straight away and
+# local keeps everything in memory for tests. With digest on, each SQS batch
+# becomes one email, the batching window on the event source sets how often
+notificationTopicArn = os.environ.get('QUERY_NOTIFICATION_TOPIC', 'arn:aws:sns:us-east-1:645243735875:QueryNotificaton')
+notificationMode = os.environ.get('QUERY_NOTIFICATION_MODE', 'queue')
+notificationQueueUrl = os.environ.get('QUERY_NOTIFICATION_QUEUE_URL', '')
+notificationDigest = os.environ.get('QUERY_NOTIFICATION_DIGEST', 'false').lower() == 'true'
+digestMaxQueries = 50
+
+# Bulk answer/unanswer settings. Atomic requests are written in transactions
+# of up to 99 queries, leaving room for the counters update
+bulkMaxQueries = 500
+bulkMaxConcurrency = int(os.environ.get('BULK_MAX_CONCURRENCY', '8'))
+atomicChunkSize = 99
+atomicAttempts = 3
+transactAttempts = 4
+
+# Search index settings. BusinessQuerySearch holds one item per term and query
+# (term, query_id, tf) where tf is the weighted number of times the term is used,
+# and one item per term (term, '#', df) counting the queries that use it.
+# Posting lists longer than searchMaxPostings are not read, the top
+# searchMaxRescore candidates are looked up in them instead
+searchFieldWeights = {'message': 1, 'forename': 2, 'surname': 2, 'email_address': 2}
+searchStopWords = frozenset(('a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'have',
+                             'i', 'in', 'is', 'it', 'my', 'of', 'on', 'or', 'the', 'this', 'to', 'was', 'with'))
+searchTermPattern = re.compile(r'[a-z0-9]+')
+searchMaxTerms = 10
+searchMaxPostings = 2000
+searchMaxRescore = 300
+searchCountID = '#'
+searchDefaultLimit = 20
+searchMaxLimit = 100
+
+
+# Any number attributes come back from DynamoDB as Decimal, which json can
+# not encode on its own, so they are written out as strings
+class ResponseEncoder(json.JSONEncoder):
+
+    def default(self, value):
+        if isinstance(value, Decimal):
+            return str(value)
+        return super().default(value)
+
+
+responseEncoder = ResponseEncoder()
+
+
+# gzip is used when the client lists it in Accept-Encoding without q=0
+def client_accepts_gzip(event):
+    headers = event.get('headers') or {}
+    for name, value in headers.items():
+        if name.lower() != 'accept-encoding' or not value:
+            continue
+        for encoding in value.split(','):
+            encodingName, _, parameters = encoding.strip().partition(';')
+            if encodingName.strip().lower() in ('gzip', '*') and parameters.replace(' ', '') != 'q=0':
+                return True
+    return False
+
+
+# NDJSON is picked with format=ndjson or an Accept header asking for it
+def client_wants_ndjson(event, queryParameters):
+    if queryParameters.get('format', '').lower() == 'ndjson':
+        return True
+    headers = event.get('headers') or {}
+    return any(name.lower() == 'accept' and 'application/x-ndjson' in (value or '')
+               for name, value in headers.items())
+
+
+# Builds the body piece by piece, compressing each piece straight away
+# when gzip is in use
+class ResponseWriter:
+
+    def __init__(self, useGzip):
+        self.useGzip = useGzip
+        self.parts = []
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if useGzip else None
+        self.size = 0
+
+    # size tracks what the body adds to the lambda response, where plain text
+    # is json escaped and gzip is base64 encoded. Returns False, writing
+    # nothing, if the text would take the body over maxSize. The text is
+    # compressed on a copy of the compressor so a refused write leaves the
+    # stream as it was
+    def write(self, text, maxSize=None):
+        if self.useGzip:
+            compressor = self.compressor.copy()
+            part = compressor.compress(text.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            partSize = (len(part) + 2) // 3 * 4
+        else:
+            part = text
+            partSize = len(text.encode('utf-8')) + text.count('"') + text.count('\\') + text.count('\n')
+
+        if maxSize is not None and self.size + partSize > maxSize:
+            return False
+
+        if self.useGzip:
+            self.compressor = compressor
+        self.parts.append(part)
+        self.size += partSize
+        return True
+
+    # Build the API Gateway response. Binary media types must be enabled on
+    # the API for the base64 gzip body to be decoded before it is sent
+    def response(self, statusCode, contentType, headers=None):
+        responseObject = {}
+        responseObject['statusCode'] = statusCode
+        responseObject['headers'] = dict(headers or {})
+        responseObject['headers']['Content-Type'] = contentType
+
+        if self.useGzip:
+            self.parts.append(self.compressor.flush())
+            responseObject['headers']['Content-Encoding'] = 'gzip'
+            responseObject['isBase64Encoded'] = True
+            responseObject['body'] = base64.b64encode(b''.join(self.parts)).decode('ascii')
+        else:
+            responseObject['body'] = ''.join(self.parts)
+
+        return responseObject
+
+
+# Opaque cursor made from the LastEvaluatedKey of a page
+def encode_cursor(lastEvaluatedKey):
+    return base64.urlsafe_b64encode(json.dumps(lastEvaluatedKey).encode('utf-8')).decode('ascii')
+
+
+# Index pages also carry the index keys, outstanding included
+def decode_cursor(cursor):
+    try:
+        lastEvaluatedKey = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError:
+        raise ValueError('Invalid cursor supplied')
+    if (not isinstance(lastEvaluatedKey, dict)
+            or not all((name in queryAttributes or name == 'outstanding') and isinstance(value, str)
+                       for name, value in lastEvaluatedKey.items())):
+        raise ValueError('Invalid cursor supplied')
+    return lastEvaluatedKey
+
+
+# from and to can be a whole date_added or just the start of one, 2022 or
+# 202210 for example, and both ends are included
+def read_date_range(queryParameters):
+    fromDate = queryParameters.get('from')
+    toDate = queryParameters.get('to')
+    for date in (fromDate, toDate):
+        if date is not None and not datePattern.fullmatch(date):
+            raise ValueError('from and to must be dates in the form YYYYMMDDHHMMSS or the start of one')
+
+    if toDate is not None:
+        toDate = toDate.ljust(14, '9')
+    return fromDate, toDate
+
+
+def date_condition(condition, fromDate, toDate):
+    if fromDate is not None and toDate is not None:
+        return condition('date_added').between(fromDate, toDate)
+    if fromDate is not None:
+        return condition('date_added').gte(fromDate)
+    if toDate is not None:
+        return condition('date_added').lte(toDate)
+    return None
+
+
+# Work out the cheapest read for the filters supplied. An email uses
+# email-index and unanswered queries use outstanding-index, both sorted by
+# date_added so a date range narrows the key condition. Answered queries and
+# no filters at all have to fall back to a scan
+def build_query_listing(queryParameters):
+    email = queryParameters.get('email')
+    answered = queryParameters.get('answered')
+    if answered is not None:
+        if answered.upper() not in ('TRUE', 'FALSE'):
+            raise ValueError('answered must be true or false')
+        answered = answered.upper() == 'TRUE'
+    fromDate, toDate = read_date_range(queryParameters)
+
+    try:
+        limit = int(queryParameters.get('limit', listDefaultLimit))
+    except ValueError:
+        limit = 0
+    if limit < 1 or limit > listMaxLimit:
+        raise ValueError(f'limit must be between 1 and {listMaxLimit}')
+
+    listArgs = {'Limit': limit}
+
+    if queryParameters.get('cursor'):
+        listArgs['ExclusiveStartKey'] = decode_cursor(queryParameters['cursor'])
+
+    # fields is a comma separated list of the attributes to return
+    if queryParameters.get('fields'):
+        fields = [field.strip() for field in queryParameters['fields'].split(',') if field.strip()]
+        unknownFields = [field for field in fields if field not in queryAttributes]
+        if unknownFields or not fields:
+            raise ValueError(f"fields can only contain {', '.join(queryAttributes)}")
+        listArgs['ProjectionExpression'] = ', '.join(f'#p{number}' for number in range(len(fields)))
+        listArgs['ExpressionAttributeNames'] = {f'#p{number}': field for number, field in enumerate(fields)}
+
+    dateKeyCondition = date_condition(Key, fromDate, toDate)
+
+    if email:
+        keyCondition = Key('email_address').eq(email)
+        if dateKeyCondition is not None:
+            keyCondition = keyCondition & dateKeyCondition
+        listArgs['IndexName'] = emailIndex
+        listArgs['KeyConditionExpression'] = keyCondition
+        if answered is not None:
+            listArgs['FilterExpression'] = Attr('answered').eq(answered)
+        return table.query, listArgs
+
+    if answered is False:
+        keyCondition = Key('outstanding').eq('Y')
+        if dateKeyCondition is not None:
+            keyCondition = keyCondition & dateKeyCondition
+        listArgs['IndexName'] = outstandingIndex
+        listArgs['KeyConditionExpression'] = keyCondition
+        return table.query, listArgs
+
+    filterExpression = date_condition(Attr, fromDate, toDate)
+    if answered is True:
+        answeredFilter = Attr('answered').eq(True)
+        filterExpression = answeredFilter if filterExpression is None else filterExpression & answeredFilter
+    if filterExpression is not None:
+        listArgs['FilterExpression'] = filterExpression
+    return table.scan, listArgs
+
+
+# Write items one per line while following LastEvaluatedKey, so each page is
+# serialised and released before the next is read. A page that would take the
+# body over maxBytes is left for the next request, so the key it was read from
+# is returned to carry on from. The first page is always written
+def write_ndjson_pages(writer, listOperation, listArgs, maxBytes):
+    listArgs = dict(listArgs)
+    firstPage = True
+
+    while True:
+        page = listOperation(**listArgs)
+        lines = ''.join(responseEncoder.encode(item) + '\n' for item in page['Items'])
+        if not writer.write(lines, None if firstPage else maxBytes):
+            return listArgs['ExclusiveStartKey']
+        firstPage = False
+
+        if 'LastEvaluatedKey' not in page:
+            return None
+        listArgs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+# Transactions go through the resource's own client, which converts plain
+# python values the same way the Table calls do. Every write also moves the
+# shared counters item, so a transaction cancelled only by TransactionConflict
+# is tried again after a short wait. Condition failures are left to the caller
+def transact_write(transactItems):
+    for attempt in range(transactAttempts):
+        try:
+            return dynamo.meta.client.transact_write_items(TransactItems=transactItems)
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'TransactionCanceledException' or attempt == transactAttempts - 1:
+                raise
+            reasons = [reason.get('Code') for reason in error.response.get('CancellationReasons', [])]
+            if 'TransactionConflict' not in reasons or 'ConditionalCheckFailed' in reasons:
+                raise
+        time.sleep(0.05 * 2 ** attempt)
+
+
+# The stats item change that goes in the same transaction as a query write,
+# answered and outstanding are moved by the given amounts. It only applies to
+# an item that already exists, ADD on a missing item would count from zero
+# and leave out every query saved before it
+def query_stats_update(answeredDelta, outstandingDelta):
+    statsUpdate = {}
+    statsUpdate['TableName'] = statsTable.name
+    statsUpdate['Key'] = {'stat_id': queryStatsID}
+    statsUpdate['UpdateExpression'] = "ADD answered :answered, outstanding :outstanding"
+    statsUpdate['ConditionExpression'] = "attribute_exists(stat_id)"
+    statsUpdate['ExpressionAttributeValues'] = {':answered': answeredDelta, ':outstanding': outstandingDelta}
+    return {'Update': statsUpdate}
+
+
+# Run a transaction whose last item is query_stats_update. If only the stats
+# item failed its condition it has not been made yet, so it is counted from
+# the table and the transaction tried again. No counted write can succeed
+# while the item is missing, so that count already has everything in it
+def transact_counted(transactItems):
+    try:
+        return transact_write(transactItems)
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'TransactionCanceledException':
+            raise
+        failed = failed_conditions(error)
+        if failed[-1:] != [True] or any(failed[:-1]):
+            raise
+
+    recount_queries(onlyIfMissing=True)
+    return transact_write(transactItems)
+
+
+# Called after every change to the queries. The version item is written by
+# every change, so it is kept out of the transactions where it would cancel
+# them with TransactionConflict. A failure is logged rather than failing a
+# change that has already been made, listings can then be answered with 304
+# until the next change
+def bump_query_version():
+    try:
+        versionTable.update_item(Key={'collection': queriesCollection},
+                                 UpdateExpression="ADD version :one",
+                                 ExpressionAttributeValues={':one': 1})
+    except ClientError as error:
+        print(json.dumps({'event': 'query_version_failed', 'error': str(error)}))
+
+
+def read_query_version():
+    versionItem = versionTable.get_item(Key={'collection': queriesCollection}).get('Item', {})
+    return int(versionItem.get('version', 0))
+
+
+# Strong ETag for one listing request. gzip and NDJSON bodies differ from the
+# plain json of the same page so they are part of the tag
+def request_etag(version, event, variant):
+    queryParameters = event.get('queryStringParameters') or {}
+    representation = json.dumps([queriesCollection, version, event['path'], sorted(queryParameters.items()), variant])
+    return '"' + hashlib.sha256(representation.encode('utf-8')).hexdigest()[:32] + '"'
+
+
+def etag_matches(event, etag):
+    headers = event.get('headers') or {}
+    for name, value in headers.items():
+        if name.lower() == 'if-none-match' and value:
+            tags = [tag.strip() for tag in value.split(',')]
+            return '*' in tags or any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+    return False
+
+
+# Which items in a cancelled transaction failed their condition check
+def failed_conditions(error):
+    return [reason.get('Code') == 'ConditionalCheckFailed'
+            for reason in error.response.get('CancellationReasons', [])]
+
+
+# The change to one query's answered flag as a transaction item. Answered
+# queries leave outstanding-index and drop any claim on them
+def answered_update(queryID, updateTo, condition, conditionValues):
+    queryUpdate = {}
+    queryUpdate['TableName'] = table.name
+    queryUpdate['Key'] = {'query_id': queryID}
+    queryUpdate['ConditionExpression'] = condition
+    if updateTo:
+        queryUpdate['UpdateExpression'] = "set answered=:bool REMOVE outstanding, claimed_by, claim_expires"
+        queryUpdate['ExpressionAttributeValues'] = {':bool': updateTo, **conditionValues}
+    else:
+        queryUpdate['UpdateExpression'] = "set answered=:bool, outstanding=:outstanding"
+        queryUpdate['ExpressionAttributeValues'] = {':bool': updateTo, ':outstanding': 'Y', **conditionValues}
+    return {'Update': queryUpdate}
+
+
+# Set answered on one query and move the counters with it. Only writes when
+# the query exists and the status actually changes, so nothing is counted
+# twice. Returns updated, unchanged or not_found. Uses the client throughout
+# so it can be called from several threads
+def set_query_answered(queryID, updateTo):
+    try:
+        transact_counted([
+            answered_update(queryID, updateTo, "attribute_exists(query_id) AND answered <> :bool", {}),
+            query_stats_update(1 if updateTo else -1, -1 if updateTo else 1)
+        ])
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'TransactionCanceledException' or failed_conditions(error)[:1] != [True]:
+            raise
+
+        # The condition fails both when the query is missing and when it
+        # already has this status, only the first is an error
+        existing = dynamo.meta.client.get_item(TableName=table.name,
+                                               Key={'query_id': queryID},
+                                               ProjectionExpression='query_id')
+        return 'unchanged' if 'Item' in existing else 'not_found'
+
+    bump_query_version()
+    return 'updated'
+
+
+# Set answered on one query without touching the counters. Bulk requests use
+# this so the shared counters item is written once per request rather than
+# once per query, where concurrent writes to it would conflict
+def update_query_answered(queryID, updateTo):
+    queryUpdate = answered_update(queryID, updateTo, "attribute_exists(query_id) AND answered <> :bool", {})['Update']
+    try:
+        dynamo.meta.client.update_item(**queryUpdate)
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        existing = dynamo.meta.client.get_item(TableName=table.name,
+                                               Key={'query_id': queryID},
+                                               ProjectionExpression='query_id')
+        return 'unchanged' if 'Item' in existing else 'not_found'
+
+    return 'updated'
+
+
+# Move the counters by the total change of a bulk request, trying again if a
+# transaction on the same item is in progress
+def add_query_counts(answeredDelta, outstandingDelta):
+    for attempt in range(transactAttempts):
+        try:
+            statsTable.update_item(Key={'stat_id': queryStatsID},
+                                   UpdateExpression="ADD answered :answered, outstanding :outstanding",
+                                   ExpressionAttributeValues={':answered': answeredDelta,
+                                                              ':outstanding': outstandingDelta})
+            return
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'TransactionConflictException' or attempt == transactAttempts - 1:
+                raise
+        time.sleep(0.05 * 2 ** attempt)
+
+
+# Queries are updated a few at a time and the counters are moved once at the
+# end. If that last write fails the counters are out until recount_queries.
+# The stats item is made before any query changes so the count it starts from
+# does not already include this request
+def set_queries_answered(queryIDs, updateTo):
+    if 'Item' not in statsTable.get_item(Key={'stat_id': queryStatsID}, ProjectionExpression='stat_id'):
+        recount_queries(onlyIfMissing=True)
+
+    def set_one(queryID):
+        try:
+            return update_query_answered(queryID, updateTo)
+        except ClientError as error:
+            print(json.dumps({'event': 'bulk_query_update_failed', 'query_id': queryID, 'error': str(error)}))
+            return 'failed'
+
+    with ThreadPoolExecutor(max_workers=bulkMaxConcurrency) as executor:
+        outcomes = dict(zip(queryIDs, executor.map(set_one, queryIDs)))
+
+    updated = sum(1 for outcome in outcomes.values() if outcome == 'updated')
+    if updated:
+        delta = updated if updateTo else -updated
+        try:
+            add_query_counts(delta, -delta)
+        except ClientError as error:
+            print(json.dumps({'event': 'query_counts_failed', 'answered': delta, 'outstanding': -delta,
+                              'error': str(error)}))
+        bump_query_version()
+
+    return outcomes
+
+
+# Current answered flag of each query that exists
+def get_answered_states(queryIDs):
+    requestItems = {table.name: {'Keys': [{'query_id': queryID} for queryID in queryIDs],
+                                 'ProjectionExpression': 'query_id, answered'}}
+    states = {}
+
+    while requestItems:
+        response = dynamo.meta.client.batch_get_item(RequestItems=requestItems)
+        for query in response['Responses'].get(table.name, []):
+            states[query['query_id']] = query.get('answered', False)
+        requestItems = response.get('UnprocessedKeys') or {}
+        if requestItems:
+            time.sleep(0.05)
+
+    return states
+
+
+# All or nothing for each chunk of queries. The current states are read first
+# and every write is conditional on them, so if anything changes in between
+# the transaction is cancelled and the chunk is read and tried again
+def set_queries_answered_atomic(queryIDs, updateTo):
+    outcomes = {}
+
+    for start in range(0, len(queryIDs), atomicChunkSize):
+        chunk = queryIDs[start:start + atomicChunkSize]
+
+        for _ in range(atomicAttempts):
+            states = get_answered_states(chunk)
+
+            # A missing query stops the whole chunk, as the single PATCH would
+            if len(states) < len(chunk):
+                for queryID in chunk:
+                    outcomes[queryID] = 'not_applied' if queryID in states else 'not_found'
+                break
+
+            changed = [queryID for queryID in chunk if states[queryID] != updateTo]
+            if not changed:
+                for queryID in chunk:
+                    outcomes[queryID] = 'unchanged'
+                break
+
+            transactItems = []
+            for queryID in chunk:
+                if queryID in changed:
+                    transactItems.append(answered_update(queryID, updateTo,
+                                                         "attribute_exists(query_id) AND answered = :current",
+                                                         {':current': states[queryID]}))
+                else:
+                    queryCheck = {}
+                    queryCheck['TableName'] = table.name
+                    queryCheck['Key'] = {'query_id': queryID}
+                    queryCheck['ConditionExpression'] = "answered = :bool"
+                    queryCheck['ExpressionAttributeValues'] = {':bool': updateTo}
+                    transactItems.append({'ConditionCheck': queryCheck})
+            delta = len(changed) if updateTo else -len(changed)
+            transactItems.append(query_stats_update(delta, -delta))
+
+            try:
+                transact_counted(transactItems)
+            except ClientError as error:
+                if (error.response['Error']['Code'] != 'TransactionCanceledException'
+                        or not any(failed_conditions(error))):
+                    raise
+                continue
+
+            for queryID in chunk:
+                outcomes[queryID] = 'updated' if queryID in changed else 'unchanged'
+            break
+        else:
+            for queryID in chunk:
+                outcomes[queryID] = 'conflict'
+
+    if 'updated' in outcomes.values():
+        bump_query_version()
+    return outcomes
+
+
+# Rebuild the counters from the table itself. Pages through the whole table
+# so this is for an admin repair or the first call, not every request. Any
+# writes made while it runs can be lost so run it when the table is quiet.
+# With onlyIfMissing the counts are only saved if the stats item has not been
+# made yet, as a first write and a first GET can both get here
+def recount_queries(onlyIfMissing=False):
+    counts = {'answered': 0, 'outstanding': 0}
+    scanArgs = {'ProjectionExpression': 'answered'}
+
+    while True:
+        page = table.scan(**scanArgs)
+        for query in page['Items']:
+            if query.get('answered') is True:
+                counts['answered'] += 1
+            else:
+                counts['outstanding'] += 1
+
+        if 'LastEvaluatedKey' not in page:
+            break
+        scanArgs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+    putArgs = {}
+    putArgs['Item'] = {
+        'stat_id': queryStatsID,
+        'answered': counts['answered'],
+        'outstanding': counts['outstanding'],
+        'recounted': datetime.now().strftime("%Y%m%d%H%M%S")
+    }
+    if onlyIfMissing:
+        putArgs['ConditionExpression'] = "attribute_not_exists(stat_id)"
+
+    try:
+        statsTable.put_item(**putArgs)
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+    return counts
+
+
+# Lower case words of two or more characters without the stop words. Email
+# addresses are also kept whole so an exact address can be searched for
+def search_terms(text):
+    terms = [term for term in searchTermPattern.findall(text.lower())
+             if len(term) > 1 and term not in searchStopWords]
+    terms.extend(word for word in text.lower().split() if '@' in word)
+    return terms
+
+
+def query_term_frequencies(query):
+    frequencies = {}
+    for field, weight in searchFieldWeights.items():
+        for term in search_terms(str(query.get(field, ''))):
+            frequencies[term] = frequencies.get(term, 0) + weight
+    return frequencies
+
+
+# Write a query's postings and return the terms it uses
+def write_postings(query, writer):
+    frequencies = query_term_frequencies(query)
+    for term, frequency in frequencies.items():
+        writer.put_item(Item={'term': term, 'query_id': query['query_id'], 'tf': frequency})
+    return list(frequencies)
+
+
+# Write one posting and count it in the term's document frequency in the
+# same transaction. The posting is only written if it is not there already,
+# so indexing a query again changes nothing. Uses the client so it can be
+# called from several threads
+def index_search_term(queryID, term, frequency):
+    postingPut = {}
+    postingPut['TableName'] = searchTable.name
+    postingPut['Item'] = {'term': term, 'query_id': queryID, 'tf': frequency}
+    postingPut['ConditionExpression'] = "attribute_not_exists(query_id)"
+
+    termCount = {}
+    termCount['TableName'] = searchTable.name
+    termCount['Key'] = {'term': term, 'query_id': searchCountID}
+    termCount['UpdateExpression'] = "ADD df :one"
+    termCount['ExpressionAttributeValues'] = {':one': 1}
+
+    try:
+        transact_write([{'Put': postingPut}, {'Update': termCount}])
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'TransactionCanceledException' or failed_conditions(error)[:1] != [True]:
+            raise
+
+
+# Index a new query. Called from the notification consumer rather than POST
+# /query, and safe to repeat when a failed message is retried
+def index_query(query):
+    frequencies = query_term_frequencies(query)
+    with ThreadPoolExecutor(max_workers=bulkMaxConcurrency) as executor:
+        list(executor.map(lambda term: index_search_term(query['query_id'], term, frequencies[term]), frequencies))
+
+
+# Batch get from the search index, 100 keys to a call
+def get_search_items(keys):
+    items = []
+    for start in range(0, len(keys), 100):
+        requestItems = {searchTable.name: {'Keys': keys[start:start + 100]}}
+        while requestItems:
+            response = dynamo.batch_get_item(RequestItems=requestItems)
+            items.extend(response['Responses'].get(searchTable.name, []))
+            requestItems = response.get('UnprocessedKeys') or {}
+            if requestItems:
+                time.sleep(0.05)
+    return items
+
+
+# Read up to maxPostings of a term's posting list in query_id order. Also
+# returns whether the list went on past that
+def read_postings(term, maxPostings):
+    postings = []
+    queryArgs = {'KeyConditionExpression': Key('term').eq(term),
+                 'ProjectionExpression': 'query_id, tf',
+                 'Limit': maxPostings + 1}
+    while True:
+        page = searchTable.query(**queryArgs)
+        postings.extend(posting for posting in page['Items'] if posting['query_id'] != searchCountID)
+        if 'LastEvaluatedKey' not in page:
+            return postings, False
+        if len(postings) >= maxPostings:
+            return postings, True
+        queryArgs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def add_term_scores(scores, postings, inverseFrequency):
+    for posting in postings:
+        scores[posting['query_id']] = scores.get(posting['query_id'], 0) + float(posting['tf']) * inverseFrequency
+
+
+# Rank queries against the search terms with tf-idf, reading only the index.
+# idf comes from each term's stored count and the query count from the
+# counters item. Terms are read rarest first. Every query using a term with a
+# short enough posting list is scored in full. Common terms only add to the
+# top candidates found so far, or if every term is common, to the start of
+# the rarest one's list. Returns the ranking and whether it was cut short
+def search_queries(text):
+    terms = list(dict.fromkeys(search_terms(text)))[:searchMaxTerms]
+
+    stats = statsTable.get_item(Key={'stat_id': queryStatsID}).get('Item', {})
+    totalQueries = max(int(stats.get('answered', 0)) + int(stats.get('outstanding', 0)), 1)
+
+    # Terms indexed before the counts were kept have none until the index is
+    # rebuilt, their posting list is read and counted instead
+    termCounts = {item['term']: int(item['df'])
+                  for item in get_search_items([{'term': term, 'query_id': searchCountID} for term in terms])}
+
+    scores = {}
+    truncated = False
+    commonTerms = []
+    for term in sorted(terms, key=lambda term: termCounts.get(term, 0)):
+        if termCounts.get(term, 0) > searchMaxPostings:
+            commonTerms.append(term)
+            continue
+
+        postings, partial = read_postings(term, searchMaxPostings)
+        truncated = truncated or (partial and term not in termCounts)
+        if postings:
+            termCount = termCounts.get(term, len(postings))
+            add_term_scores(scores, postings, math.log(1 + totalQueries / termCount))
+
+    if commonTerms:
+        truncated = True
+        if not scores:
+            term = commonTerms.pop(0)
+            postings, _ = read_postings(term, searchMaxPostings)
+            add_term_scores(scores, postings, math.log(1 + totalQueries / termCounts[term]))
+
+        candidates = [queryID for queryID, _ in sorted(scores.items(), key=lambda score: -score[1])[:searchMaxRescore]]
+        for term in commonTerms:
+            postings = get_search_items([{'term': term, 'query_id': queryID} for queryID in candidates])
+            add_term_scores(scores, postings, math.log(1 + totalQueries / termCounts[term]))
+
+    return sorted(scores.items(), key=lambda score: (-score[1], score[0])), truncated
+
+
+# Fetch the full queries for one page of results, keeping the ranked order
+def get_queries(queryIDs):
+    if not queryIDs:
+        return []
+
+    requestItems = {table.name: {'Keys': [{'query_id': queryID} for queryID in queryIDs]}}
+    queries = {}
+
+    while requestItems:
+        response = dynamo.batch_get_item(RequestItems=requestItems)
+        for query in response['Responses'].get(table.name, []):
+            queries[query['query_id']] = query
+        requestItems = response.get('UnprocessedKeys') or {}
+        if requestItems:
+            time.sleep(0.05)
+
+    return [queries[queryID] for queryID in queryIDs if queryID in queries]
+
+
+# Search cursors carry the position in the ranked results
+def decode_search_cursor(cursor):
+    try:
+        searchPosition = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        offset = int(searchPosition['offset'])
+    except (ValueError, TypeError, KeyError):
+        raise ValueError('Invalid cursor supplied')
+    if offset < 0:
+        raise ValueError('Invalid cursor supplied')
+    return offset
+
+
+# Index every query in the table, for queries written before search existed,
+# and set every term count from what was indexed. Queries added while it runs
+# can be missed from the counts so run it when the table is quiet
+def rebuild_search_index():
+    scanArgs = {'ProjectionExpression': ', '.join(['query_id'] + list(searchFieldWeights))}
+    indexed = 0
+    termCounts = {}
+
+    with searchTable.batch_writer(overwrite_by_pkeys=['term', 'query_id']) as writer:
+        while True:
+            page = table.scan(**scanArgs)
+            for query in page['Items']:
+                for term in write_postings(query, writer):
+                    termCounts[term] = termCounts.get(term, 0) + 1
+            indexed += len(page['Items'])
+
+            if 'LastEvaluatedKey' not in page:
+                break
+            scanArgs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+        for term, termCount in termCounts.items():
+            writer.put_item(Item={'term': term, 'query_id': searchCountID, 'df': termCount})
+
+    return {'indexed': indexed, 'terms': len(termCounts)}
+
+
+# Reserve a query for one member of staff until the lease runs out. Only
+# succeeds if the query is still outstanding and no unexpired claim exists
+def claim_query(queryID, staff, leaseSeconds):
+    now = int(time.time())
+    try:
+        claimed = table.update_item(
+            Key={'query_id': queryID},
+            ConditionExpression=(Attr('outstanding').eq('Y')
+                                 & (Attr('claim_expires').not_exists() | Attr('claim_expires').lt(now))),
+            UpdateExpression="set claimed_by=:staff, claim_expires=:expires",
+            ExpressionAttributeValues={':staff': staff, ':expires': now + leaseSeconds},
+            ReturnValues='ALL_NEW'
+            )
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise
+    return claimed['Attributes']
+
+
+# Oldest outstanding queries first, read from the index so the cost depends on
+# how many are asked for rather than the size of the table. When staff is
+# given each one is claimed and queries someone else holds are skipped
+def retrieve_oldest(limit, staff, leaseSeconds):
+    queryArgs = {}
+    queryArgs['IndexName'] = outstandingIndex
+    queryArgs['KeyConditionExpression'] = Key('outstanding').eq('Y')
+    queryArgs['ScanIndexForward'] = True
+    queryArgs['Limit'] = limit
+    if staff:
+        queryArgs['FilterExpression'] = Attr('claim_expires').not_exists() | Attr('claim_expires').lt(int(time.time()))
+
+    oldestQueries = []
+    for _ in range(retrievePageBudget):
+        page = table.query(**queryArgs)
+
+        for query in page['Items']:
+            if staff:
+                query = claim_query(query['query_id'], staff, leaseSeconds)
+                if query is None:
+                    continue
+
+            oldestQuery = {field: query[field] for field in oldestFields if field in query}
+            if staff:
+                oldestQuery['claimed_by'] = query['claimed_by']
+                oldestQuery['claim_expires'] = query['claim_expires']
+            oldestQueries.append(oldestQuery)
+
+            if len(oldestQueries) == limit:
+                return oldestQueries
+
+        if 'LastEvaluatedKey' not in page:
+            break
+        queryArgs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+    return oldestQueries
+
+
+# Set outstanding on unanswered queries written before the index existed
+def backfill_outstanding_index():
+    scanArgs = {}
+    scanArgs['FilterExpression'] = Attr('answered').eq(False) & Attr('outstanding').not_exists()
+    scanArgs['ProjectionExpression'] = 'query_id'
+    updated = 0
+
+    while True:
+        page = table.scan(**scanArgs)
+        for query in page['Items']:
+            try:
+                table.update_item(
+                    Key={'query_id': query['query_id']},
+                    ConditionExpression=Attr('answered').eq(False),
+                    UpdateExpression="set outstanding=:outstanding",
+                    ExpressionAttributeValues={':outstanding': 'Y'}
+                    )
+                updated += 1
+            except ClientError as error:
+                if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+
+        if 'LastEvaluatedKey' not in page:
+            break
+        scanArgs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+    if updated:
+        bump_query_version()
+    return {'updated': updated}
+
+
+# Publishes to the staff topic with the shared client
+class SnsNotificationSink:
+
+    def __init__(self, topicArn):
+        self.topicArn = topicArn
+
+    def publish(self, subject, message):
+        sns_client.publish(TopicArn=self.topicArn,
+                           Message=message,
+                           Subject=subject)
+
+
+# Keeps published emails in memory so tests can check what would be sent
+class LocalNotificationSink:
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, subject, message):
+        self.published.append({'subject': subject, 'message': message})
+
+
+class SqsNotificationQueue:
+
+    def __init__(self, queueUrl):
+        self.queueUrl = queueUrl
+        self.sqs_client = boto3.client('sqs')
+
+    def send(self, notification):
+        self.sqs_client.send_message(QueueUrl=self.queueUrl,
+                                     MessageBody=json.dumps(notification))
+
+
+# Sync mode, indexes and sends as soon as the notification is made
+class DirectNotificationQueue:
+
+    def send(self, notification):
+        process_new_queries([notification], False)
+
+
+# In-process stand in for the SQS queue. Nothing is sent until drain is called
+class LocalNotificationQueue:
+
+    def __init__(self):
+        self.pending = deque()
+
+    def send(self, notification):
+        self.pending.append(notification)
+
+    def drain(self, digest=False):
+        notifications = list(self.pending)
+        self.pending.clear()
+        return process_new_queries(notifications, digest)
+
+
+def create_notification_backend(mode):
+    if mode == 'local':
+        return LocalNotificationSink(), LocalNotificationQueue()
+    if mode == 'sync':
+        return SnsNotificationSink(notificationTopicArn), DirectNotificationQueue()
+    return SnsNotificationSink(notificationTopicArn), SqsNotificationQueue(notificationQueueUrl)
+
+
+notificationSink, notificationQueue = create_notification_backend(notificationMode)
+
+
+# Carries every field the search index uses, so the consumer can index the
+# query without reading it back
+def build_query_notification(queryID, forename, surname, contactEmail, message):
+    notification = {}
+    notification['query_id'] = queryID
+    notification['forename'] = forename
+    notification['surname'] = surname
+    notification['email_address'] = contactEmail
+    notification['message'] = message
+    notification['queued_at'] = int(time.time() * 1000)
+    return notification
+
+
+# Turn notifications into emails, one each or a single digest, and log how
+# many went out and how long the oldest waited. Returns the query ids whose
+# email could not be published
+def dispatch_notifications(notifications, digest):
+    if not notifications:
+        return []
+
+    if digest and len(notifications) > 1:
+        subject = f"{len(notifications)} new queries"
+        lines = [f"{notification['query_id']} from {notification['forename']} {notification['surname']}\n"
+                 f"{notification['message']}"
+                 for notification in notifications[:digestMaxQueries]]
+        if len(notifications) > digestMaxQueries:
+            lines.append(f"...and {len(notifications) - digestMaxQueries} more")
+        emails = [(subject, "\n\n".join(lines), [notification['query_id'] for notification in notifications])]
+    else:
+        emails = [("New query - " + notification['query_id'],
+                   "New query recieved from " + notification['forename'] + " " + notification['surname'] + "\n"
+                   + notification['message'],
+                   [notification['query_id']])
+                  for notification in notifications]
+
+    failedQueries = []
+    for subject, message, queryIDs in emails:
+        try:
+            notificationSink.publish(subject, message)
+        except ClientError as error:
+            print(json.dumps({'event': 'query_notification_failed', 'query_ids': queryIDs, 'error': str(error)}))
+            failedQueries.extend(queryIDs)
+
+    now = int(time.time() * 1000)
+    print(json.dumps({'event': 'query_notifications_sent',
+                      'queries': len(notifications),
+                      'emails': len(emails),
+                      'failed': len(failedQueries),
+                      'digest': digest and len(notifications) > 1,
+                      'max_delay_ms': max(now - notification.get('queued_at', now) for notification in notifications)}))
+    return failedQueries
+
+
+# Index each new query for search and then email staff about it. A query
+# that could not be indexed is not emailed yet, so the retry of its message
+# does both without sending the email twice. Returns the query ids to retry
+def process_new_queries(notifications, digest):
+    failedQueries = []
+    indexedNotifications = []
+    for notification in notifications:
+        try:
+            index_query(notification)
+            indexedNotifications.append(notification)
+        except ClientError as error:
+            print(json.dumps({'event': 'query_search_index_failed', 'query_id': notification['query_id'],
+                              'error': str(error)}))
+            failedQueries.append(notification['query_id'])
+
+    return failedQueries + dispatch_notifications(indexedNotifications, digest)
+
+
+# SQS consumer. Failed queries are handed back as batchItemFailures so only
+# those messages are retried
+def process_notification_records(records):
+    notifications = []
+    messageIDs = {}
+    for record in records:
+        notification = json.loads(record['body'])
+        notifications.append(notification)
+        messageIDs.setdefault(notification['query_id'], []).append(record['messageId'])
+
+    failedQueries = set(process_new_queries(notifications, notificationDigest))
+
+    batchItemFailures = []
+    for queryID in failedQueries:
+        for messageID in messageIDs[queryID]:
+            batchItemFailures.append({'itemIdentifier': messageID})
+    return {'batchItemFailures': batchItemFailures}
+
+
+# Never fails the request, the query is already saved. If the queue can not
+# be reached the query is indexed and the email published directly instead
+def notify_new_query(notification):
+    try:
+        notificationQueue.send(notification)
+    except ClientError as error:
+        print(json.dumps({'event': 'query_notification_queue_failed', 'query_id': notification['query_id'],
+                          'error': str(error)}))
+        process_new_queries([notification], False)
 
 
 def lambda_handler(event, context):
 
+    # New query notifications from SQS
+    if 'Records' in event:
+        return process_notification_records(event['Records'])
+
+    # Admin repair of the answered/outstanding counters
+    if event.get('action') == 'recount_queries':
+        return recount_queries()
+
+    # Index all existing queries for GET /search
+    if event.get('action') == 'rebuild_search_index':
+        return rebuild_search_index()
+
+    # One off fill of outstanding-index for existing queries
+    if event.get('action') == 'backfill_outstanding_index':
+        return backfill_outstanding_index()
+
     # Ensure calling method and api paths supplied are correct
     if event['httpMethod'] == "POST" and event['path'] == queryPath:
 
@@ -99,8 +1165,7 @@ def lambda_handler(event, context):
         # Create unique query ID
         queryID = contactEmail.partition("@")[0] + dateTimeString
 
-        # Insert query into DynamoDB table
-        response = table.put_item(Item={
+        queryItem = {
             'query_id': queryID,
             'date_added': dateTimeString,
             'forename': forename,
@@ -109,19 +1174,38 @@ def lambda_handler(event, context):
             'email_address': contactEmail,
             'message': message,
             'answered': answered
-        })
+        }
+        if not answered:
+            queryItem['outstanding'] = 'Y'
+
+        # Insert query into DynamoDB table and count it in the same transaction
+        queryPut = {}
+        queryPut['TableName'] = table.name
+        queryPut['Item'] = queryItem
+        queryPut['ConditionExpression'] = "attribute_not_exists(query_id)"
+
+        try:
+            response = transact_counted([
+                {'Put': queryPut},
+                query_stats_update(1 if answered else 0, 0 if answered else 1)
+            ])
+        except ClientError as error:
+            if (error.response['Error']['Code'] == 'TransactionCanceledException'
+                    and failed_conditions(error)[:1] == [True]):
+                responseObject = {}
+                responseObject['statusCode'] = 409
+                responseObject['headers'] = {}
+                responseObject['body'] = "A query with this id already exists, please try again"
+                return responseObject
+            raise
 
         if response['ResponseMetadata']['HTTPStatusCode'] == 200:
+            bump_query_version()
 
             # If successful send email to staff to let them know a new query has been asked
-            # For the purposes of my assignment this is my university email address
-            sns_client = boto3.client('sns')
-            sns_subject = "New query - " + queryID
-            sns_message = "New query recieved from " + forename + " " + surname + "\n" + message
-
-            sns_client.publish(TopicArn='arn:aws:sns:us-east-1:645243735875:QueryNotificaton',
-                               Message=sns_message,
-                               Subject=sns_subject)
+            # For the purposes of my assignment this is my university email address.
+            # The query is indexed for search by the same consumer
+            notify_new_query(build_query_notification(queryID, forename, surname, contactEmail, message))
 
             responseObject = {}
             responseObject['statusCode'] = '200'
@@ -166,47 +1250,85 @@ def lambda_handler(event, context):
             return responseObject
 
         # Update query to say if answered or not, but only if queryid already exists
+        if set_query_answered(queryID, updateTo) == 'not_found':
+            responseObject = {}
+            responseObject['statusCode'] = 400
+            responseObject['headers'] = {}
+            responseObject['body'] = "Supplied input does not exist. Failed to update query status"
+            return responseObject
+
+        responseObject = {}
+        responseObject['statusCode'] = '200'
+        responseObject['headers'] = {}
+        responseObject['body'] = "Successfully updated query"
+        return responseObject
+
+    # Ensure calling method and api paths supplied are correct
+    if event['httpMethod'] == "PATCH" and event['path'] == bulkQueryPath:
+
+        # The ids are sent as a json body, {"queryids": [...], "updateto": true, "atomic": false}
         try:
-            response = table.update_item(
-                Key={'query_id': queryID},
-                ConditionExpression=Attr("query_id").exists(),
-                UpdateExpression="set answered=:bool",
-                ExpressionAttributeValues={':bool': updateTo}
-                )
-        except ClientError as error:
-            if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
-                responseObject = {}
-                responseObject['statusCode'] = 400
-                responseObject['headers'] = {}
-                responseObject['body'] = "Supplied input does not exist. Failed to update query status"
-                return responseObject
+            bulkRequest = json.loads(event['body'])
+            queryIDs = bulkRequest['queryids']
+            updateTo = bulkRequest['updateto']
+            atomic = bulkRequest.get('atomic', False)
+        except:
+            queryIDs = None
 
-        if response['ResponseMetadata']['HTTPStatusCode'] == 200:
+        # A bare string would otherwise be read one character at a time
+        if not isinstance(queryIDs, list) or not all(isinstance(queryID, str) and queryID for queryID in queryIDs):
+            message = "Body must be json with a queryids list and an updateto boolean"
 
             responseObject = {}
-            responseObject['statusCode'] = '200'
+            responseObject['statusCode'] = '400'
             responseObject['headers'] = {}
-            responseObject['body'] = "Successfully updated query"
+            responseObject['body'] = json.dumps(message)
             return responseObject
-        else:
+
+        queryIDs = list(dict.fromkeys(queryIDs))
+
+        if (not isinstance(updateTo, bool) or not isinstance(atomic, bool)
+                or not queryIDs or len(queryIDs) > bulkMaxQueries):
+            message = f"updateto and atomic must be booleans and between 1 and {bulkMaxQueries} queryids are allowed"
+
             responseObject = {}
-            responseObject['statusCode'] = response['ResponseMetadata']['HTTPStatusCode']
+            responseObject['statusCode'] = '400'
             responseObject['headers'] = {}
-            responseObject['body'] = "Failed to update query"
+            responseObject['body'] = json.dumps(message)
             return responseObject
 
+        if atomic:
+            outcomes = set_queries_answered_atomic(queryIDs, updateTo)
+        else:
+            outcomes = set_queries_answered(queryIDs, updateTo)
+
+        message = {}
+        message['results'] = [{'query_id': queryID, 'outcome': outcomes[queryID]} for queryID in queryIDs]
+        for outcome in outcomes.values():
+            message[outcome] = message.get(outcome, 0) + 1
+
+        # 207 when any of the queries were not updated as asked
+        responseObject = {}
+        allApplied = all(outcome in ('updated', 'unchanged') for outcome in outcomes.values())
+        responseObject['statusCode'] = 200 if allApplied else 207
+        responseObject['headers'] = {}
+        responseObject['body'] = json.dumps(message)
+        return responseObject
+
     # Ensure calling method and api paths supplied are correct
     if event['httpMethod'] == "GET" and event['path'] == countQueriesPath:
 
-        # Count how many queries are answered and outstanding
-        countAnswered = table.scan(FilterExpression=Key('answered').eq(True),
-                                   Select='COUNT')
-        countOutstanding = table.scan(FilterExpression=Key('answered').eq(False),
-                                      Select='COUNT')
+        # Counters are kept up to date by POST and PATCH, they are only
+        # counted from the table if the stats item has never been made
+        stats = statsTable.get_item(Key={'stat_id': queryStatsID})
+        if 'Item' in stats:
+            counts = stats['Item']
+        else:
+            counts = recount_queries(onlyIfMissing=True)
 
         message = {}
-        message['answered'] = countAnswered['Count']
-        message['outstanding'] = countOutstanding['Count']
+        message['answered'] = int(counts.get('answered', 0))
+        message['outstanding'] = int(counts.get('outstanding', 0))
 
         responseObject = {}
         responseObject['statusCode'] = 200
@@ -217,51 +1339,168 @@ def lambda_handler(event, context):
     # Ensure calling method and api paths supplied are correct
     if event['httpMethod'] == "GET" and event['path'] == allQueriesPath:
 
-        # Scan for all queries on DB
-        allQueries = table.scan()
+        queryParameters = event.get('queryStringParameters') or {}
+
+        # answered, email, from, to, fields, limit and cursor are all optional
+        try:
+            listOperation, listArgs = build_query_listing(queryParameters)
+        except ValueError as error:
+            message = str(error)
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
+
+        useGzip = client_accepts_gzip(event)
+        useNdjson = client_wants_ndjson(event, queryParameters)
 
-        returnQueries = allQueries['Items']
+        # The version is read before the table, so a page is never tagged with
+        # a version newer than its contents. A matching client gets a 304
+        # without the table being read at all
+        headers = {}
+        try:
+            headers['ETag'] = request_etag(read_query_version(), event, [useGzip, useNdjson])
+        except ClientError as error:
+            print(json.dumps({'event': 'query_version_read_failed', 'error': str(error)}))
+
+        if 'ETag' in headers and etag_matches(event, headers['ETag']):
+            responseObject = {}
+            responseObject['statusCode'] = 304
+            responseObject['headers'] = headers
+            responseObject['body'] = ''
+            return responseObject
+
+        writer = ResponseWriter(useGzip)
+
+        # NDJSON follows the cursor itself and streams every matching query,
+        # writing each page as it arrives. X-Next-Cursor is set if it stopped early.
+        # Pages are read at the full 1MB unless the caller asked for a limit
+        if useNdjson:
+            if 'limit' not in queryParameters:
+                listArgs.pop('Limit')
+            lastEvaluatedKey = write_ndjson_pages(writer, listOperation, listArgs, ndjsonMaxBytes)
+
+            if lastEvaluatedKey is not None:
+                headers['X-Next-Cursor'] = encode_cursor(lastEvaluatedKey)
+            return writer.response(200, 'application/x-ndjson', headers)
+
+        allQueries = listOperation(**listArgs)
+
+        message = {}
+        message['queries'] = allQueries['Items']
+        message['cursor'] = None
+        if 'LastEvaluatedKey' in allQueries:
+            message['cursor'] = encode_cursor(allQueries['LastEvaluatedKey'])
+
+        writer.write(responseEncoder.encode(message))
+        return writer.response(200, 'application/json', headers)
+
+    # Ensure calling method and api paths supplied are correct
+    if event['httpMethod'] == "GET" and event['path'] == searchPath:
+
+        queryParameters = event.get('queryStringParameters') or {}
+
+        # q is required
+        try:
+            searchText = queryParameters['q']
+        except:
+            message = "q field not supplied"
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
+
+        try:
+            limit = int(queryParameters.get('limit', str(searchDefaultLimit)))
+            offset = decode_search_cursor(queryParameters['cursor']) if queryParameters.get('cursor') else 0
+        except ValueError:
+            message = "limit must be a whole number and cursor must come from a previous search"
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
+
+        if limit < 1 or limit > searchMaxLimit:
+            message = f"limit must be between 1 and {searchMaxLimit}"
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
+
+        rankedQueries, truncated = search_queries(searchText)
+        pageScores = dict(rankedQueries[offset:offset + limit])
+
+        results = []
+        for query in get_queries(list(pageScores)):
+            query['score'] = round(pageScores[query['query_id']], 4)
+            results.append(query)
+
+        message = {}
+        message['results'] = results
+        message['total'] = len(rankedQueries)
+        message['truncated'] = truncated
+        message['cursor'] = None
+        if offset + limit < len(rankedQueries):
+            message['cursor'] = encode_cursor({'offset': offset + limit})
 
         responseObject = {}
         responseObject['statusCode'] = 200
         responseObject['headers'] = {}
-        responseObject['body'] = json.dumps(returnQueries)
+        responseObject['body'] = responseEncoder.encode(message)
         return responseObject
 
     # Ensure calling method and api paths supplied are correct
     if event['httpMethod'] == "GET" and event['path'] == retreieveOldestPath:
 
-        # Scan for all outstanding queries so the oldest can be answered first
-        outstanding = table.scan(FilterExpression=Key('answered').eq(False))
-        queryNo = 1
-        oldestQuery = {}
-
-        # Loop through all returned queries and check the dates to only return the oldest
-        for query in outstanding['Items']:
-            if queryNo == 1:
-                oldestQuery['query_id'] = query['query_id']
-                oldestQuery['date_added'] = query['date_added']
-                oldestQuery['forename'] = query['forename']
-                oldestQuery['surname'] = query['surname']
-                oldestQuery['phone_number'] = query['phone_number']
-                oldestQuery['email_address'] = query['email_address']
-                oldestQuery['message'] = query['message']
-            else:
-                if query['date_added'] < oldestQuery['date_added']:
-                    oldestQuery['query_id'] = query['query_id']
-                    oldestQuery['date_added'] = query['date_added']
-                    oldestQuery['forename'] = query['forename']
-                    oldestQuery['surname'] = query['surname']
-                    oldestQuery['phone_number'] = query['phone_number']
-                    oldestQuery['email_address'] = query['email_address']
-                    oldestQuery['message'] = query['message']
+        queryParameters = event.get('queryStringParameters') or {}
+
+        # limit asks for the next N oldest as a list, without it just the
+        # oldest query is returned as before
+        try:
+            limit = int(queryParameters.get('limit', '1'))
+            leaseSeconds = int(queryParameters.get('lease', str(claimDefaultLease)))
+        except ValueError:
+            message = "limit and lease must be whole numbers"
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
 
-            queryNo += 1
+        if limit < 1 or limit > retrieveMaxLimit or leaseSeconds < 1 or leaseSeconds > claimMaxLease:
+            message = f"limit must be between 1 and {retrieveMaxLimit} and lease between 1 and {claimMaxLease} seconds"
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
+
+        # claimby reserves the returned queries so other staff are given different ones
+        oldestQueries = retrieve_oldest(limit, queryParameters.get('claimby'), leaseSeconds)
+
+        # Claims show up in GET /allqueries
+        if queryParameters.get('claimby') and oldestQueries:
+            bump_query_version()
+
+        if 'limit' in queryParameters:
+            body = oldestQueries
+        else:
+            body = oldestQueries[0] if oldestQueries else {}
 
         responseObject = {}
         responseObject['statusCode'] = 200
         responseObject['headers'] = {}
-        responseObject['body'] = json.dumps(oldestQuery)
+        responseObject['body'] = responseEncoder.encode(body)
         return responseObject
 
     # Return error if called with correct method or path
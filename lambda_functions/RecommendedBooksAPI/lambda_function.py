@@ -1,14 +1,509 @@
+import base64
+import codecs
+import csv
+import hashlib
+import io
 import json
 import boto3
-from boto3.dynamodb.conditions import Key
+import os
+import time
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Attr, Key
+from collections import OrderedDict
 
 client = boto3.resource("dynamodb")
 table = client.Table("Books")
 bookPath = "/book"
+bookImportPath = "/book/import"
+booksPath = "/books"
+s3 = boto3.client('s3')
+
+# Catalog cache settings. Each container keeps the books for recently asked
+# ages. The version stamp in CollectionVersions is bumped on every change so
+# other containers notice within versionCheckInterval seconds
+versionTable = client.Table("CollectionVersions")
+booksCollection = 'books'
+bookCacheTTL = int(os.environ.get('BOOK_CACHE_TTL', '300'))
+bookCacheMaxBytes = int(os.environ.get('BOOK_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+versionCheckInterval = float(os.environ.get('BOOK_VERSION_CHECK_SECONDS', '5'))
+bookPrefetchAges = [age.strip() for age in os.environ.get('BOOK_PREFETCH_AGES', '').split(',') if age.strip()]
+
+# Bulk import settings. Large files can be uploaded under the import prefix
+# and imported by key instead of being sent as the request body. Keys outside
+# the prefix are refused, so the rest of the bucket, invoices included, can
+# not be read or probed through the import
+bookImportBucket = os.environ.get('BOOK_IMPORT_BUCKET', 'lwbespokeinvoices')
+bookImportPrefix = os.environ.get('BOOK_IMPORT_PREFIX', 'book-imports/')
+bookImportMaxRows = int(os.environ.get('BOOK_IMPORT_MAX_ROWS', '10000'))
+bookImportChunkSize = 25
+bookFields = ('age', 'title', 'author', 'type')
+bookFieldMaxLength = 500
+
+# Browsing settings. Age ranges are put together from the cached age groups,
+# author and type on their own use author-index and type-index, both sorted
+# by title
+authorIndex = 'author-index'
+typeIndex = 'type-index'
+browseDefaultLimit = 50
+browseMaxLimit = 500
+browseMaxAgeSpan = 30
+
+
+# Least recently used results are dropped once the cache goes over maxBytes,
+# sizes are the length of the json for each result set
+class BookCache:
+
+    def __init__(self, ttl, maxBytes):
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def get(self, age):
+        entry = self.items.get(age)
+        if entry is None:
+            self.counts['misses'] += 1
+            return None
+
+        expires, size, books = entry
+        if expires < time.monotonic():
+            self.discard(age)
+            self.counts['expirations'] += 1
+            self.counts['misses'] += 1
+            return None
+
+        self.items.move_to_end(age)
+        self.counts['hits'] += 1
+        return books
+
+    def put(self, age, books):
+        size = len(json.dumps(books, default=str))
+        if size > self.maxBytes:
+            return
+
+        self.discard(age)
+        self.items[age] = (time.monotonic() + self.ttl, size, books)
+        self.size += size
+        while self.size > self.maxBytes:
+            _, (_, evictedSize, _) = self.items.popitem(last=False)
+            self.size -= evictedSize
+            self.counts['evictions'] += 1
+
+    def discard(self, age):
+        entry = self.items.pop(age, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def invalidate(self, age=None):
+        if age is None:
+            self.items.clear()
+            self.size = 0
+        else:
+            self.discard(age)
+        self.counts['invalidations'] += 1
+
+    def stats(self):
+        cacheStats = dict(self.counts)
+        cacheStats['entries'] = len(self.items)
+        cacheStats['bytes'] = self.size
+        cacheStats['version'] = catalogVersion['version']
+        return cacheStats
+
+
+bookCache = BookCache(bookCacheTTL, bookCacheMaxBytes)
+catalogVersion = {'version': None, 'checked': 0.0}
+
+
+def read_catalog_version():
+    versionItem = versionTable.get_item(Key={'collection': booksCollection}).get('Item', {})
+    return int(versionItem.get('version', 0))
+
+
+# Re-reads the version stamp at most once every versionCheckInterval seconds
+# and empties the cache if another container has changed the catalog. If the
+# stamp can not be read the cache is still used until its entries expire
+def check_catalog_version():
+    now = time.monotonic()
+    if now - catalogVersion['checked'] < versionCheckInterval:
+        return
+
+    try:
+        version = read_catalog_version()
+    except ClientError as error:
+        print(json.dumps({'event': 'book_version_check_failed', 'error': str(error)}))
+        return
+
+    if catalogVersion['version'] is not None and version != catalogVersion['version']:
+        bookCache.invalidate()
+    catalogVersion['version'] = version
+    catalogVersion['checked'] = now
+
+
+# Called after every write to the catalog. The local cache is fixed straight
+# away and the new stamp tells the other containers
+def bump_catalog_version(age=None):
+    bookCache.invalidate(age)
+    try:
+        updated = versionTable.update_item(Key={'collection': booksCollection},
+                                           UpdateExpression="ADD version :one",
+                                           ExpressionAttributeValues={':one': 1},
+                                           ReturnValues='UPDATED_NEW')
+    except ClientError as error:
+        print(json.dumps({'event': 'book_version_bump_failed', 'error': str(error)}))
+        return
+
+    # Someone else changed the catalog as well, so nothing cached can be trusted
+    version = int(updated['Attributes']['version'])
+    if catalogVersion['version'] is not None and version != catalogVersion['version'] + 1:
+        bookCache.invalidate()
+    catalogVersion['version'] = version
+    catalogVersion['checked'] = time.monotonic()
+
+
+# ETags come from the catalog version, so a container may answer 304 for up
+# to versionCheckInterval seconds after another container changes the catalog,
+# the same window its cached books can be out of date for
+def request_etag(event):
+    if catalogVersion['version'] is None:
+        return None
+    queryParameters = event.get('queryStringParameters') or {}
+    representation = json.dumps([booksCollection, catalogVersion['version'], event['path'],
+                                 sorted(queryParameters.items())])
+    return '"' + hashlib.sha256(representation.encode('utf-8')).hexdigest()[:32] + '"'
+
+
+def etag_matches(event, etag):
+    headers = event.get('headers') or {}
+    for name, value in headers.items():
+        if name.lower() == 'if-none-match' and value:
+            tags = [tag.strip() for tag in value.split(',')]
+            return '*' in tags or any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+    return False
+
+
+def not_modified_response(etag):
+    responseObject = {}
+    responseObject['statusCode'] = '304'
+    responseObject['headers'] = {'ETag': etag}
+    responseObject['body'] = ''
+    return responseObject
+
+
+# All the books for one age, following LastEvaluatedKey so large age groups
+# are not cut off at 1 MB
+def query_books_for_age(age):
+    queryArgs = {'KeyConditionExpression': Key('age').eq(age)}
+    books = []
+
+    while True:
+        page = table.query(**queryArgs)
+        books.extend(page['Items'])
+        if 'LastEvaluatedKey' not in page:
+            return books
+        queryArgs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+# Returns the books and whether they came from the cache
+def get_books_for_age(age):
+    check_catalog_version()
+
+    books = bookCache.get(age)
+    if books is not None:
+        return books, True
+
+    books = query_books_for_age(age)
+    bookCache.put(age, books)
+    return books, False
+
+
+# Load the most asked for ages while the container starts, so the first
+# requests are already cached. A failure just leaves them to load on demand
+def prefetch_books(ages):
+    for age in ages:
+        try:
+            get_books_for_age(age)
+        except ClientError as error:
+            print(json.dumps({'event': 'book_prefetch_failed', 'age': age, 'error': str(error)}))
+
+
+prefetch_books(bookPrefetchAges)
+
+
+# Cursors are base64 json. Index pages carry their LastEvaluatedKey and age
+# ranges the position in the sorted results
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError:
+        raise ValueError('Invalid cursor supplied')
+    if not isinstance(position, dict):
+        raise ValueError('Invalid cursor supplied')
+    if 'offset' in position and isinstance(position['offset'], int) and position['offset'] >= 0:
+        return position
+    if ('key' in position and isinstance(position['key'], dict)
+            and all(name in bookFields and isinstance(value, str) for name, value in position['key'].items())):
+        return position
+    raise ValueError('Invalid cursor supplied')
+
+
+def read_browse_parameters(queryParameters):
+    browse = {}
+    browse['author'] = queryParameters.get('author')
+    browse['type'] = queryParameters.get('type')
+
+    try:
+        browse['limit'] = int(queryParameters.get('limit', browseDefaultLimit))
+        browse['minage'] = int(queryParameters['minage']) if queryParameters.get('minage') else None
+        browse['maxage'] = int(queryParameters['maxage']) if queryParameters.get('maxage') else None
+    except ValueError:
+        raise ValueError('limit, minage and maxage must be whole numbers')
+    if browse['limit'] < 1 or browse['limit'] > browseMaxLimit:
+        raise ValueError(f'limit must be between 1 and {browseMaxLimit}')
+
+    # One end of an age range on its own means that single age
+    if browse['minage'] is None:
+        browse['minage'] = browse['maxage']
+    if browse['maxage'] is None:
+        browse['maxage'] = browse['minage']
+    if browse['minage'] is not None:
+        if (browse['minage'] < 0 or browse['maxage'] < browse['minage']
+                or browse['maxage'] - browse['minage'] >= browseMaxAgeSpan):
+            raise ValueError('maxage must not be less than minage and the range can cover '
+                             f'at most {browseMaxAgeSpan} ages')
+    elif not browse['author'] and not browse['type']:
+        raise ValueError('At least one of minage, maxage, author or type must be supplied')
+
+    browse['fields'] = None
+    if queryParameters.get('fields'):
+        fields = [field.strip() for field in queryParameters['fields'].split(',') if field.strip()]
+        if not fields or any(field not in bookFields for field in fields):
+            raise ValueError(f"fields can only contain {', '.join(bookFields)}")
+        browse['fields'] = fields
+
+    browse['cursor'] = decode_cursor(queryParameters['cursor']) if queryParameters.get('cursor') else None
+    return browse
+
+
+# Every age in the range comes from the per-age cache, then author and type
+# are applied in memory and the results are paged by position
+def browse_age_range(browse):
+    books = []
+    for age in range(browse['minage'], browse['maxage'] + 1):
+        ageBooks, _ = get_books_for_age(str(age))
+        books.extend(book for book in ageBooks
+                     if (not browse['author'] or book.get('author') == browse['author'])
+                     and (not browse['type'] or book.get('type') == browse['type']))
+
+    offset = browse['cursor']['offset'] if browse['cursor'] and 'offset' in browse['cursor'] else 0
+    page = books[offset:offset + browse['limit']]
+    if browse['fields']:
+        page = [{field: book[field] for field in browse['fields'] if field in book} for book in page]
+
+    cursor = None
+    if offset + browse['limit'] < len(books):
+        cursor = encode_cursor({'offset': offset + browse['limit']})
+    return page, cursor
+
+
+# Author, or type on its own, is a single index query for one page
+def browse_index(browse):
+    queryArgs = {'Limit': browse['limit']}
+    if browse['author']:
+        queryArgs['IndexName'] = authorIndex
+        queryArgs['KeyConditionExpression'] = Key('author').eq(browse['author'])
+        if browse['type']:
+            queryArgs['FilterExpression'] = Attr('type').eq(browse['type'])
+    else:
+        queryArgs['IndexName'] = typeIndex
+        queryArgs['KeyConditionExpression'] = Key('type').eq(browse['type'])
+
+    # type is a reserved word so every field goes through a placeholder
+    if browse['fields']:
+        queryArgs['ProjectionExpression'] = ', '.join(f'#p{number}' for number in range(len(browse['fields'])))
+        queryArgs['ExpressionAttributeNames'] = {f'#p{number}': field for number, field in enumerate(browse['fields'])}
+
+    if browse['cursor'] and 'key' in browse['cursor']:
+        queryArgs['ExclusiveStartKey'] = browse['cursor']['key']
+
+    page = table.query(**queryArgs)
+
+    cursor = None
+    if 'LastEvaluatedKey' in page:
+        cursor = encode_cursor({'key': page['LastEvaluatedKey']})
+    return page['Items'], cursor
+
+
+# Work out whether the import is csv or ndjson from the format parameter, the
+# Content-Type header or the file extension, in that order
+def import_format(event, queryParameters):
+    if queryParameters.get('format'):
+        return queryParameters['format'].lower()
+
+    headers = event.get('headers') or {}
+    for name, value in headers.items():
+        if name.lower() == 'content-type' and value:
+            if 'csv' in value:
+                return 'csv'
+            if 'ndjson' in value or 'jsonl' in value:
+                return 'ndjson'
+
+    key = queryParameters.get('key', '')
+    if key.endswith('.csv'):
+        return 'csv'
+    if key.endswith('.ndjson') or key.endswith('.jsonl'):
+        return 'ndjson'
+    return None
+
+
+# Lines of the import, read from s3 a piece at a time when a key is given
+def import_lines(event, queryParameters):
+    if queryParameters.get('key'):
+        if not queryParameters['key'].startswith(bookImportPrefix) or queryParameters['key'] == bookImportPrefix:
+            raise ValueError(f'key must be a file under {bookImportPrefix}')
+        importObject = s3.get_object(Bucket=bookImportBucket, Key=queryParameters['key'])
+        return codecs.getreader('utf-8')(importObject['Body'])
+
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
+    return io.StringIO(body)
+
+
+# Yields (row number, row) one at a time. A row that can not be read is
+# yielded as an error string so it goes in the report like any other
+def read_import_rows(lines, importFormat):
+    if importFormat == 'csv':
+        reader = csv.DictReader(lines)
+        if reader.fieldnames is None or not all(field in reader.fieldnames for field in bookFields):
+            raise ValueError(f"csv header must include {', '.join(bookFields)}")
+        for rowNumber, row in enumerate(reader, start=1):
+            yield rowNumber, row
+        return
+
+    rowNumber = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        rowNumber += 1
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield rowNumber, 'Row is not valid json'
+            continue
+        yield rowNumber, row if isinstance(row, dict) else 'Row must be a json object'
+
+
+# The same four fields POST /book needs, as strings. Age has to be a whole
+# number so it can be used in age ranges
+def validate_book(row):
+    book = {}
+    for field in bookFields:
+        value = row.get(field)
+        if value is None or not str(value).strip():
+            return None, f'{field} field not supplied'
+        value = str(value).strip()
+        if len(value) > bookFieldMaxLength:
+            return None, f'{field} is longer than {bookFieldMaxLength} characters'
+        book[field] = value
+
+    if not book['age'].isdigit():
+        return None, 'age must be a whole number'
+    book['age'] = str(int(book['age']))
+    return book, None
+
+
+def find_existing_books(books):
+    requestItems = {table.name: {'Keys': [{'age': book['age'], 'title': book['title']} for book in books],
+                                 'ProjectionExpression': 'age, title'}}
+    existing = set()
+
+    while requestItems:
+        response = client.batch_get_item(RequestItems=requestItems)
+        for book in response['Responses'].get(table.name, []):
+            existing.add((book['age'], book['title']))
+        requestItems = response.get('UnprocessedKeys') or {}
+        if requestItems:
+            time.sleep(0.05)
+
+    return existing
+
+
+# Write one chunk of valid rows. batch_writer resends any unprocessed items
+# itself, so an error here means the whole chunk could not be written
+def write_import_chunk(chunk, skipExisting, report):
+    try:
+        if skipExisting:
+            existing = find_existing_books([book for _, book in chunk])
+            for rowNumber, book in chunk:
+                if (book['age'], book['title']) in existing:
+                    report.append({'row': rowNumber, 'status': 'exists'})
+            chunk = [(rowNumber, book) for rowNumber, book in chunk if (book['age'], book['title']) not in existing]
+
+        with table.batch_writer() as writer:
+            for _, book in chunk:
+                writer.put_item(Item=book)
+    except ClientError as error:
+        for rowNumber, _ in chunk:
+            report.append({'row': rowNumber, 'status': 'failed', 'error': error.response['Error']['Code']})
+        return 0
+
+    for rowNumber, _ in chunk:
+        report.append({'row': rowNumber, 'status': 'imported'})
+    return len(chunk)
+
+
+# Rows are validated and written in chunks as they are read, so only one
+# chunk and the keys already seen are held at a time. A book appearing twice
+# in the file is only written the first time
+def import_books(rows, skipExisting):
+    report = []
+    seenBooks = set()
+    chunk = []
+    imported = 0
+
+    for rowNumber, row in rows:
+        if rowNumber > bookImportMaxRows:
+            report.append({'row': rowNumber, 'status': 'skipped',
+                           'error': f'Only {bookImportMaxRows} rows can be imported at once'})
+            break
+
+        if isinstance(row, str):
+            report.append({'row': rowNumber, 'status': 'invalid', 'error': row})
+            continue
+
+        book, error = validate_book(row)
+        if error:
+            report.append({'row': rowNumber, 'status': 'invalid', 'error': error})
+            continue
+
+        if (book['age'], book['title']) in seenBooks:
+            report.append({'row': rowNumber, 'status': 'duplicate'})
+            continue
+        seenBooks.add((book['age'], book['title']))
+
+        chunk.append((rowNumber, book))
+        if len(chunk) == bookImportChunkSize:
+            imported += write_import_chunk(chunk, skipExisting, report)
+            chunk = []
+
+    if chunk:
+        imported += write_import_chunk(chunk, skipExisting, report)
+
+    report.sort(key=lambda result: result['row'])
+    return imported, report
 
 
 def lambda_handler(event, context):
 
+    # Cache hit/miss counts for monitoring
+    if event.get('action') == 'book_cache_stats':
+        return bookCache.stats()
+
     # Ensure calling method and api paths supplied are correct
     if event['httpMethod'] == "GET" and event['path'] == bookPath:
 
@@ -24,23 +519,31 @@ def lambda_handler(event, context):
             responseObject['body'] = json.dumps(message)
             return responseObject
 
-        # Retrieve all books for that age group on the DB
-        books = table.query(KeyConditionExpression=Key('age').eq(input_age))
+        # Nothing needs reading if the client already has this version
+        check_catalog_version()
+        etag = request_etag(event)
+        if etag is not None and etag_matches(event, etag):
+            return not_modified_response(etag)
+
+        # Retrieve all books for that age group, from the cache when possible
+        returnBooks, cacheHit = get_books_for_age(input_age)
+
+        headers = {'X-Cache': 'HIT' if cacheHit else 'MISS'}
+        if etag is not None:
+            headers['ETag'] = etag
 
-        if books['Count'] == 0:
+        if len(returnBooks) == 0:
             message = "Sorry, no books are currently recommended for this age"
 
             responseObject = {}
             responseObject['statusCode'] = '200'
-            responseObject['headers'] = {}
+            responseObject['headers'] = headers
             responseObject['body'] = json.dumps(message)
             return responseObject
 
-        returnBooks = books['Items']
-
         responseObject = {}
         responseObject['statusCode'] = 200
-        responseObject['headers'] = {}
+        responseObject['headers'] = headers
         responseObject['body'] = json.dumps(returnBooks)
         return responseObject
 
@@ -100,6 +603,8 @@ def lambda_handler(event, context):
         })
 
         if response['ResponseMetadata']['HTTPStatusCode'] == 200:
+            bump_catalog_version(age)
+
             responseObject = {}
             responseObject['statusCode'] = '200'
             responseObject['headers'] = {}
@@ -112,6 +617,98 @@ def lambda_handler(event, context):
             responseObject['body'] = "Call to insert new book failed"
             return responseObject
 
+    # Ensure calling method and api paths supplied are correct
+    if event['httpMethod'] == "GET" and event['path'] == booksPath:
+
+        queryParameters = event.get('queryStringParameters') or {}
+
+        # minage, maxage, author, type, fields, limit and cursor are all optional
+        # but at least one of the ages, author or type is needed
+        try:
+            browse = read_browse_parameters(queryParameters)
+        except ValueError as error:
+            message = str(error)
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
+
+        check_catalog_version()
+        etag = request_etag(event)
+        if etag is not None and etag_matches(event, etag):
+            return not_modified_response(etag)
+
+        if browse['minage'] is not None:
+            returnBooks, cursor = browse_age_range(browse)
+        else:
+            returnBooks, cursor = browse_index(browse)
+
+        message = {}
+        message['books'] = returnBooks
+        message['cursor'] = cursor
+
+        responseObject = {}
+        responseObject['statusCode'] = 200
+        responseObject['headers'] = {'ETag': etag} if etag is not None else {}
+        responseObject['body'] = json.dumps(message, default=str)
+        return responseObject
+
+    # Ensure calling method and api paths supplied are correct
+    if event['httpMethod'] == "POST" and event['path'] == bookImportPath:
+
+        queryParameters = event.get('queryStringParameters') or {}
+        importFormat = import_format(event, queryParameters)
+
+        if importFormat not in ('csv', 'ndjson'):
+            message = "format must be csv or ndjson"
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
+
+        # skipexisting leaves books already in the catalog as they are,
+        # otherwise they are overwritten as POST /book would
+        skipExisting = queryParameters.get('skipexisting', 'false').upper() == "TRUE"
+
+        try:
+            importRows = read_import_rows(import_lines(event, queryParameters), importFormat)
+            imported, report = import_books(importRows, skipExisting)
+        except (ValueError, csv.Error) as error:
+            message = str(error)
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
+        except ClientError as error:
+            message = "Import file could not be read: " + error.response['Error']['Code']
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(message)
+            return responseObject
+
+        if imported:
+            bump_catalog_version()
+
+        message = {}
+        message['imported'] = imported
+        message['rows'] = len(report)
+        message['report'] = report
+
+        # 207 when any row was not imported
+        responseObject = {}
+        responseObject['statusCode'] = 200 if imported == len(report) else 207
+        responseObject['headers'] = {}
+        responseObject['body'] = json.dumps(message)
+        return responseObject
+
     # Return error if called with correct method or path
     error = {}
     error["Code"] = "1"
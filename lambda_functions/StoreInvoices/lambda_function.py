@@ -1,17 +1,1142 @@
+import base64
+import functools
+import html
 import json
 import boto3
+import hashlib
 import os
+import queue
+import re
 import subprocess
+import threading
+import time
+import uuid
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from decimal import Decimal
+from urllib.parse import quote, unquote
 
 s3 = boto3.client('s3')
 bucket = 'lwbespokeinvoices'
+dynamo = boto3.resource("dynamodb")
+indexTable = dynamo.Table("InvoiceIndex")
+versionTable = dynamo.Table("CollectionVersions")
 createPath = "/createinvoice"
 downloadPath = "/download"
+bulkDownloadPath = "/download/bulk"
+latestInvoicePath = "/createinvoice/latest"
+clientInvoicesPath = "/createinvoice/client"
+
+# Renderer settings. The workers are kept running between warm invocations
+wkhtmltopdfBinary = os.environ.get('WKHTMLTOPDF_PATH', 'wkhtmltopdf')
+renderWorkers = int(os.environ.get('RENDER_WORKERS', '1'))
+renderTimeout = float(os.environ.get('RENDER_TIMEOUT', '60'))
+
+# file renders through the pool of warm workers using /tmp. stream pipes the
+# html in and the pdf out of a new wkhtmltopdf for each invoice and straight
+# into s3, it has to be asked for and falls back to file if streaming fails
+renderMode = os.environ.get('RENDER_MODE', 'file')
+
+# s3 multipart parts must be at least 5MB, and at most one part is held in
+# memory at a time while streaming
+streamPartSize = max(int(os.environ.get('STREAM_PART_SIZE', str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+streamReadSize = 64 * 1024
+
+# Batch settings. Concurrency defaults to one render worker per core
+batchCreatePath = "/createinvoice/batch"
+batchMaxItems = int(os.environ.get('BATCH_MAX_ITEMS', '500'))
+batchMaxConcurrency = int(os.environ.get('BATCH_MAX_CONCURRENCY', str(os.cpu_count() or 1)))
+
+# Invoice listing settings. A request with a filter that can not be turned into
+# a prefix stops after listPageBudget list calls and returns a cursor
+invoicesPrefix = 'invoices/'
+listDefaultLimit = 100
+listMaxLimit = 1000
+listPageBudget = 10
+
+# Every new invoice bumps this version stamp, so GET /createinvoice can tell a
+# client nothing has changed without listing the bucket
+invoicesCollection = 'invoices'
+
+# Presigned url settings. A cached url is reused while at least
+# presignMinRemaining of the requested lifetime is left on it
+presignDefaultExpiry = 120
+presignMaxExpiry = int(os.environ.get('PRESIGN_MAX_EXPIRY', '3600'))
+presignMinRemaining = float(os.environ.get('PRESIGN_MIN_REMAINING', '0.5'))
+presignCacheSize = int(os.environ.get('PRESIGN_CACHE_SIZE', '4096'))
+bulkDownloadMaxKeys = 1000
+
+# Invoice templates are looked for in the templates folder bundled with this
+# function first and then under templates/ in the bucket, as
+# {template_id}/{template_version}.html
+templatePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+templatePrefix = 'templates/'
+templateDefaultVersion = 'v1'
+templateCacheSize = int(os.environ.get('TEMPLATE_CACHE_SIZE', '32'))
+templateNamePattern = re.compile(r'^[A-Za-z0-9_-]+$')
+templateTagPattern = re.compile(r'\{\{\s*([#/]?)\s*([A-Za-z0-9_.]+)\s*\}\}')
+
+# Render cache settings. Pointers from content hash to invoice are kept in s3
+# outside the invoices folder so they never show up as invoices
+renderCachePrefix = 'invoice-cache/'
+renderCacheSize = int(os.environ.get('RENDER_CACHE_SIZE', '1024'))
+
+# Two invoices for the same client and month can be made in the same second,
+# so invoice keys end in the start of the content hash after the time
+invoiceKeyHashLength = 12
+
+
+class RenderError(Exception):
+    pass
+
+
+# Map the wkhtmltopdf_options supplied in a request onto wkhtmltopdf settings
+def map_wkhtmltopdf_options(requestOptions):
+    wkhtmltopdf_options = {}
+
+    if 'margin' in requestOptions:
+        margins = requestOptions['margin'].split(' ')
+        if len(margins) == 4:
+            wkhtmltopdf_options['margin-top'] = margins[0]
+            wkhtmltopdf_options['margin-right'] = margins[1]
+            wkhtmltopdf_options['margin-bottom'] = margins[2]
+            wkhtmltopdf_options['margin-left'] = margins[3]
+
+    if 'orientation' in requestOptions:
+        wkhtmltopdf_options['orientation'] = 'portrait'
+
+        if requestOptions['orientation'].lower() == 'landscape':
+            wkhtmltopdf_options['orientation'] = 'landscape'
+
+    if 'title' in requestOptions:
+        wkhtmltopdf_options['title'] = requestOptions['title']
+
+    return wkhtmltopdf_options
+
+
+# Build the wkhtmltopdf argument list. No shell is involved so values
+# such as the title do not need to be quoted
+def build_wkhtmltopdf_args(wkhtmltopdf_options, source, target):
+    args = ['--load-error-handling', 'ignore']  # ignore unecessary errors
+    for key, value in wkhtmltopdf_options.items():
+        args += [f'--{key}', str(value)]
+    args += [source, target]
+    return args
+
+
+# wkhtmltopdf splits each line read from stdin itself, so every argument is
+# double quoted with backslash escapes and line breaks are removed
+def quote_stdin_arg(value):
+    value = value.replace('\r', ' ').replace('\n', ' ')
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+# A single long running wkhtmltopdf process started with --read-args-from-stdin.
+# Each line written to stdin is one conversion, and the progress output on
+# stderr is used to tell when that conversion has finished
+class RenderWorker:
+
+    def __init__(self, workerID):
+        self.workerID = workerID
+        self.process = None
+        self.stderrLines = None
+        self.renders = 0
+        self.restarts = 0
+
+    def start(self):
+        self.process = subprocess.Popen([wkhtmltopdfBinary, '--read-args-from-stdin'],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE,
+                                        text=True,
+                                        bufsize=1)
+        self.stderrLines = queue.Queue()
+        reader = threading.Thread(target=self.read_stderr,
+                                  args=(self.process, self.stderrLines),
+                                  daemon=True)
+        reader.start()
+
+    @staticmethod
+    def read_stderr(process, lines):
+        for line in process.stderr:
+            lines.put(line)
+        # None tells the waiting render that the process has exited
+        lines.put(None)
+
+    def is_healthy(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def restart(self):
+        if self.process is not None:
+            self.restarts += 1
+        self.stop()
+        self.start()
+
+    def render(self, args, target, timeout):
+        if not self.is_healthy():
+            self.restart()
+
+        # Throw away anything left over from a previous conversion
+        while not self.stderrLines.empty():
+            self.stderrLines.get_nowait()
+
+        try:
+            self.process.stdin.write(' '.join(quote_stdin_arg(arg) for arg in args) + '\n')
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as error:
+            self.stop()
+            raise RenderError(f'Render worker {self.workerID} is not accepting work: {error}')
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                line = self.stderrLines.get(timeout=max(remaining, 0))
+            except queue.Empty:
+                self.stop()
+                raise RenderError(f'Render worker {self.workerID} timed out after {timeout}s')
+
+            # wkhtmltopdf exits when a conversion fails, the pdf may still
+            # have been written if only part of the page failed to load
+            if line is None:
+                self.stop()
+                if os.path.exists(target) and os.path.getsize(target) > 0:
+                    break
+                raise RenderError(f'Render worker {self.workerID} exited during conversion')
+
+            # Progress updates are written with carriage returns on one line
+            status = line.strip().split('\r')[-1].strip()
+            if status.startswith('Done'):
+                break
+            if status.startswith('Failed'):
+                raise RenderError(f'Render worker {self.workerID} failed to convert {target}')
+
+        if not os.path.exists(target):
+            raise RenderError(f'Render worker {self.workerID} did not write {target}')
+
+        self.renders += 1
+
+
+# Fixed size pool of render workers. Idle workers wait on a queue so
+# concurrent renders each get their own process
+class RenderPool:
+
+    def __init__(self, size):
+        self.size = max(size, 1)
+        self.idle = queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    # Workers are only started on first use so cold starts that never
+    # render an invoice do not pay for them
+    def ensure_started(self):
+        with self.lock:
+            while len(self.workers) < self.size:
+                worker = RenderWorker(len(self.workers) + 1)
+                worker.start()
+                self.workers.append(worker)
+                self.idle.put(worker)
+
+    # Grow the pool so a batch can run size renders at once. Extra workers
+    # stay warm for later invocations
+    def ensure_size(self, size):
+        with self.lock:
+            self.size = max(self.size, size)
+        self.ensure_started()
+
+    # Restart any idle worker that has died and report on every worker.
+    # Workers that are busy are left alone and checked on their next render.
+    # With start off only workers that are already running are checked
+    def health_check(self, start=True):
+        if start:
+            self.ensure_started()
+
+        checked = []
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if not worker.is_healthy():
+                worker.restart()
+            checked.append(worker)
+        for worker in checked:
+            self.idle.put(worker)
+
+        status = []
+        for worker in self.workers:
+            status.append({'worker': worker.workerID,
+                           'healthy': worker.is_healthy(),
+                           'renders': worker.renders,
+                           'restarts': worker.restarts})
+        return status
+
+    def render(self, args, target, timeout):
+        self.ensure_started()
+
+        try:
+            worker = self.idle.get(timeout=timeout)
+        except queue.Empty:
+            raise RenderError('No render worker became free in time')
+
+        try:
+            worker.render(args, target, timeout)
+        finally:
+            self.idle.put(worker)
+
+    def shutdown(self):
+        with self.lock:
+            for worker in self.workers:
+                worker.stop()
+            self.workers = []
+            self.idle = queue.Queue()
+
+
+renderPool = RenderPool(renderWorkers)
+
+
+# Render html_file to pdf_file, returning how long it took. If the warm pool
+# cannot do the conversion a one off wkhtmltopdf process is used instead
+def render_pdf(wkhtmltopdf_options, html_file, pdf_file):
+    args = build_wkhtmltopdf_args(wkhtmltopdf_options, html_file, pdf_file)
+    renderTiming = {}
+    startTime = time.perf_counter()
+
+    try:
+        renderPool.render(args, pdf_file, renderTimeout)
+        renderTiming['mode'] = 'pool'
+    except (RenderError, OSError) as error:
+        print(json.dumps({'event': 'render_pool_failed', 'error': str(error)}))
+        subprocess.run([wkhtmltopdfBinary] + args, timeout=renderTimeout,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        renderTiming['mode'] = 'process'
+
+    renderTiming['render_ms'] = round((time.perf_counter() - startTime) * 1000, 1)
+    return renderTiming
+
+
+# Feed the html into wkhtmltopdf on its own thread so a large invoice can not
+# dead lock with the pdf being read back from stdout
+def write_render_input(process, htmlBytes):
+    try:
+        process.stdin.write(htmlBytes)
+    except (BrokenPipeError, OSError):
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+
+
+# Read the pdf from wkhtmltopdf stdout and upload it as it arrives. Small
+# invoices that fit in one part are sent with a single put_object, anything
+# larger becomes a multipart upload so memory stays at one part
+def stream_invoice_to_s3(invoiceRequest, upload_file, metadata):
+    args = build_wkhtmltopdf_args(invoiceRequest['wkhtmltopdf_options'], '-', '-')
+    startTime = time.perf_counter()
+
+    process = subprocess.Popen([wkhtmltopdfBinary] + args,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    writer = threading.Thread(target=write_render_input,
+                              args=(process, invoiceRequest['html_string'].encode('utf-8')),
+                              daemon=True)
+    writer.start()
+
+    # Kill the renderer if it hangs, which ends the read loop below
+    watchdog = threading.Timer(renderTimeout, process.kill)
+    watchdog.start()
+
+    uploadID = None
+    uploadedParts = []
+    partBuffer = bytearray()
+    bytesRendered = 0
+
+    try:
+        while True:
+            chunk = process.stdout.read(streamReadSize)
+            if not chunk:
+                break
+
+            if bytesRendered == 0 and not chunk.startswith(b'%PDF'):
+                raise RenderError('wkhtmltopdf did not return a pdf')
+
+            bytesRendered += len(chunk)
+            partBuffer += chunk
+
+            if len(partBuffer) >= streamPartSize:
+                if uploadID is None:
+                    uploadID = s3.create_multipart_upload(Bucket=bucket, Key=upload_file,
+                                                          ContentType='application/pdf',
+                                                          Metadata=metadata)['UploadId']
+                partNumber = len(uploadedParts) + 1
+                part = s3.upload_part(Bucket=bucket, Key=upload_file, UploadId=uploadID,
+                                      PartNumber=partNumber, Body=bytes(partBuffer))
+                uploadedParts.append({'PartNumber': partNumber, 'ETag': part['ETag']})
+                partBuffer = bytearray()
+
+        process.wait(timeout=renderTimeout)
+        watchdog.cancel()
+        renderTiming = {'mode': 'stream'}
+        renderTiming['render_ms'] = round((time.perf_counter() - startTime) * 1000, 1)
+
+        # A negative return code means the watchdog killed the renderer and
+        # the pdf read so far is incomplete
+        if process.returncode < 0:
+            raise RenderError(f'wkhtmltopdf timed out after {renderTimeout}s')
+
+        # wkhtmltopdf can exit non zero for ignored load errors and still
+        # produce a pdf, so only an empty output counts as a failure
+        if bytesRendered == 0:
+            raise RenderError(f'wkhtmltopdf exited with code {process.returncode} and no output')
+
+        uploadStart = time.perf_counter()
+        if uploadID is None:
+            s3.put_object(Bucket=bucket, Key=upload_file, Body=bytes(partBuffer),
+                          ContentType='application/pdf',
+                          Metadata=metadata)
+        else:
+            if partBuffer:
+                partNumber = len(uploadedParts) + 1
+                part = s3.upload_part(Bucket=bucket, Key=upload_file, UploadId=uploadID,
+                                      PartNumber=partNumber, Body=bytes(partBuffer))
+                uploadedParts.append({'PartNumber': partNumber, 'ETag': part['ETag']})
+            s3.complete_multipart_upload(Bucket=bucket, Key=upload_file, UploadId=uploadID,
+                                         MultipartUpload={'Parts': uploadedParts})
+        renderTiming['upload_ms'] = round((time.perf_counter() - uploadStart) * 1000, 1)
+        renderTiming['pdf_bytes'] = bytesRendered
+        renderTiming['parts'] = max(len(uploadedParts), 1)
+        return renderTiming
+
+    except BaseException:
+        if uploadID is not None:
+            s3.abort_multipart_upload(Bucket=bucket, Key=upload_file, UploadId=uploadID)
+        raise
+
+    finally:
+        watchdog.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
+
+# The original path through /tmp, kept as the fallback. The html and pdf
+# files are always removed afterwards so warm containers do not fill /tmp
+def upload_invoice_from_file(invoiceRequest, upload_file, metadata):
+
+    # The local name does not use the request fields as they are passed
+    # straight to wkhtmltopdf
+    local_filename = f'/tmp/{uuid.uuid4().hex}.html'
+    pdf_filename = local_filename.replace('.html', '.pdf')
+
+    try:
+        with open(local_filename, 'w') as f:
+            f.write(invoiceRequest['html_string'])
+
+        # Convert the html on one of the warm render workers
+        renderTiming = render_pdf(invoiceRequest['wkhtmltopdf_options'], local_filename, pdf_filename)
+
+        # Upload the pdf
+        uploadStart = time.perf_counter()
+        s3.upload_file(Filename=pdf_filename, Bucket=bucket, Key=upload_file,
+                       ExtraArgs={'ContentType': 'application/pdf',
+                                  'Metadata': metadata})
+        renderTiming['upload_ms'] = round((time.perf_counter() - uploadStart) * 1000, 1)
+        renderTiming['pdf_bytes'] = os.path.getsize(pdf_filename)
+    finally:
+        for tmp_file in (local_filename, pdf_filename):
+            try:
+                os.unlink(tmp_file)
+            except FileNotFoundError:
+                pass
+
+    return renderTiming
+
+
+def read_collection_version(collection):
+    versionItem = versionTable.get_item(Key={'collection': collection}).get('Item', {})
+    return int(versionItem.get('version', 0))
+
+
+# Batch invoices are created from several threads. Table resources must not
+# be shared between threads, so the writes made for each invoice go through
+# the resource's client, which can be
+def bump_collection_version(collection):
+    dynamo.meta.client.update_item(TableName=versionTable.name,
+                                   Key={'collection': collection},
+                                   UpdateExpression="ADD version :one",
+                                   ExpressionAttributeValues={':one': 1})
+
+
+# Strong ETag for one listing request, the same version and parameters
+# always give the same page
+def request_etag(collection, version, event):
+    queryParameters = event.get('queryStringParameters') or {}
+    representation = json.dumps([collection, version, event['path'], sorted(queryParameters.items())])
+    return '"' + hashlib.sha256(representation.encode('utf-8')).hexdigest()[:32] + '"'
+
+
+def etag_matches(event, etag):
+    headers = event.get('headers') or {}
+    for name, value in headers.items():
+        if name.lower() == 'if-none-match' and value:
+            tags = [tag.strip() for tag in value.split(',')]
+            return '*' in tags or any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+    return False
+
+
+def not_modified_response(etag):
+    responseObject = {}
+    responseObject['statusCode'] = '304'
+    responseObject['headers'] = {'ETag': etag}
+    responseObject['body'] = ''
+    return responseObject
+
+
+# Cursors are the last key returned, base64 encoded so clients treat them as opaque
+def encode_list_cursor(lastKey):
+    return base64.urlsafe_b64encode(lastKey.encode('utf-8')).decode('ascii')
+
+
+def decode_list_cursor(cursor):
+    lastKey = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    if not lastKey.startswith(invoicesPrefix):
+        raise ValueError('cursor is not an invoice key')
+    return lastKey
+
+
+# Invoice keys are {forename}{surname}{yearmonth}-{timestamp}-{hash}.pdf. Keys
+# made before the hash was added end in the timestamp alone
+invoiceKeyEnd = r'-(?P<created>\d{14})(?:-(?P<hash>[0-9a-f]{12}))?\.pdf$'
+invoiceKeyEndPattern = re.compile(invoiceKeyEnd)
+invoiceKeyPattern = re.compile(r'^invoices/(?P<client>.+?)(?P<yearmonth>\d{4}-?\d{2})' + invoiceKeyEnd)
+
+
+# A year month filter without a client is matched against the year month part
+# of the key. As with a client filter it matches the start, so 2022 finds all
+# of 2022
+def invoice_matches_yearmonth(objectKey, yearMonth):
+    match = invoiceKeyPattern.match(objectKey)
+    return match is not None and match.group('yearmonth').startswith(yearMonth)
+
+
+# List one page of invoices. The client filter, and year month when a client
+# is given, become part of the s3 prefix so only matching keys are read
+def list_invoices(limit, cursor=None, client=None, yearMonth=None):
+    listPrefix = invoicesPrefix
+    matchYearMonth = None
+    if client:
+        listPrefix += client
+        if yearMonth:
+            listPrefix += yearMonth
+    elif yearMonth:
+        matchYearMonth = yearMonth
+
+    listArgs = {'Bucket': bucket, 'Prefix': listPrefix, 'MaxKeys': limit}
+    if cursor is not None:
+        listArgs['StartAfter'] = cursor
+
+    invoices = []
+    lastKey = None
+    for listCall in range(listPageBudget):
+        response = s3.list_objects_v2(**listArgs)
+
+        for keys in response.get('Contents', []):
+            lastKey = keys['Key']
+
+            # Skip the folder itself and anything not matching the filters
+            if keys['Key'] == invoicesPrefix:
+                continue
+            if matchYearMonth and not invoice_matches_yearmonth(keys['Key'], matchYearMonth):
+                continue
+
+            invoice = {}
+            invoice['Key'] = keys['Key']
+            invoice['Size'] = keys['Size']
+            invoice['LastModified'] = keys['LastModified'].isoformat()
+            invoices.append(invoice)
+
+            if len(invoices) == limit:
+                return invoices, encode_list_cursor(lastKey)
+
+        if not response.get('IsTruncated'):
+            return invoices, None
+
+        listArgs['StartAfter'] = lastKey
+
+    # Out of list calls for this request, carry on from the last key read
+    return invoices, encode_list_cursor(lastKey)
+
+
+# Object metadata written with every invoice so the index can be rebuilt from
+# the bucket alone. Values are url quoted as s3 metadata must be ascii
+def invoice_metadata(invoiceRequest, contentHash):
+    metadata = {}
+    metadata['content-hash'] = contentHash
+    metadata['forename'] = quote(str(invoiceRequest['forename']))
+    metadata['surname'] = quote(str(invoiceRequest['surname']))
+    metadata['yearmonth'] = quote(str(invoiceRequest['yearMonth']))
+    return metadata
+
+
+# Index entries are keyed on client (forename followed by surname, as in the
+# object key) and sorted on year month then creation time, so the latest
+# invoice for a month is the first item of a descending query. The key's hash
+# is added to the sort key so invoices made in the same second stay separate
+def build_index_entry(client, yearMonth, created, upload_file, size, contentHash, renderMs):
+    keyEnd = invoiceKeyEndPattern.search(upload_file)
+    indexEntry = {}
+    indexEntry['client'] = client
+    indexEntry['invoice_sort'] = f'{yearMonth}#{created}'
+    if keyEnd is not None and keyEnd.group('hash'):
+        indexEntry['invoice_sort'] += '#' + keyEnd.group('hash')
+    indexEntry['year_month'] = yearMonth
+    indexEntry['created'] = created
+    indexEntry['object_key'] = upload_file
+    indexEntry['size'] = size
+    if contentHash:
+        indexEntry['content_hash'] = contentHash
+    if renderMs is not None:
+        indexEntry['render_ms'] = Decimal(str(renderMs))
+    return indexEntry
+
+
+# Goes through the resource's client like bump_collection_version, so batch
+# threads can call it at the same time
+def index_invoice(invoiceRequest, upload_file, created, contentHash, renderTiming):
+    dynamo.meta.client.put_item(TableName=indexTable.name, Item=build_index_entry(
+        f"{invoiceRequest['forename']}{invoiceRequest['surname']}",
+        invoiceRequest['yearMonth'],
+        created,
+        upload_file,
+        renderTiming['pdf_bytes'],
+        contentHash,
+        renderTiming['render_ms']))
+
+
+# DynamoDB returns numbers as Decimal which json can not serialise
+def index_entry_to_json(indexEntry):
+    invoice = {}
+    invoice['client'] = indexEntry['client']
+    invoice['yearmonth'] = indexEntry['year_month']
+    invoice['created'] = indexEntry['created']
+    invoice['Key'] = indexEntry['object_key']
+    invoice['Size'] = int(indexEntry['size'])
+    invoice['content_hash'] = indexEntry.get('content_hash')
+    if 'render_ms' in indexEntry:
+        invoice['render_ms'] = float(indexEntry['render_ms'])
+    return invoice
+
+
+def encode_index_cursor(lastEvaluatedKey):
+    return base64.urlsafe_b64encode(json.dumps(lastEvaluatedKey).encode('utf-8')).decode('ascii')
+
+
+def decode_index_cursor(cursor):
+    lastEvaluatedKey = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    if not isinstance(lastEvaluatedKey, dict) or set(lastEvaluatedKey) != {'client', 'invoice_sort'}:
+        raise ValueError('cursor is not an index key')
+    return lastEvaluatedKey
+
+
+# Keys written before the index existed have no metadata, so the client, year
+# month and timestamp are recovered from the key itself with invoiceKeyPattern
+def rebuild_index_entry(objectSummary):
+    objectKey = objectSummary['Key']
+    keyEnd = invoiceKeyEndPattern.search(objectKey)
+    if keyEnd is None:
+        return None
+    created = keyEnd.group('created')
+    head = s3.head_object(Bucket=bucket, Key=objectKey)
+    metadata = head.get('Metadata', {})
+
+    if 'forename' in metadata and 'surname' in metadata and 'yearmonth' in metadata:
+        client = unquote(metadata['forename']) + unquote(metadata['surname'])
+        yearMonth = unquote(metadata['yearmonth'])
+    else:
+        match = invoiceKeyPattern.match(objectKey)
+        if match is None:
+            return None
+        client = match.group('client')
+        yearMonth = match.group('yearmonth')
+
+    return build_index_entry(client, yearMonth, created, objectKey, objectSummary['Size'],
+                             metadata.get('content-hash'), None)
+
+
+# Backfill the index from every invoice in the bucket. Stops with a cursor
+# when the lambda is close to timing out so the rebuild can be resumed
+def rebuild_invoice_index(context, startAfter=None):
+    rebuildResult = {'indexed': 0, 'skipped': 0, 'complete': False, 'start_after': startAfter}
+    listArgs = {'Bucket': bucket, 'Prefix': invoicesPrefix}
+    if startAfter:
+        listArgs['StartAfter'] = startAfter
+
+    with indexTable.batch_writer(overwrite_by_pkeys=['client', 'invoice_sort']) as batch:
+        for page in s3.get_paginator('list_objects_v2').paginate(**listArgs):
+            for objectSummary in page.get('Contents', []):
+                if context is not None and context.get_remaining_time_in_millis() < 10000:
+                    return rebuildResult
+
+                rebuildResult['start_after'] = objectSummary['Key']
+                if objectSummary['Key'] == invoicesPrefix:
+                    continue
+
+                indexEntry = rebuild_index_entry(objectSummary)
+                if indexEntry is None:
+                    rebuildResult['skipped'] += 1
+                    continue
+
+                batch.put_item(Item=indexEntry)
+                rebuildResult['indexed'] += 1
+
+    rebuildResult['complete'] = True
+    rebuildResult['start_after'] = None
+    return rebuildResult
+
+
+# Small thread safe least recently used cache for warm containers
+class LRUCache:
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxSize:
+                self.items.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def __len__(self):
+        return len(self.items)
+
+
+renderCache = LRUCache(renderCacheSize)
+renderCacheStats = {'memory_hits': 0, 's3_hits': 0, 'misses': 0}
+renderCacheStatsLock = threading.Lock()
+
+
+def count_render_cache(outcome):
+    with renderCacheStatsLock:
+        renderCacheStats[outcome] += 1
+
+
+# Only line endings and whitespace at the end of lines are evened out before
+# hashing, as those never show on the page. Any other whitespace can, between
+# inline tags or inside <pre>, so html that differs there is rendered again
+def normalise_html(html_string):
+    lines = html_string.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(line.rstrip() for line in lines).strip('\n')
+
+
+# The cache key covers the html, the wkhtmltopdf options actually used, and
+# the client and month so a hit never returns another client's invoice
+def render_cache_key(invoiceRequest):
+    keySource = {}
+    keySource['html'] = normalise_html(invoiceRequest['html_string'])
+    keySource['options'] = invoiceRequest['wkhtmltopdf_options']
+    keySource['invoice'] = [invoiceRequest['forename'], invoiceRequest['surname'], invoiceRequest['yearMonth']]
+    return hashlib.sha256(json.dumps(keySource, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Look the content hash up in memory first and then in s3. The s3 pointer is
+# only trusted if the invoice it points at still exists
+def lookup_render_cache(contentHash):
+    upload_file = renderCache.get(contentHash)
+    if upload_file is not None:
+        count_render_cache('memory_hits')
+        return upload_file, 'memory'
+
+    try:
+        pointer = s3.get_object(Bucket=bucket, Key=renderCachePrefix + contentHash)
+        upload_file = json.loads(pointer['Body'].read())['Key']
+        s3.head_object(Bucket=bucket, Key=upload_file)
+    except ClientError as error:
+        if error.response['Error']['Code'] not in ('NoSuchKey', '404', 'NotFound'):
+            raise
+        count_render_cache('misses')
+        return None, None
+
+    renderCache.put(contentHash, upload_file)
+    count_render_cache('s3_hits')
+    return upload_file, 's3'
+
+
+def store_render_cache(contentHash, upload_file):
+    s3.put_object(Bucket=bucket, Key=renderCachePrefix + contentHash,
+                  Body=json.dumps({'Key': upload_file}).encode('utf-8'),
+                  ContentType='application/json')
+    renderCache.put(contentHash, upload_file)
+
+
+presignCache = LRUCache(presignCacheSize)
+
+
+# Keys are normally supplied without the invoices folder, as returned by the
+# original listing, but full keys from the paginated listing are accepted too
+def invoice_object_key(objectKey):
+    if objectKey.startswith(invoicesPrefix):
+        return objectKey
+    return f'{invoicesPrefix}{objectKey}'
+
+
+# Return a presigned download url and when it expires. Signing is skipped if
+# a url for the same key and expiry still has enough of its lifetime left
+def presign_invoice(objectKey, expiresIn):
+    fullKey = invoice_object_key(objectKey)
+    now = time.time()
+
+    cached = presignCache.get((fullKey, expiresIn))
+    if cached is not None and cached[1] - now >= expiresIn * presignMinRemaining:
+        return cached
+
+    url = s3.generate_presigned_url('get_object',
+                                    Params={'Bucket': bucket,
+                                            'Key': fullKey},
+                                    ExpiresIn=expiresIn)
+    signed = (url, int(now) + expiresIn)
+    presignCache.put((fullKey, expiresIn), signed)
+    return signed
+
+
+def read_presign_expiry(value):
+    if value is None:
+        return presignDefaultExpiry
+    expiresIn = int(value)
+    if expiresIn < 1 or expiresIn > presignMaxExpiry:
+        raise ValueError(f'expires must be between 1 and {presignMaxExpiry} seconds')
+    return expiresIn
+
+
+class TemplateError(Exception):
+    pass
+
+
+# An invoice template compiled once into text, field and section nodes.
+# {{ name }} inserts an escaped field, dotted names reach into nested data,
+# and {{#lines}}...{{/lines}} repeats for each item of a list or is shown
+# once if the value is any other true value
+class InvoiceTemplate:
+
+    def __init__(self, source):
+        self.nodes = self.compile(source)
+
+    @staticmethod
+    def compile(source):
+        nodes = []
+        openSections = [('', nodes)]
+        position = 0
+
+        for match in templateTagPattern.finditer(source):
+            if match.start() > position:
+                openSections[-1][1].append(('text', source[position:match.start()]))
+            position = match.end()
+
+            marker, name = match.groups()
+            path = tuple(name.split('.'))
+
+            if marker == '#':
+                children = []
+                openSections[-1][1].append(('section', path, children))
+                openSections.append((name, children))
+            elif marker == '/':
+                if openSections[-1][0] != name:
+                    raise TemplateError(f'Unexpected end of section {name} in template')
+                openSections.pop()
+            else:
+                openSections[-1][1].append(('field', path))
+
+        if len(openSections) > 1:
+            raise TemplateError(f'Section {openSections[-1][0]} is not closed in template')
+
+        if position < len(source):
+            nodes.append(('text', source[position:]))
+
+        return nodes
+
+    # Names are looked up in the innermost section item first and then outwards
+    @staticmethod
+    def lookup(path, scopes, required):
+        for scope in reversed(scopes):
+            if isinstance(scope, dict) and path[0] in scope:
+                value = scope[path[0]]
+                for name in path[1:]:
+                    if not isinstance(value, dict) or name not in value:
+                        break
+                    value = value[name]
+                else:
+                    return value
+
+        if required:
+            raise TemplateError(f"Missing {'.'.join(path)} from template_data.")
+        return None
+
+    def render_nodes(self, nodes, scopes, parts):
+        for node in nodes:
+            if node[0] == 'text':
+                parts.append(node[1])
+            elif node[0] == 'field':
+                parts.append(html.escape(str(self.lookup(node[1], scopes, True)), quote=True))
+            else:
+                value = self.lookup(node[1], scopes, False)
+                if isinstance(value, list):
+                    for item in value:
+                        self.render_nodes(node[2], scopes + [item], parts)
+                elif value:
+                    self.render_nodes(node[2], scopes, parts)
+
+    def render(self, data):
+        parts = []
+        self.render_nodes(self.nodes, [data], parts)
+        return ''.join(parts)
+
+
+# Compiled templates are kept for the life of the container
+@functools.lru_cache(maxsize=templateCacheSize)
+def load_template(templateID, templateVersion):
+    if not templateNamePattern.match(templateID) or not templateNamePattern.match(templateVersion):
+        raise TemplateError('template_id and template_version can only contain letters, numbers, - and _.')
+
+    bundledTemplate = os.path.join(templatePath, templateID, f'{templateVersion}.html')
+    if os.path.exists(bundledTemplate):
+        with open(bundledTemplate) as f:
+            return InvoiceTemplate(f.read())
+
+    try:
+        templateObject = s3.get_object(Bucket=bucket, Key=f'{templatePrefix}{templateID}/{templateVersion}.html')
+    except ClientError as error:
+        if error.response['Error']['Code'] not in ('NoSuchKey', '404', 'NotFound'):
+            raise
+        raise TemplateError(f'Template {templateID} version {templateVersion} does not exist.')
+
+    return InvoiceTemplate(templateObject['Body'].read().decode('utf-8'))
+
+
+def render_invoice_template(templateID, templateVersion, templateData):
+    if not isinstance(templateData, dict):
+        raise TemplateError('template_data must be an object.')
+    return load_template(templateID, templateVersion).render(templateData)
+
+
+class InvoiceRequestError(Exception):
+    pass
+
+
+# Check a create invoice request has everything needed to populate the pdf
+# file, rendering the template if one is named, and map any
+# wkhtmltopdf_options supplied. These are optional
+def read_invoice_request(loadedEvent):
+    invoiceRequest = {}
+
+    if not isinstance(loadedEvent, dict):
+        raise InvoiceRequestError('Missing html_string from request.')
+
+    # Either the full html_string or a template_id with template_data is needed
+    if 'template_id' in loadedEvent and 'html_string' not in loadedEvent:
+        try:
+            invoiceRequest['html_string'] = render_invoice_template(
+                loadedEvent['template_id'],
+                loadedEvent.get('template_version', templateDefaultVersion),
+                loadedEvent.get('template_data', {}))
+        except TemplateError as error:
+            raise InvoiceRequestError(str(error))
+
+    for field, name in (('html_string', 'html_string'), ('forename', 'forename'),
+                        ('surname', 'surname'), ('yearmonth', 'yearMonth')):
+        if name in invoiceRequest:
+            continue
+        if field not in loadedEvent:
+            raise InvoiceRequestError(f'Missing {field} from request.')
+        invoiceRequest[name] = loadedEvent[field]
+
+    invoiceRequest['wkhtmltopdf_options'] = {}
+    if 'wkhtmltopdf_options' in loadedEvent:
+        invoiceRequest['wkhtmltopdf_options'] = map_wkhtmltopdf_options(loadedEvent['wkhtmltopdf_options'])
+
+    # no_cache forces a fresh render even if an identical invoice exists
+    invoiceRequest['use_cache'] = loadedEvent.get('no_cache') is not True
+
+    return invoiceRequest
+
+
+# Render the invoice and upload it to s3, returning the object key and timings.
+# An identical earlier invoice is returned from the cache without rendering
+def create_invoice(invoiceRequest):
+
+    contentHash = render_cache_key(invoiceRequest)
+    if invoiceRequest['use_cache']:
+        upload_file, cacheTier = lookup_render_cache(contentHash)
+        if upload_file is not None:
+            renderTiming = {'mode': 'cache', 'cache': cacheTier, 'render_ms': 0, 'upload_ms': 0}
+            print(json.dumps({'event': 'invoice_cached', 'key': upload_file, **renderTiming}))
+            return upload_file, renderTiming
+
+    dateTimeStamp = datetime.now()
+    dateTimeString = dateTimeStamp.strftime("%Y%m%d%H%M%S")
+    upload_file = (f"invoices/{invoiceRequest['forename']}{invoiceRequest['surname']}"
+                   f"{invoiceRequest['yearMonth']}-{dateTimeString}-{contentHash[:invoiceKeyHashLength]}.pdf")
+
+    metadata = invoice_metadata(invoiceRequest, contentHash)
+
+    renderTiming = None
+    if renderMode == 'stream':
+        try:
+            renderTiming = stream_invoice_to_s3(invoiceRequest, upload_file, metadata)
+        except (RenderError, OSError, subprocess.TimeoutExpired) as error:
+            print(json.dumps({'event': 'render_stream_failed', 'key': upload_file, 'error': str(error)}))
+
+    if renderTiming is None:
+        renderTiming = upload_invoice_from_file(invoiceRequest, upload_file, metadata)
+
+    store_render_cache(contentHash, upload_file)
+
+    # The index is only an optimisation for lookups, a failed write is logged
+    # and repaired by the rebuild_invoice_index action rather than failing
+    # an invoice that has already been uploaded
+    try:
+        index_invoice(invoiceRequest, upload_file, dateTimeString, contentHash, renderTiming)
+    except ClientError as error:
+        print(json.dumps({'event': 'invoice_index_failed', 'key': upload_file, 'error': str(error)}))
+
+    # A failed bump only means listings can be answered with 304 until the
+    # next invoice is created
+    try:
+        bump_collection_version(invoicesCollection)
+    except ClientError as error:
+        print(json.dumps({'event': 'invoice_version_failed', 'key': upload_file, 'error': str(error)}))
+
+    print(json.dumps({'event': 'invoice_created', 'key': upload_file, **renderTiming}))
+
+    return upload_file, renderTiming
+
+
+# Read one batch item and work out its content hash. An item that can not be
+# read gets its result straight away instead
+def read_batch_item(index, loadedItem):
+    result = {}
+    result['index'] = index
+
+    try:
+        invoiceRequest = read_invoice_request(loadedItem)
+        return invoiceRequest, render_cache_key(invoiceRequest), None
+    except InvoiceRequestError as error:
+        result['status'] = 'invalid'
+        result['error'] = str(error)
+    except Exception as error:
+        result['status'] = 'failed'
+        result['error'] = str(error)
+    return None, None, result
+
+
+# Create one invoice from a batch, recording the outcome rather than raising
+# so a single bad item does not fail the rest of the batch
+def create_batch_invoice(index, invoiceRequest):
+    result = {}
+    result['index'] = index
+
+    try:
+        upload_file, renderTiming = create_invoice(invoiceRequest)
+    except Exception as error:
+        result['status'] = 'failed'
+        result['error'] = str(error)
+        return result
+
+    result['status'] = 'cached' if renderTiming['mode'] == 'cache' else 'created'
+    result['key'] = upload_file
+    result['render_ms'] = renderTiming['render_ms']
+    result['upload_ms'] = renderTiming['upload_ms']
+    return result
+
+
+# Render a batch of invoices. Each thread drives its own render worker and
+# upload, so renders and uploads for different invoices overlap
+# Items that would make the same invoice are rendered once, the repeats are
+# reported as duplicates of the first with its key
+def create_invoice_batch(invoiceItems, concurrency):
+
+    # Streamed renders run their own wkhtmltopdf, so the pool is only grown
+    # when renders go through the file path
+    if renderMode == 'file':
+        renderPool.ensure_size(concurrency)
+
+    results = [None] * len(invoiceItems)
+    firstIndexes = {}
+    duplicateIndexes = []
+    createIndexes = []
+    createRequests = []
+    for index, loadedItem in enumerate(invoiceItems):
+        invoiceRequest, contentHash, result = read_batch_item(index, loadedItem)
+        if result is not None:
+            results[index] = result
+        elif contentHash in firstIndexes:
+            duplicateIndexes.append((index, firstIndexes[contentHash]))
+        else:
+            firstIndexes[contentHash] = index
+            createIndexes.append(index)
+            createRequests.append(invoiceRequest)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for result in executor.map(create_batch_invoice, createIndexes, createRequests):
+            results[result['index']] = result
+
+    # A repeat of an item that failed is reported as failed too
+    for index, firstIndex in duplicateIndexes:
+        result = {}
+        result['index'] = index
+        result['duplicate_of'] = firstIndex
+        if 'key' in results[firstIndex]:
+            result['status'] = 'duplicate'
+            result['key'] = results[firstIndex]['key']
+        else:
+            result['status'] = results[firstIndex]['status']
+            result['error'] = results[firstIndex]['error']
+        results[index] = result
+
+    return results
 
 
 def lambda_handler(event, context):
 
+    # Scheduled warm up call. Starts the render workers if renders use the
+    # file path, restarts any that have crashed since the last invocation and
+    # reports cache use
+    if event.get('action') == 'render_health':
+        with renderCacheStatsLock:
+            cacheStats = dict(renderCacheStats)
+        cacheStats['memory_entries'] = len(renderCache)
+        return {'workers': renderPool.health_check(renderMode == 'file'), 'cache': cacheStats}
+
+    # Backfill the invoice index from the bucket. Pass start_after from the
+    # previous result to carry on from where a timed out rebuild stopped
+    if event.get('action') == 'rebuild_invoice_index':
+        return rebuild_invoice_index(context, event.get('start_after'))
+
     # Ensure calling method and api paths supplied are correct
     if event['httpMethod'] == "POST" and event['path'] == createPath:
 
@@ -27,11 +1152,11 @@ def lambda_handler(event, context):
         else:
             loadedEvent = event
 
-        # html_string is required to create the pdf file
+        # html_string, forename, surname and yearmonth are required to create the pdf file
         try:
-            html_string = loadedEvent['html_string']
-        except KeyError:
-            error_message = ('Missing html_string from request.')
+            invoiceRequest = read_invoice_request(loadedEvent)
+        except InvoiceRequestError as error:
+            error_message = str(error)
 
             responseObject = {}
             responseObject['statusCode'] = '400'
@@ -39,11 +1164,42 @@ def lambda_handler(event, context):
             responseObject['body'] = json.dumps(error_message)
             return responseObject
 
-        # forename is required to populate the pdf file
+        upload_file, renderTiming = create_invoice(invoiceRequest)
+
+        error_message = "Successfully created invoice"
+
+        responseObject = {}
+        responseObject['statusCode'] = '200'
+        responseObject['headers'] = {}
+        responseObject['headers']['X-Invoice-Key'] = upload_file
+        responseObject['headers']['X-Render-Mode'] = renderTiming['mode']
+        responseObject['headers']['X-Render-Time-Ms'] = str(renderTiming['render_ms'])
+        responseObject['body'] = "Call to create invoice was successful"
+        return responseObject
+
+    # Ensure calling method and api paths supplied are correct
+    if event['httpMethod'] == "POST" and event['path'] == batchCreatePath:
+
+        # Check to see if call is from test or other lambda.
+        # If through api gateway need to use json.load
+        try:
+            fromLambdaFlag = event['from_lambda']
+        except:
+            fromLambdaFlag = False
+
+        if fromLambdaFlag is False:
+            loadedEvent = json.loads(event['body'])
+        else:
+            loadedEvent = event
+
+        # invoices is required and holds one create invoice request per item
         try:
-            forename = loadedEvent['forename']
+            invoiceItems = loadedEvent['invoices']
         except:
-            error_message = ('Missing forename from request.')
+            invoiceItems = None
+
+        if not isinstance(invoiceItems, list) or len(invoiceItems) == 0:
+            error_message = ('Missing invoices list from request.')
 
             responseObject = {}
             responseObject['statusCode'] = '400'
@@ -51,11 +1207,8 @@ def lambda_handler(event, context):
             responseObject['body'] = json.dumps(error_message)
             return responseObject
 
-        # surname is required to populate the pdf file
-        try:
-            surname = loadedEvent['surname']
-        except:
-            error_message = ('Missing surname from request.')
+        if len(invoiceItems) > batchMaxItems:
+            error_message = (f'A batch can contain at most {batchMaxItems} invoices.')
 
             responseObject = {}
             responseObject['statusCode'] = '400'
@@ -63,11 +1216,11 @@ def lambda_handler(event, context):
             responseObject['body'] = json.dumps(error_message)
             return responseObject
 
-        # The month and year of invoice is required to populate the pdf file
+        # concurrency is optional but can not go above the configured cap
         try:
-            yearMonth = loadedEvent['yearmonth']
-        except:
-            error_message = ('Missing yearmonth from request.')
+            concurrency = int(loadedEvent.get('concurrency', batchMaxConcurrency))
+        except (TypeError, ValueError):
+            error_message = ('concurrency must be a number.')
 
             responseObject = {}
             responseObject['statusCode'] = '400'
@@ -75,84 +1228,169 @@ def lambda_handler(event, context):
             responseObject['body'] = json.dumps(error_message)
             return responseObject
 
-        # Now we can check for the option wkhtmltopdf_options and map them to values. This is optional
-        wkhtmltopdf_options = {}
-        if 'wkhtmltopdf_options' in loadedEvent:
-            if 'margin' in loadedEvent['wkhtmltopdf_options']:
-                margins = loadedEvent['wkhtmltopdf_options']['margin'].split(' ')
-                if len(margins) == 4:
-                    wkhtmltopdf_options['margin-top'] = margins[0]
-                    wkhtmltopdf_options['margin-right'] = margins[1]
-                    wkhtmltopdf_options['margin-bottom'] = margins[2]
-                    wkhtmltopdf_options['margin-left'] = margins[3]
+        concurrency = max(1, min(concurrency, batchMaxConcurrency, len(invoiceItems)))
+
+        results = create_invoice_batch(invoiceItems, concurrency)
 
-            if 'orientation' in loadedEvent['wkhtmltopdf_options']:
-                wkhtmltopdf_options['orientation'] = 'portrait'
+        batchResult = {}
+        batchResult['created'] = sum(1 for result in results if result['status'] == 'created')
+        batchResult['cached'] = sum(1 for result in results if result['status'] == 'cached')
+        batchResult['duplicates'] = sum(1 for result in results if result['status'] == 'duplicate')
+        batchResult['failed'] = (len(results) - batchResult['created'] - batchResult['cached']
+                                 - batchResult['duplicates'])
+        batchResult['concurrency'] = concurrency
+        batchResult['results'] = results
 
-                if loadedEvent['wkhtmltopdf_options']['orientation'].lower() == 'landscape':
-                    wkhtmltopdf_options['orientation'] = 'landscape'
+        # 207 tells the caller to check the results as some invoices failed
+        responseObject = {}
+        responseObject['statusCode'] = '200' if batchResult['failed'] == 0 else '207'
+        responseObject['headers'] = {}
+        responseObject['body'] = json.dumps(batchResult)
+        return responseObject
 
-            if 'title' in loadedEvent['wkhtmltopdf_options']:
-                wkhtmltopdf_options['title'] = loadedEvent['wkhtmltopdf_options']['title']
+    # Ensure calling method and api paths supplied are correct
+    if event['httpMethod'] == "GET" and event['path'] == createPath:
 
-        # Write the HTML string to a tmp file
-        dateTimeStamp = datetime.now()
-        dateTimeString = dateTimeStamp.strftime("%Y%m%d%H%M%S")
-        local_filename = f'/tmp/{forename}{surname}{yearMonth}-{dateTimeString}.html'
-        upload_file = f'invoices/{forename}{surname}{yearMonth}-{dateTimeString}.pdf'
+        queryParameters = event.get('queryStringParameters') or {}
 
-        # Delete any existing files with that name
+        # limit is optional and sets how many invoices are returned per page
         try:
-            os.unlink(local_filename)
-        except FileNotFoundError:
-            pass
+            limit = int(queryParameters.get('limit', listDefaultLimit))
+        except ValueError:
+            limit = 0
 
-        with open(local_filename, 'w') as f:
-            f.write(html_string)
+        if limit < 1 or limit > listMaxLimit:
+            error_message = (f'limit must be between 1 and {listMaxLimit}.')
 
-        # Now we can create our command string to execute and upload the result to s3
-        command = 'wkhtmltopdf  --load-error-handling ignore'  # ignore unecessary errors
-        for key, value in wkhtmltopdf_options.items():
-            if key == 'title':
-                value = f'"{value}"'
-            command += ' --{0} {1}'.format(key, value)
-        command += ' {0} {1}'.format(local_filename, local_filename.replace('.html', '.pdf'))
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(error_message)
+            return responseObject
 
-        # Run the command
-        subprocess.run(command, shell=True)
+        # cursor is optional and comes from the previous page
+        cursor = None
+        if queryParameters.get('cursor'):
+            try:
+                cursor = decode_list_cursor(queryParameters['cursor'])
+            except ValueError:
+                error_message = ('Invalid cursor supplied.')
 
-        # Upload the pdf
-        s3.upload_file(Filename=local_filename.replace('.html', '.pdf'), Bucket=bucket, Key=upload_file)
+                responseObject = {}
+                responseObject['statusCode'] = '400'
+                responseObject['headers'] = {}
+                responseObject['body'] = json.dumps(error_message)
+                return responseObject
 
-        error_message = "Successfully created invoice"
+        # The version is read before the bucket, so a page is never tagged
+        # with a version newer than its contents
+        etag = None
+        try:
+            etag = request_etag(invoicesCollection, read_collection_version(invoicesCollection), event)
+        except ClientError as error:
+            print(json.dumps({'event': 'invoice_version_read_failed', 'error': str(error)}))
+
+        if etag is not None and etag_matches(event, etag):
+            return not_modified_response(etag)
+
+        # client (forename followed by surname) and yearmonth are optional filters
+        invoices, nextCursor = list_invoices(limit, cursor,
+                                             client=queryParameters.get('client'),
+                                             yearMonth=queryParameters.get('yearmonth'))
+
+        returnKeys = {}
+        returnKeys['invoices'] = invoices
+        returnKeys['cursor'] = nextCursor
+
+        responseObject = {}
+        responseObject['statusCode'] = '200'
+        responseObject['headers'] = {'ETag': etag} if etag is not None else {}
+        responseObject['body'] = json.dumps(returnKeys)
+        return responseObject
+
+    # Ensure calling method and api paths supplied are correct
+    if event['httpMethod'] == "GET" and event['path'] == latestInvoicePath:
+
+        queryParameters = event.get('queryStringParameters') or {}
+
+        # client and yearmonth are required to find the invoice
+        try:
+            client = queryParameters['client']
+            yearMonth = queryParameters['yearmonth']
+        except KeyError:
+            error_message = ('Missing client or yearmonth from request.')
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(error_message)
+            return responseObject
+
+        # Newest first so the first entry is the latest invoice for the month
+        response = indexTable.query(KeyConditionExpression=Key('client').eq(client) &
+                                    Key('invoice_sort').begins_with(f'{yearMonth}#'),
+                                    ScanIndexForward=False,
+                                    Limit=1)
+
+        if len(response['Items']) == 0:
+            error_message = ('No invoice found for that client and yearmonth.')
+
+            responseObject = {}
+            responseObject['statusCode'] = '404'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(error_message)
+            return responseObject
 
         responseObject = {}
         responseObject['statusCode'] = '200'
         responseObject['headers'] = {}
-        responseObject['body'] = "Call to create invoice was successful"
+        responseObject['body'] = json.dumps(index_entry_to_json(response['Items'][0]))
         return responseObject
 
     # Ensure calling method and api paths supplied are correct
-    if event['httpMethod'] == "GET" and event['path'] == createPath:
+    if event['httpMethod'] == "GET" and event['path'] == clientInvoicesPath:
 
-        returnKeys = {}
-        keyNumber = 1
+        queryParameters = event.get('queryStringParameters') or {}
+
+        # client is required, limit and cursor are optional
+        try:
+            client = queryParameters['client']
+        except KeyError:
+            error_message = ('Missing client from request.')
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(error_message)
+            return responseObject
 
-        # Loop through bucket and only return files in the invoices folder
-        for keys in s3.list_objects(Bucket=bucket)['Contents']:
+        try:
+            limit = int(queryParameters.get('limit', listDefaultLimit))
+            queryArgs = {}
+            if queryParameters.get('cursor'):
+                queryArgs['ExclusiveStartKey'] = decode_index_cursor(queryParameters['cursor'])
+        except ValueError:
+            limit = 0
 
-            checkDir = keys['Key'].split('/')[0]
+        if limit < 1 or limit > listMaxLimit:
+            error_message = (f'limit must be between 1 and {listMaxLimit} and cursor must come from a previous page.')
 
-            try:
-                checkFile = keys['Key'].split('/')[1]
-            except:
-                checkFile = None
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(error_message)
+            return responseObject
 
-            if checkDir == "invoices":
-                if checkFile != "" or None:
-                    returnKeys[f'Key{keyNumber}'] = {}
-                    returnKeys[f'Key{keyNumber}']['Key'] = keys['Key']
-                    keyNumber += 1
+        response = indexTable.query(KeyConditionExpression=Key('client').eq(client),
+                                    ScanIndexForward=False,
+                                    Limit=limit,
+                                    **queryArgs)
+
+        returnKeys = {}
+        returnKeys['invoices'] = [index_entry_to_json(indexEntry) for indexEntry in response['Items']]
+        returnKeys['cursor'] = None
+        if 'LastEvaluatedKey' in response:
+            returnKeys['cursor'] = encode_index_cursor(response['LastEvaluatedKey'])
 
         responseObject = {}
         responseObject['statusCode'] = '200'
@@ -175,10 +1413,19 @@ def lambda_handler(event, context):
             responseObject['body'] = json.dumps(error_message)
             return responseObject
 
-        response = s3.generate_presigned_url('get_object',
-                                             Params={'Bucket': bucket,
-                                                     'Key': f'invoices/{objectKey}'},
-                                             ExpiresIn=120)
+        # expires is optional and defaults to two minutes
+        try:
+            expiresIn = read_presign_expiry(event['queryStringParameters'].get('expires'))
+        except ValueError:
+            error_message = (f'expires must be between 1 and {presignMaxExpiry} seconds.')
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(error_message)
+            return responseObject
+
+        response, expiresAt = presign_invoice(objectKey, expiresIn)
 
         responseObject = {}
         responseObject['statusCode'] = '200'
@@ -186,6 +1433,63 @@ def lambda_handler(event, context):
         responseObject['body'] = json.dumps(response)
         return responseObject
 
+    # Ensure calling method and api paths supplied are correct
+    if event['httpMethod'] == "POST" and event['path'] == bulkDownloadPath:
+
+        # Check to see if call is from test or other lambda.
+        # If through api gateway need to use json.load
+        try:
+            fromLambdaFlag = event['from_lambda']
+        except:
+            fromLambdaFlag = False
+
+        if fromLambdaFlag is False:
+            loadedEvent = json.loads(event['body'])
+        else:
+            loadedEvent = event
+
+        # keys is required and holds the object keys to sign
+        try:
+            objectKeys = loadedEvent['keys']
+        except:
+            objectKeys = None
+
+        if (not isinstance(objectKeys, list) or len(objectKeys) == 0 or len(objectKeys) > bulkDownloadMaxKeys
+                or not all(isinstance(objectKey, str) for objectKey in objectKeys)):
+            error_message = (f'keys must be a list of between 1 and {bulkDownloadMaxKeys} object keys.')
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(error_message)
+            return responseObject
+
+        # expires is optional and defaults to two minutes
+        try:
+            expiresIn = read_presign_expiry(loadedEvent.get('expires'))
+        except (TypeError, ValueError):
+            error_message = (f'expires must be between 1 and {presignMaxExpiry} seconds.')
+
+            responseObject = {}
+            responseObject['statusCode'] = '400'
+            responseObject['headers'] = {}
+            responseObject['body'] = json.dumps(error_message)
+            return responseObject
+
+        returnUrls = {}
+        returnUrls['urls'] = {}
+        returnUrls['expires_at'] = {}
+        for objectKey in objectKeys:
+            url, expiresAt = presign_invoice(objectKey, expiresIn)
+            returnUrls['urls'][objectKey] = url
+            returnUrls['expires_at'][objectKey] = expiresAt
+
+        responseObject = {}
+        responseObject['statusCode'] = '200'
+        responseObject['headers'] = {}
+        responseObject['body'] = json.dumps(returnUrls)
+        return responseObject
+
     # Return error if called with correct method or path
     error = {}
     error["Code"] = "1"
@@ -0,0 +1,300 @@
+# Runs the InvoiceDetails export against moto's DynamoDB and s3
+import csv
+import gzip
+import importlib.util
+import io
+import json
+import os
+from decimal import Decimal
+
+import boto3
+import moto.s3.models
+import pytest
+from moto import mock_aws
+
+functionPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                            'lambda_functions', 'AddInvoiceDetails', 'lambda_function.py')
+
+
+@pytest.fixture
+def invoices(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('INVOICE_JOB_QUEUE', 'local')
+    # Lets the export upload small parts so a resume can be tested quickly
+    monkeypatch.setattr(moto.s3.models, 'S3_UPLOAD_PART_MIN_SIZE', 1)
+
+    with mock_aws():
+        dynamo = boto3.client('dynamodb')
+        dynamo.create_table(TableName='InvoiceDetails',
+                            KeySchema=[{'AttributeName': 'client_id', 'KeyType': 'HASH'},
+                                       {'AttributeName': 'year_month', 'KeyType': 'RANGE'}],
+                            AttributeDefinitions=[{'AttributeName': name, 'AttributeType': 'S'}
+                                                  for name in ('client_id', 'year_month', 'invoice_status')],
+                            GlobalSecondaryIndexes=[{'IndexName': 'invoice_status-index',
+                                                     'KeySchema': [{'AttributeName': 'invoice_status',
+                                                                    'KeyType': 'HASH'},
+                                                                   {'AttributeName': 'year_month',
+                                                                    'KeyType': 'RANGE'}],
+                                                     'Projection': {'ProjectionType': 'ALL'}}],
+                            BillingMode='PAY_PER_REQUEST')
+        dynamo.create_table(TableName='InvoiceSummary',
+                            KeySchema=[{'AttributeName': 'year_month', 'KeyType': 'HASH'}],
+                            AttributeDefinitions=[{'AttributeName': 'year_month', 'AttributeType': 'S'}],
+                            BillingMode='PAY_PER_REQUEST')
+        boto3.client('s3').create_bucket(Bucket='lwbespokeinvoices')
+
+        spec = importlib.util.spec_from_file_location('add_invoice_details', functionPath)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        monkeypatch.setattr(module, 'invoke_store_invoices', lambda inputToLambda: {'statusCode': '200'})
+        yield module
+
+
+def read_export(invoices, key):
+    body = boto3.client('s3').get_object(Bucket=invoices.exportBucket, Key=key)['Body'].read()
+    return list(csv.DictReader(io.StringIO(gzip.decompress(body).decode('utf-8'))))
+
+
+def test_export_resumes_from_a_json_checkpoint(invoices, monkeypatch):
+    for number in range(5):
+        invoices.table.put_item(Item={'client_id': f'client{number}', 'year_month': '202210',
+                                      'forename': 'Ada', 'surname': 'Lovelace', 'invoice_status': 'paid',
+                                      'amount': Decimal('12.50')})
+    monkeypatch.setattr(invoices, 'exportPartSize', 1)
+
+    # Stop after two pages, each of which is uploaded as its own part
+    pagesLeft = [2]
+
+    def stillHasTime():
+        pagesLeft[0] -= 1
+        return pagesLeft[0] >= 0
+
+    checkpoint = invoices.export_segment('test', 0, 1, 1, 0, stillHasTime)
+    assert not checkpoint['complete'] and checkpoint['rows'] == 2
+    assert json.loads(json.dumps(checkpoint['last_evaluated_key'])) == checkpoint['last_evaluated_key']
+
+    checkpoint = invoices.export_segment('test', 0, 1, 1, 0, lambda: True)
+    assert checkpoint['complete'] and checkpoint['rows'] == 5
+
+    rows = read_export(invoices, checkpoint['key'])
+    assert sorted(row['client_id'] for row in rows) == [f'client{number}' for number in range(5)]
+    assert {row['amount'] for row in rows} == {'12.50'}
+
+
+def post_invoice(invoices, clientID, status, amount, yearmonth='202210'):
+    event = {'httpMethod': 'POST', 'path': '/invoices',
+             'queryStringParameters': {'clientid': clientID, 'yearmonth': yearmonth, 'forename': 'Ada',
+                                       'surname': 'Lovelace', 'number': '0123', 'email': 'ada@example.com',
+                                       'status': status, 'amount': amount}}
+    return invoices.lambda_handler(event, None)
+
+
+def patch_invoice(invoices, clientID, updateTo, yearmonth='202210'):
+    event = {'httpMethod': 'PATCH', 'path': '/invoices',
+             'queryStringParameters': {'clientid': clientID, 'yearmonth': yearmonth, 'updateto': updateTo}}
+    return invoices.lambda_handler(event, None)
+
+
+def post_bulk(invoices, rows):
+    event = {'httpMethod': 'POST', 'path': '/invoices/bulk', 'body': json.dumps(rows)}
+    response = invoices.lambda_handler(event, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def bulk_row(clientID, status, amount):
+    return {'clientid': clientID, 'yearmonth': '202210', 'forename': 'Ada', 'surname': 'Lovelace',
+            'number': '0123', 'email': 'ada@example.com', 'status': status, 'amount': amount}
+
+
+def month_summary(invoices, yearmonth='202210'):
+    event = {'httpMethod': 'GET', 'path': '/invoices/summary', 'queryStringParameters': {'yearmonth': yearmonth}}
+    summary = json.loads(invoices.lambda_handler(event, None)['body'])
+    return {total: (summary[total]['amount'], summary[total]['count']) for total in ('billed', 'paid', 'outstanding')}
+
+
+def test_summary_follows_posts_overwrites_and_status_changes(invoices):
+    assert post_invoice(invoices, 'client1', 'unpaid', '10.00')['statusCode'] == '200'
+    assert post_invoice(invoices, 'client2', 'paid', '2.50')['statusCode'] == '200'
+    assert month_summary(invoices) == {'billed': ('12.50', 2), 'paid': ('2.50', 1), 'outstanding': ('10.00', 1)}
+
+    # An overwrite takes the old amount and status out first
+    post_invoice(invoices, 'client1', 'paid', '20.00')
+    assert month_summary(invoices) == {'billed': ('22.50', 2), 'paid': ('22.50', 2), 'outstanding': ('0.00', 0)}
+
+    assert patch_invoice(invoices, 'client2', 'unpaid')['statusCode'] == '200'
+    assert month_summary(invoices) == {'billed': ('22.50', 2), 'paid': ('20.00', 1), 'outstanding': ('2.50', 1)}
+
+    # The same status again moves nothing
+    patch_invoice(invoices, 'client2', 'unpaid')
+    assert month_summary(invoices) == {'billed': ('22.50', 2), 'paid': ('20.00', 1), 'outstanding': ('2.50', 1)}
+
+
+def test_bulk_overwrite_replaces_the_old_amounts(invoices):
+    post_invoice(invoices, 'client1', 'unpaid', '10.00')
+
+    statusCode, message = post_bulk(invoices, [bulk_row('client1', 'paid', '4.00'),
+                                               bulk_row('client2', 'unpaid', '6.00')])
+    assert statusCode == '200' and message['written'] == 2
+    assert month_summary(invoices) == {'billed': ('10.00', 2), 'paid': ('4.00', 1), 'outstanding': ('6.00', 1)}
+
+
+@pytest.mark.parametrize('change', ['post', 'overwrite', 'patch', 'bulk'])
+def test_first_change_counts_invoices_saved_before_the_rollups(invoices, change):
+    for number, status in enumerate(['unpaid', 'unpaid', 'paid']):
+        invoices.table.put_item(Item={'client_id': f'client{number}', 'year_month': '202210',
+                                      'invoice_status': status, 'amount': Decimal('5.00')})
+
+    if change == 'post':
+        post_invoice(invoices, 'client3', 'unpaid', '1.00')
+        expected = {'billed': ('16.00', 4), 'paid': ('5.00', 1), 'outstanding': ('11.00', 3)}
+    elif change == 'overwrite':
+        post_invoice(invoices, 'client0', 'paid', '1.00')
+        expected = {'billed': ('11.00', 3), 'paid': ('6.00', 2), 'outstanding': ('5.00', 1)}
+    elif change == 'patch':
+        patch_invoice(invoices, 'client0', 'paid')
+        expected = {'billed': ('15.00', 3), 'paid': ('10.00', 2), 'outstanding': ('5.00', 1)}
+    else:
+        post_bulk(invoices, [bulk_row('client0', 'paid', '1.00'), bulk_row('client3', 'unpaid', '1.00')])
+        expected = {'billed': ('12.00', 4), 'paid': ('6.00', 2), 'outstanding': ('6.00', 2)}
+
+    assert month_summary(invoices) == expected
+    assert invoices.reconcile_invoice_summary() == {'months': 1, 'removed': 0}
+    assert month_summary(invoices) == expected
+
+
+def get_job(invoices, jobID):
+    event = {'httpMethod': 'GET', 'path': '/invoices/jobs', 'queryStringParameters': {'jobid': jobID}}
+    response = invoices.lambda_handler(event, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def test_async_jobs_move_from_queued_to_done_or_failed(invoices, monkeypatch):
+    rendered = []
+
+    def invoke_store_invoices(inputToLambda):
+        rendered.append(inputToLambda)
+        if inputToLambda['forename'] == 'Grace':
+            return {'statusCode': '400', 'body': 'Missing html_string from request.'}
+        return {'statusCode': '200', 'headers': {'X-Invoice-Key': 'invoices/AdaLovelace202210.pdf'}}
+    monkeypatch.setattr(invoices, 'invoke_store_invoices', invoke_store_invoices)
+
+    event = {'httpMethod': 'POST', 'path': '/invoices',
+             'queryStringParameters': {'clientid': 'client1', 'yearmonth': '202210', 'forename': 'Ada',
+                                       'surname': 'Lovelace', 'number': '0123', 'email': 'ada@example.com',
+                                       'status': 'unpaid', 'amount': '10.00', 'async': 'true'}}
+    response = invoices.lambda_handler(event, None)
+    assert response['statusCode'] == '202'
+    adaJob = json.loads(response['body'])['job_id']
+
+    event['queryStringParameters'].update(clientid='client2', forename='Grace')
+    graceJob = json.loads(invoices.lambda_handler(event, None)['body'])['job_id']
+
+    # Nothing is rendered until the worker runs
+    assert get_job(invoices, adaJob)[1]['job_status'] == 'queued'
+    assert rendered == []
+
+    invoices.invoiceJobQueue.drain()
+    assert get_job(invoices, adaJob)[1]['job_status'] == 'done'
+    assert get_job(invoices, adaJob)[1]['s3_key'] == 'invoices/AdaLovelace202210.pdf'
+    assert get_job(invoices, graceJob)[1]['job_status'] == 'failed'
+    assert get_job(invoices, graceJob)[1]['error'] == 'Missing html_string from request.'
+    assert rendered[0]['template_data']['client'] == {'forename': 'Ada', 'surname': 'Lovelace'}
+
+    # A done job is not rendered again when its message is delivered twice
+    records = [{'messageId': 'message1', 'body': json.dumps({'job_id': adaJob})}]
+    assert invoices.process_invoice_job_records(records) == {'batchItemFailures': []}
+    assert len(rendered) == 2
+
+    assert get_job(invoices, 'nojob')[0] == '404'
+
+
+def test_jobs_that_raise_are_retried_by_sqs(invoices, monkeypatch):
+    def invoke_store_invoices(inputToLambda):
+        raise invoices.ClientError({'Error': {'Code': 'TooManyRequestsException', 'Message': 'busy'}}, 'Invoke')
+    monkeypatch.setattr(invoices, 'invoke_store_invoices', invoke_store_invoices)
+
+    job = invoices.enqueue_invoice_job('client1', '202210', {'forename': 'Ada'})
+    records = [{'messageId': 'message1', 'body': json.dumps({'job_id': job['job_id']})}]
+    assert invoices.process_invoice_job_records(records) == {'batchItemFailures': [{'itemIdentifier': 'message1'}]}
+    assert invoices.invoiceJobStore.get(job['job_id'])['job_status'] == 'failed'
+
+
+def test_bulk_ingest_retries_unprocessed_items(invoices, monkeypatch):
+    monkeypatch.setattr(invoices.time, 'sleep', lambda seconds: None)
+    batchWriteItem = invoices.dynamo.batch_write_item
+    calls = []
+
+    # The first call of each chunk only writes one item and hands the rest back
+    def batch_write_item(RequestItems):
+        requests = RequestItems['InvoiceDetails']
+        calls.append(len(requests))
+        if len(calls) % 2 == 1:
+            batchWriteItem(RequestItems={'InvoiceDetails': requests[:1]})
+            return {'UnprocessedItems': {'InvoiceDetails': requests[1:]}}
+        return batchWriteItem(RequestItems=RequestItems)
+    monkeypatch.setattr(invoices.dynamo, 'batch_write_item', batch_write_item)
+
+    rows = [bulk_row(f'client{number:02d}', 'unpaid', '1.00') for number in range(30)]
+    rows.append(dict(bulk_row('client00', 'paid', '1.00')))
+    rows.append({'clientid': 'client99'})
+    statusCode, message = post_bulk(invoices, rows)
+
+    assert statusCode == '207'
+    assert message['written'] == 30 and message['failed'] == 2
+    assert [result['status'] for result in message['results'][30:]] == ['duplicate', 'invalid']
+    assert calls == [25, 24, 5, 4]
+    assert len(invoices.table.scan()['Items']) == 30
+
+
+def test_bulk_ingest_reports_items_never_written(invoices, monkeypatch):
+    monkeypatch.setattr(invoices.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(invoices.dynamo, 'batch_write_item',
+                        lambda RequestItems: {'UnprocessedItems': RequestItems})
+
+    statusCode, message = post_bulk(invoices, [bulk_row('client1', 'unpaid', '1.00')])
+    assert statusCode == '207'
+    assert message['results'] == [{'row': 1, 'status': 'failed', 'error': 'Not written after retries'}]
+
+
+def list_invoices(invoices, **queryParameters):
+    event = {'httpMethod': 'GET', 'path': '/invoices', 'queryStringParameters': queryParameters}
+    response = invoices.lambda_handler(event, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def list_all_pages(invoices, **queryParameters):
+    invoiceKeys = []
+    while True:
+        statusCode, page = list_invoices(invoices, **queryParameters)
+        assert statusCode == 200
+        invoiceKeys.extend((invoice['client_id'], invoice['year_month']) for invoice in page['invoices'])
+        if not page['cursor']:
+            return invoiceKeys
+        queryParameters['cursor'] = page['cursor']
+
+
+def test_invoice_listing_filters_and_pages(invoices):
+    for clientID, yearmonth, status in [('client1', '202209', 'paid'), ('client1', '202210', 'unpaid'),
+                                        ('client1', '202301', 'unpaid'), ('client2', '202210', 'paid')]:
+        invoices.table.put_item(Item={'client_id': clientID, 'year_month': yearmonth, 'invoice_status': status,
+                                      'amount': Decimal('1.50')})
+
+    firstClient = [('client1', '202209'), ('client1', '202210'), ('client1', '202301')]
+    assert list_all_pages(invoices, clientid='client1', limit='1') == firstClient
+    assert list_all_pages(invoices, clientid='client1', yearmonth='2022') == firstClient[:2]
+    assert list_all_pages(invoices, clientid='client1', status='unpaid') == firstClient[1:]
+    assert list_all_pages(invoices, status='paid', yearmonth='202210') == [('client2', '202210')]
+    octoberInvoices = list_all_pages(invoices, yearmonth='202210', limit='1')
+    assert sorted(octoberInvoices) == [('client1', '202210'), ('client2', '202210')]
+    assert len(list_all_pages(invoices, limit='3')) == 4
+
+    _, page = list_invoices(invoices, clientid='client2', fields='client_id,amount')
+    assert page['invoices'] == [{'client_id': 'client2', 'amount': '1.50'}]
+
+
+@pytest.mark.parametrize('queryParameters', [{'limit': '0'}, {'limit': 'ten'}, {'fields': 'amount,password'},
+                                             {'cursor': 'not a cursor'}])
+def test_invoice_listing_rejects_bad_parameters(invoices, queryParameters):
+    assert list_invoices(invoices, **queryParameters)[0] == '400'
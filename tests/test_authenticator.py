@@ -0,0 +1,52 @@
+# Loads the Authenticator with a registry file and the legacy token settings
+# given, as they are read when the function is loaded
+import hashlib
+import importlib.util
+import json
+import os
+
+import pytest
+
+functionPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                            'lambda_functions', 'Authenticator', 'lambda_function.py')
+
+
+@pytest.fixture
+def load_authenticator(monkeypatch, tmp_path):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    registryFile = tmp_path / 'registry.json'
+    registryFile.write_text(json.dumps([{'token_sha256': hashlib.sha256(b'storefront-token').hexdigest(),
+                                         'principal': 'storefront',
+                                         'routes': ['GET /book']}]))
+    monkeypatch.setenv('TOKEN_REGISTRY_FILE', str(registryFile))
+
+    def load(**environment):
+        for name, value in environment.items():
+            monkeypatch.setenv(name, value)
+        spec = importlib.util.spec_from_file_location('authenticator', functionPath)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    return load
+
+
+def decide(authenticator, token):
+    authResponse = authenticator.lambda_handler({'authorizationToken': token}, None)
+    statement = authResponse['policyDocument']['Statement'][0]
+    return statement['Effect'], statement['Resource']
+
+
+def test_legacy_token_is_off_by_default(load_authenticator):
+    authenticator = load_authenticator()
+    assert decide(authenticator, 'cetm67_test')[0] == 'Deny'
+    assert decide(authenticator, 'storefront-token') == (
+        'Allow', ['arn:aws:execute-api:us-east-1:645243735875:*/*/GET/book'])
+    assert decide(authenticator, 'not-a-token')[0] == 'Deny'
+
+
+def test_legacy_token_can_be_limited_to_routes(load_authenticator):
+    authenticator = load_authenticator(LEGACY_TOKEN_ENABLED='true', LEGACY_TOKEN_ROUTES='GET /book, GET /books')
+    assert decide(authenticator, 'cetm67_test') == (
+        'Allow', ['arn:aws:execute-api:us-east-1:645243735875:*/*/GET/book',
+                  'arn:aws:execute-api:us-east-1:645243735875:*/*/GET/books'])
@@ -0,0 +1,414 @@
+# Runs the BusinessQueries handler against moto's DynamoDB, so the
+# transactions go through the same boto3 client they use in lambda
+import base64
+import importlib.util
+import json
+import os
+import zlib
+
+import boto3
+import pytest
+from moto import mock_aws
+
+functionPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                            'lambda_functions', 'BusinessQueries', 'lambda_function.py')
+
+
+def create_table(dynamo, name, keyName):
+    dynamo.create_table(TableName=name,
+                        KeySchema=[{'AttributeName': keyName, 'KeyType': 'HASH'}],
+                        AttributeDefinitions=[{'AttributeName': keyName, 'AttributeType': 'S'}],
+                        BillingMode='PAY_PER_REQUEST')
+
+
+def index_by_date(indexName, keyName):
+    return {'IndexName': indexName,
+            'KeySchema': [{'AttributeName': keyName, 'KeyType': 'HASH'},
+                          {'AttributeName': 'date_added', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'ALL'}}
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('QUERY_NOTIFICATION_MODE', 'local')
+    # moto copies its tables during a transaction, which is not thread safe
+    monkeypatch.setenv('BULK_MAX_CONCURRENCY', '1')
+
+    with mock_aws():
+        dynamo = boto3.client('dynamodb')
+        dynamo.create_table(TableName='BusinessQueries',
+                            KeySchema=[{'AttributeName': 'query_id', 'KeyType': 'HASH'}],
+                            AttributeDefinitions=[{'AttributeName': name, 'AttributeType': 'S'}
+                                                  for name in ('query_id', 'outstanding', 'email_address',
+                                                               'date_added')],
+                            GlobalSecondaryIndexes=[index_by_date('outstanding-index', 'outstanding'),
+                                                    index_by_date('email-index', 'email_address')],
+                            BillingMode='PAY_PER_REQUEST')
+        create_table(dynamo, 'BusinessQueryStats', 'stat_id')
+        create_table(dynamo, 'CollectionVersions', 'collection')
+        dynamo.create_table(TableName='BusinessQuerySearch',
+                            KeySchema=[{'AttributeName': 'term', 'KeyType': 'HASH'},
+                                       {'AttributeName': 'query_id', 'KeyType': 'RANGE'}],
+                            AttributeDefinitions=[{'AttributeName': 'term', 'AttributeType': 'S'},
+                                                  {'AttributeName': 'query_id', 'AttributeType': 'S'}],
+                            BillingMode='PAY_PER_REQUEST')
+
+        spec = importlib.util.spec_from_file_location('business_queries', functionPath)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        yield module
+
+
+def post_query(queries, email, answered='false', message='Where is my order'):
+    event = {'httpMethod': 'POST', 'path': '/query',
+             'queryStringParameters': {'forename': 'Ada', 'surname': 'Lovelace', 'number': '0123',
+                                       'email': email, 'message': message, 'answered': answered}}
+    return queries.lambda_handler(event, None)
+
+
+def patch_query(queries, queryID, updateTo):
+    event = {'httpMethod': 'PATCH', 'path': '/query',
+             'queryStringParameters': {'queryid': queryID, 'updateto': updateTo}}
+    return queries.lambda_handler(event, None)
+
+
+def count_queries(queries):
+    response = queries.lambda_handler({'httpMethod': 'GET', 'path': '/countqueries'}, None)
+    return json.loads(response['body'])
+
+
+def stored_query_ids(queries):
+    return [query['query_id'] for query in queries.table.scan()['Items']]
+
+
+def test_post_saves_the_query_and_counts_it(queries):
+    assert post_query(queries, 'ada@example.com')['statusCode'] == '200'
+    assert post_query(queries, 'grace@example.com', answered='true')['statusCode'] == '200'
+
+    saved = queries.table.scan()['Items']
+    assert sorted(query['forename'] for query in saved) == ['Ada', 'Ada']
+    assert count_queries(queries) == {'answered': 1, 'outstanding': 1}
+    assert queries.read_query_version() == 2
+
+
+def test_patch_moves_the_counters_once(queries):
+    post_query(queries, 'ada@example.com')
+    queryID = stored_query_ids(queries)[0]
+
+    assert patch_query(queries, queryID, 'true')['statusCode'] == '200'
+    assert queries.table.get_item(Key={'query_id': queryID})['Item']['answered'] is True
+    assert count_queries(queries) == {'answered': 1, 'outstanding': 0}
+
+    # Setting the same status again changes nothing
+    assert patch_query(queries, queryID, 'true')['statusCode'] == '200'
+    assert queries.set_query_answered(queryID, True) == 'unchanged'
+    assert count_queries(queries) == {'answered': 1, 'outstanding': 0}
+    assert queries.read_query_version() == 2
+
+    assert patch_query(queries, queryID, 'false')['statusCode'] == '200'
+    assert count_queries(queries) == {'answered': 0, 'outstanding': 1}
+
+
+def test_patch_of_a_missing_query_is_rejected(queries):
+    assert patch_query(queries, 'nobody20260101000000', 'true')['statusCode'] == 400
+    assert 'Item' not in queries.statsTable.get_item(Key={'stat_id': 'query_counts'})
+
+
+def patch_bulk(queries, queryIDs, updateTo, atomic):
+    event = {'httpMethod': 'PATCH', 'path': '/query/bulk',
+             'body': json.dumps({'queryids': queryIDs, 'updateto': updateTo, 'atomic': atomic})}
+    response = queries.lambda_handler(event, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+@pytest.mark.parametrize('atomic', [False, True])
+def test_bulk_patch_counts_each_change_once(queries, atomic):
+    for name in ('ada', 'grace', 'alan'):
+        post_query(queries, f'{name}@example.com')
+    queryIDs = sorted(stored_query_ids(queries))
+    queries.set_query_answered(queryIDs[0], True)
+
+    statusCode, message = patch_bulk(queries, queryIDs, True, atomic)
+    assert statusCode == 200
+    assert [result['outcome'] for result in message['results']] == ['unchanged', 'updated', 'updated']
+    assert count_queries(queries) == {'answered': 3, 'outstanding': 0}
+
+
+def test_bulk_patch_reports_missing_queries(queries):
+    post_query(queries, 'ada@example.com')
+    queryID = stored_query_ids(queries)[0]
+
+    statusCode, message = patch_bulk(queries, [queryID, 'nobody20260101000000'], True, False)
+    assert statusCode == 207
+    assert message['updated'] == 1 and message['not_found'] == 1
+    assert count_queries(queries) == {'answered': 1, 'outstanding': 0}
+
+    # Atomic requests apply nothing when any query is missing
+    statusCode, message = patch_bulk(queries, [queryID, 'nobody20260101000000'], False, True)
+    assert statusCode == 207
+    assert message['not_applied'] == 1 and message['not_found'] == 1
+    assert count_queries(queries) == {'answered': 1, 'outstanding': 0}
+
+
+@pytest.mark.parametrize('body', ['{"queryids": "query0", "updateto": true}',
+                                  '{"queryids": [1, 2], "updateto": true}',
+                                  '{"queryids": [""], "updateto": true}',
+                                  '{"queryids": [], "updateto": true}',
+                                  '{"queryids": ["query0"], "updateto": "yes"}',
+                                  '{"updateto": true}', '["query0"]', 'not json'])
+def test_bulk_patch_rejects_malformed_bodies(queries, body):
+    queries.table.put_item(Item={'query_id': 'query0', 'answered': False, 'outstanding': 'Y'})
+    response = queries.lambda_handler({'httpMethod': 'PATCH', 'path': '/query/bulk', 'body': body}, None)
+    assert response['statusCode'] == '400'
+    assert queries.table.get_item(Key={'query_id': 'query0'})['Item']['answered'] is False
+
+
+@pytest.mark.parametrize('change', ['patch', 'post', 'bulk', 'bulk_atomic'])
+def test_first_change_counts_queries_saved_before_the_counters(queries, change):
+    for number in range(3):
+        queries.table.put_item(Item={'query_id': f'query{number}', 'date_added': '20221001120000',
+                                     'answered': False, 'outstanding': 'Y'})
+
+    if change == 'patch':
+        assert patch_query(queries, 'query0', 'true')['statusCode'] == '200'
+        assert count_queries(queries) == {'answered': 1, 'outstanding': 2}
+    elif change == 'post':
+        assert post_query(queries, 'ada@example.com')['statusCode'] == '200'
+        assert count_queries(queries) == {'answered': 0, 'outstanding': 4}
+    else:
+        assert patch_bulk(queries, ['query0', 'query1'], True, change == 'bulk_atomic')[0] == 200
+        assert count_queries(queries) == {'answered': 2, 'outstanding': 1}
+
+
+def list_ndjson(queries, cursor=None, gzip=False, limit=None):
+    queryParameters = {'format': 'ndjson'}
+    if cursor:
+        queryParameters['cursor'] = cursor
+    if limit:
+        queryParameters['limit'] = str(limit)
+    event = {'httpMethod': 'GET', 'path': '/allqueries', 'queryStringParameters': queryParameters,
+             'headers': {'Accept-Encoding': 'gzip'} if gzip else {}}
+    response = queries.lambda_handler(event, None)
+    body = response['body']
+    if gzip:
+        body = zlib.decompress(base64.b64decode(body), 31).decode('utf-8')
+    return [json.loads(line) for line in body.splitlines()], response['headers'].get('X-Next-Cursor')
+
+
+@pytest.mark.parametrize('gzip', [False, True])
+def test_ndjson_listing_stops_on_body_size(queries, monkeypatch, gzip):
+    for number in range(40):
+        queries.table.put_item(Item={'query_id': f'query{number:02d}', 'date_added': '20261018093000',
+                                     'message': os.urandom(300).hex(), 'answered': False})
+    monkeypatch.setattr(queries, 'ndjsonMaxBytes', 8000)
+
+    # Without a limit the whole table is one page, which is always written
+    listed, cursor = list_ndjson(queries, gzip=gzip)
+    assert len(listed) == 40 and cursor is None
+
+    listedIDs = []
+    cursor = None
+    responses = 0
+    while True:
+        listed, cursor = list_ndjson(queries, cursor, gzip=gzip, limit=5)
+        listedIDs.extend(query['query_id'] for query in listed)
+        responses += 1
+        if cursor is None:
+            break
+
+    assert sorted(listedIDs) == [f'query{number:02d}' for number in range(40)]
+    assert responses > 1
+
+
+def search(queries, text):
+    event = {'httpMethod': 'GET', 'path': '/search', 'queryStringParameters': {'q': text}}
+    return json.loads(queries.lambda_handler(event, None)['body'])
+
+
+def term_count(queries, term):
+    return int(queries.searchTable.get_item(Key={'term': term, 'query_id': '#'})['Item']['df'])
+
+
+def test_search_ranks_with_stored_term_counts(queries, monkeypatch):
+    monkeypatch.setattr(queries, 'searchMaxPostings', 3)
+    for number in range(6):
+        post_query(queries, f'customer{number}@example.com', message=f'order number {number} is late')
+    post_query(queries, 'refunds@example.com', message='please refund my order')
+    queries.notificationQueue.drain()
+
+    assert term_count(queries, 'order') == 7
+    assert term_count(queries, 'refund') == 1
+
+    # order is too common to read in full, so only the refund match is scored
+    # with it and the results say so
+    found = search(queries, 'order refund')
+    assert found['results'][0]['email_address'] == 'refunds@example.com'
+    assert found['truncated'] is True
+
+    found = search(queries, 'refund')
+    assert [query['email_address'] for query in found['results']] == ['refunds@example.com']
+    assert found['truncated'] is False
+
+    # Only common terms, the start of the rarest list is ranked
+    found = search(queries, 'order')
+    assert len(found['results']) == 3 and found['truncated'] is True
+
+
+def test_queries_are_indexed_by_the_notification_consumer(queries, monkeypatch):
+    post_query(queries, 'ada@example.com', message='late order')
+    assert search(queries, 'late')['results'] == []
+
+    # Indexing the same query again, as a retried message would, counts nothing twice
+    notification = queries.notificationQueue.pending[0]
+    assert queries.notificationQueue.drain() == []
+    queries.index_query(notification)
+    assert term_count(queries, 'late') == 1
+    assert [query['email_address'] for query in search(queries, 'late')['results']] == ['ada@example.com']
+    assert len(queries.notificationSink.published) == 1
+
+    # A query that could not be indexed is retried before it is emailed
+    def fail_index(query):
+        raise queries.ClientError({'Error': {'Code': 'InternalServerError', 'Message': 'failed'}}, 'TransactWriteItems')
+    monkeypatch.setattr(queries, 'index_query', fail_index)
+    records = [{'messageId': 'message1', 'body': json.dumps(notification)}]
+    assert queries.process_notification_records(records) == {'batchItemFailures': [{'itemIdentifier': 'message1'}]}
+    assert len(queries.notificationSink.published) == 1
+
+
+def test_new_query_emails_are_sent_from_the_queue(queries):
+    for name in ('ada', 'grace', 'alan'):
+        post_query(queries, f'{name}@example.com')
+    assert queries.notificationSink.published == []
+
+    assert queries.notificationQueue.drain(digest=True) == []
+    assert [email['subject'] for email in queries.notificationSink.published] == ['3 new queries']
+
+
+def test_only_messages_whose_email_failed_are_retried(queries, monkeypatch):
+    notifications = [queries.build_query_notification(f'query{number}', 'Ada', 'Lovelace', 'ada@example.com',
+                                                      'Where is my order') for number in range(3)]
+    records = [{'messageId': f'message{number}', 'body': json.dumps(notification)}
+               for number, notification in enumerate(notifications)]
+
+    def publish(subject, message):
+        if subject.endswith('query1'):
+            raise queries.ClientError({'Error': {'Code': 'Throttling', 'Message': 'slow down'}}, 'Publish')
+        queries.notificationSink.published.append({'subject': subject, 'message': message})
+    monkeypatch.setattr(queries.notificationSink, 'publish', publish)
+
+    assert queries.process_notification_records(records) == {'batchItemFailures': [{'itemIdentifier': 'message1'}]}
+    published = [email['subject'] for email in queries.notificationSink.published]
+    assert published == ['New query - query0', 'New query - query2']
+
+
+def test_rebuild_sets_term_counts_from_scratch(queries):
+    post_query(queries, 'ada@example.com', message='late order')
+    post_query(queries, 'grace@example.com', message='late delivery')
+
+    queries.rebuild_search_index()
+    queries.rebuild_search_index()
+    assert term_count(queries, 'late') == 2
+    assert term_count(queries, 'order') == 1
+
+
+def put_queries(queries, answeredFlags):
+    for number, answered in enumerate(answeredFlags):
+        query = {'query_id': f'query{number}', 'date_added': f'2022100{number + 1}120000', 'forename': 'Ada',
+                 'surname': 'Lovelace', 'email_address': f'customer{number % 2}@example.com',
+                 'message': 'Where is my order', 'answered': answered}
+        if not answered:
+            query['outstanding'] = 'Y'
+        queries.table.put_item(Item=query)
+
+
+def retrieve_oldest(queries, **queryParameters):
+    event = {'httpMethod': 'GET', 'path': '/retrieveoldest', 'queryStringParameters': queryParameters}
+    response = queries.lambda_handler(event, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def test_retrieve_oldest_reads_the_outstanding_index(queries):
+    put_queries(queries, [True, False, False, False])
+
+    # Without a limit the single oldest query is returned as an object
+    statusCode, oldest = retrieve_oldest(queries)
+    assert statusCode == 200
+    assert oldest['query_id'] == 'query1' and 'outstanding' not in oldest
+
+    statusCode, oldest = retrieve_oldest(queries, limit='2')
+    assert [query['query_id'] for query in oldest] == ['query1', 'query2']
+
+    assert retrieve_oldest(queries, limit='0')[0] == '400'
+    assert retrieve_oldest(queries, limit='2', lease='nine')[0] == '400'
+
+    # Answered queries drop out of the index
+    patch_query(queries, 'query1', 'true')
+    assert retrieve_oldest(queries)[1]['query_id'] == 'query2'
+
+    put_queries(queries, [True, True, True, True])
+    assert retrieve_oldest(queries) == (200, {})
+    assert retrieve_oldest(queries, limit='5') == (200, [])
+
+
+def test_claims_skip_queries_held_by_other_staff(queries):
+    put_queries(queries, [False, False, False])
+
+    _, claimed = retrieve_oldest(queries, claimby='ann', limit='2')
+    assert [query['query_id'] for query in claimed] == ['query0', 'query1']
+    assert {query['claimed_by'] for query in claimed} == {'ann'}
+
+    _, claimed = retrieve_oldest(queries, claimby='bob', limit='2')
+    assert [query['query_id'] for query in claimed] == ['query2']
+    assert retrieve_oldest(queries, claimby='cat') == (200, {})
+
+    # An expired lease can be claimed again, a current one can not
+    queries.table.update_item(Key={'query_id': 'query0'}, UpdateExpression='set claim_expires=:expired',
+                              ExpressionAttributeValues={':expired': 1})
+    assert retrieve_oldest(queries, claimby='cat')[1]['query_id'] == 'query0'
+    assert queries.claim_query('query1', 'cat', 60) is None
+
+    # Answering a query drops its claim
+    patch_query(queries, 'query1', 'true')
+    assert 'claimed_by' not in queries.table.get_item(Key={'query_id': 'query1'})['Item']
+    assert queries.claim_query('query1', 'cat', 60) is None
+
+
+def list_queries(queries, **queryParameters):
+    event = {'httpMethod': 'GET', 'path': '/allqueries', 'queryStringParameters': queryParameters}
+    response = queries.lambda_handler(event, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def list_all_pages(queries, **queryParameters):
+    queryIDs = []
+    while True:
+        statusCode, page = list_queries(queries, **queryParameters)
+        assert statusCode == 200
+        queryIDs.extend(query['query_id'] for query in page['queries'])
+        if not page.get('cursor'):
+            return queryIDs
+        queryParameters['cursor'] = page['cursor']
+
+
+def test_query_listing_filters_and_pages(queries):
+    put_queries(queries, [True, False, False, True, False, False])
+
+    assert list_all_pages(queries, answered='false', limit='2') == ['query1', 'query2', 'query4', 'query5']
+    assert list_all_pages(queries, answered='false', **{'from': '20221003', 'to': '20221005'}) == \
+        ['query2', 'query4']
+    assert list_all_pages(queries, email='customer1@example.com', limit='1') == ['query1', 'query3', 'query5']
+    assert list_all_pages(queries, email='customer1@example.com', answered='true') == ['query3']
+    assert sorted(list_all_pages(queries, answered='true', limit='1')) == ['query0', 'query3']
+    assert sorted(list_all_pages(queries, limit='4')) == [f'query{number}' for number in range(6)]
+
+    _, page = list_queries(queries, answered='false', fields='query_id,message', limit='1')
+    assert page['queries'] == [{'query_id': 'query1', 'message': 'Where is my order'}]
+
+
+@pytest.mark.parametrize('queryParameters', [{'answered': 'maybe'}, {'from': '2022-10'}, {'limit': '0'},
+                                             {'fields': 'query_id,password'}, {'cursor': 'not a cursor'}])
+def test_query_listing_rejects_bad_filters(queries, queryParameters):
+    assert list_queries(queries, **queryParameters)[0] == '400'
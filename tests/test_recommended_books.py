@@ -0,0 +1,177 @@
+# Runs the book import against moto's s3 and DynamoDB
+import importlib.util
+import json
+import os
+
+import boto3
+import pytest
+from moto import mock_aws
+
+functionPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                            'lambda_functions', 'RecommendedBooksAPI', 'lambda_function.py')
+
+
+def index_by_title(indexName, keyName):
+    return {'IndexName': indexName,
+            'KeySchema': [{'AttributeName': keyName, 'KeyType': 'HASH'},
+                          {'AttributeName': 'title', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'ALL'}}
+
+
+# Each call is a separate container with its own cache
+def load_recommended_books():
+    spec = importlib.util.spec_from_file_location('recommended_books', functionPath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def books(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+
+    with mock_aws():
+        dynamo = boto3.client('dynamodb')
+        dynamo.create_table(TableName='Books',
+                            KeySchema=[{'AttributeName': 'age', 'KeyType': 'HASH'},
+                                       {'AttributeName': 'title', 'KeyType': 'RANGE'}],
+                            AttributeDefinitions=[{'AttributeName': name, 'AttributeType': 'S'}
+                                                  for name in ('age', 'title', 'author', 'type')],
+                            GlobalSecondaryIndexes=[index_by_title('author-index', 'author'),
+                                                    index_by_title('type-index', 'type')],
+                            BillingMode='PAY_PER_REQUEST')
+        dynamo.create_table(TableName='CollectionVersions',
+                            KeySchema=[{'AttributeName': 'collection', 'KeyType': 'HASH'}],
+                            AttributeDefinitions=[{'AttributeName': 'collection', 'AttributeType': 'S'}],
+                            BillingMode='PAY_PER_REQUEST')
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='lwbespokeinvoices')
+        s3.put_object(Bucket='lwbespokeinvoices', Key='book-imports/books.csv',
+                      Body=b'age,title,author,type\n7,Matilda,Roald Dahl,Fiction\n')
+        s3.put_object(Bucket='lwbespokeinvoices', Key='invoices/AdaLovelace202210-20221001120000.pdf',
+                      Body=b'%PDF-1.4')
+
+        yield load_recommended_books()
+
+
+def import_key(books, key):
+    event = {'httpMethod': 'POST', 'path': '/book/import', 'queryStringParameters': {'key': key, 'format': 'csv'}}
+    response = books.lambda_handler(event, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def test_import_reads_files_under_the_import_prefix(books):
+    statusCode, message = import_key(books, 'book-imports/books.csv')
+    assert statusCode == 200
+    assert message['imported'] == 1
+    assert books.table.get_item(Key={'age': '7', 'title': 'Matilda'})['Item']['author'] == 'Roald Dahl'
+
+
+@pytest.mark.parametrize('key', ['invoices/AdaLovelace202210-20221001120000.pdf', 'invoices/missing.csv',
+                                 'book-imports/', 'books.csv'])
+def test_import_refuses_keys_outside_the_prefix(books, key):
+    # Existing and missing objects get the same answer
+    statusCode, message = import_key(books, key)
+    assert statusCode == '400'
+    assert message == 'key must be a file under book-imports/'
+
+
+def get_books(books, age):
+    event = {'httpMethod': 'GET', 'path': '/book', 'queryStringParameters': {'age': age}}
+    response = books.lambda_handler(event, None)
+    return response['headers'].get('X-Cache'), json.loads(response['body'])
+
+
+def post_book(books, age, title, author='Roald Dahl', type='Fiction'):
+    event = {'httpMethod': 'POST', 'path': '/book',
+             'queryStringParameters': {'age': age, 'title': title, 'author': author, 'type': type}}
+    return books.lambda_handler(event, None)
+
+
+def titles(bookList):
+    return [book['title'] for book in bookList]
+
+
+def test_posting_a_book_drops_its_age_from_the_cache(books):
+    post_book(books, '7', 'Matilda')
+    matilda = {'age': '7', 'title': 'Matilda', 'author': 'Roald Dahl', 'type': 'Fiction'}
+    assert get_books(books, '7') == ('MISS', [matilda])
+    assert get_books(books, '7')[0] == 'HIT'
+
+    post_book(books, '7', 'The Twits')
+    cache, ageBooks = get_books(books, '7')
+    assert cache == 'MISS' and titles(ageBooks) == ['Matilda', 'The Twits']
+
+    cacheStats = books.lambda_handler({'action': 'book_cache_stats'}, None)
+    assert cacheStats['hits'] == 1 and cacheStats['invalidations'] == 2 and cacheStats['entries'] == 1
+
+
+def test_other_containers_drop_their_cache_when_the_version_moves(books, monkeypatch):
+    otherContainer = load_recommended_books()
+    monkeypatch.setattr(otherContainer, 'versionCheckInterval', 0)
+    post_book(books, '7', 'Matilda')
+
+    assert get_books(otherContainer, '7')[0] == 'MISS'
+    assert get_books(otherContainer, '7')[0] == 'HIT'
+
+    post_book(books, '7', 'The Twits')
+    cache, ageBooks = get_books(otherContainer, '7')
+    assert cache == 'MISS' and titles(ageBooks) == ['Matilda', 'The Twits']
+
+
+def browse(books, **queryParameters):
+    event = {'httpMethod': 'GET', 'path': '/books', 'queryStringParameters': queryParameters}
+    response = books.lambda_handler(event, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def browse_all_pages(books, **queryParameters):
+    found = []
+    while True:
+        statusCode, page = browse(books, **queryParameters)
+        assert statusCode == 200
+        found.extend(page['books'])
+        if not page['cursor']:
+            return found
+        queryParameters['cursor'] = page['cursor']
+
+
+def add_books(books):
+    for age, title, author, type in [('5', 'The Gruffalo', 'Julia Donaldson', 'Picture'),
+                                     ('6', 'Room on the Broom', 'Julia Donaldson', 'Picture'),
+                                     ('7', 'Matilda', 'Roald Dahl', 'Fiction'),
+                                     ('7', 'The Twits', 'Roald Dahl', 'Fiction'),
+                                     ('9', 'Holes', 'Louis Sachar', 'Fiction'),
+                                     ('12', 'Wonder', 'R J Palacio', 'Fiction')]:
+        books.table.put_item(Item={'age': age, 'title': title, 'author': author, 'type': type})
+
+
+def test_age_ranges_page_through_every_age(books):
+    add_books(books)
+
+    found = browse_all_pages(books, minage='5', maxage='9', limit='2')
+    assert titles(found) == ['The Gruffalo', 'Room on the Broom', 'Matilda', 'The Twits', 'Holes']
+    assert titles(browse_all_pages(books, minage='5', maxage='9', type='Fiction', limit='1')) == \
+        ['Matilda', 'The Twits', 'Holes']
+    assert titles(browse_all_pages(books, maxage='7')) == ['Matilda', 'The Twits']
+
+    _, page = browse(books, minage='12', fields='title,author')
+    assert page['books'] == [{'title': 'Wonder', 'author': 'R J Palacio'}]
+
+
+def test_author_and_type_use_their_indexes(books):
+    add_books(books)
+
+    assert titles(browse_all_pages(books, author='Roald Dahl', limit='1')) == ['Matilda', 'The Twits']
+    assert titles(browse_all_pages(books, type='Picture')) == ['Room on the Broom', 'The Gruffalo']
+    assert titles(browse_all_pages(books, author='Julia Donaldson', type='Fiction')) == []
+
+
+@pytest.mark.parametrize('queryParameters', [{}, {'minage': 'seven'}, {'minage': '9', 'maxage': '5'},
+                                             {'minage': '1', 'maxage': '40'}, {'minage': '5', 'limit': '0'},
+                                             {'minage': '5', 'fields': 'title,isbn'},
+                                             {'minage': '5', 'cursor': 'not a cursor'}])
+def test_browsing_rejects_bad_parameters(books, queryParameters):
+    assert browse(books, **queryParameters)[0] == '400'
@@ -0,0 +1,263 @@
+# Runs invoice creation against moto's s3 and DynamoDB. wkhtmltopdf is
+# replaced with a stand in that writes a fixed pdf
+import importlib.util
+import json
+import os
+import sys
+from datetime import datetime
+
+import boto3
+import pytest
+from boto3.dynamodb.conditions import Key
+from moto import mock_aws
+
+functionPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                            'lambda_functions', 'StoreInvoices', 'lambda_function.py')
+
+
+class FixedDateTime(datetime):
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2026, 10, 18, 9, 30, 0)
+
+
+def fake_render_pdf(wkhtmltopdf_options, local_filename, pdf_filename):
+    with open(local_filename) as html_file, open(pdf_filename, 'wb') as pdf_file:
+        pdf_file.write(b'%PDF-1.4 ' + html_file.read().encode('utf-8'))
+    return {'mode': 'file', 'render_ms': 1.0}
+
+
+def load_store_invoices():
+    spec = importlib.util.spec_from_file_location('store_invoices', functionPath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def invoices(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.delenv('RENDER_MODE', raising=False)
+
+    with mock_aws():
+        boto3.client('s3').create_bucket(Bucket='lwbespokeinvoices')
+        dynamo = boto3.client('dynamodb')
+        dynamo.create_table(TableName='InvoiceIndex',
+                            KeySchema=[{'AttributeName': 'client', 'KeyType': 'HASH'},
+                                       {'AttributeName': 'invoice_sort', 'KeyType': 'RANGE'}],
+                            AttributeDefinitions=[{'AttributeName': 'client', 'AttributeType': 'S'},
+                                                  {'AttributeName': 'invoice_sort', 'AttributeType': 'S'}],
+                            BillingMode='PAY_PER_REQUEST')
+        dynamo.create_table(TableName='CollectionVersions',
+                            KeySchema=[{'AttributeName': 'collection', 'KeyType': 'HASH'}],
+                            AttributeDefinitions=[{'AttributeName': 'collection', 'AttributeType': 'S'}],
+                            BillingMode='PAY_PER_REQUEST')
+
+        module = load_store_invoices()
+        monkeypatch.setattr(module, 'render_pdf', fake_render_pdf)
+        monkeypatch.setattr(module, 'datetime', FixedDateTime)
+        yield module
+
+
+def invoice_request(invoices, html_string):
+    return invoices.read_invoice_request({'html_string': html_string, 'forename': 'Ada',
+                                          'surname': 'Lovelace', 'yearmonth': '202210'})
+
+
+def test_invoices_made_in_the_same_second_get_their_own_keys(invoices):
+    firstKey, _ = invoices.create_invoice(invoice_request(invoices, '<p>First</p>'))
+    secondKey, _ = invoices.create_invoice(invoice_request(invoices, '<p>Second</p>'))
+
+    assert firstKey != secondKey
+    assert firstKey.startswith('invoices/AdaLovelace202210-20261018093000-')
+
+    indexed = invoices.indexTable.query(KeyConditionExpression=Key('client').eq('AdaLovelace'))['Items']
+    assert sorted(entry['object_key'] for entry in indexed) == sorted([firstKey, secondKey])
+    assert all(entry['created'] == '20261018093000' for entry in indexed)
+
+
+def test_rebuilt_index_entries_match_the_original(invoices):
+    upload_file, _ = invoices.create_invoice(invoice_request(invoices, '<p>First</p>'))
+    indexed = invoices.indexTable.query(KeyConditionExpression=Key('client').eq('AdaLovelace'))['Items'][0]
+
+    rebuilt = invoices.rebuild_index_entry({'Key': upload_file, 'Size': int(indexed['size'])})
+    assert rebuilt['invoice_sort'] == indexed['invoice_sort']
+    assert rebuilt['created'] == '20261018093000'
+
+    # Keys from before the hash was added still parse
+    match = invoices.invoiceKeyPattern.match('invoices/AdaLovelace202210-20221001120000.pdf')
+    assert match.group('client', 'yearmonth', 'created') == ('AdaLovelace', '202210', '20221001120000')
+
+
+def test_cache_key_only_ignores_whitespace_that_never_renders(invoices):
+    def cache_key(html_string):
+        return invoices.render_cache_key(invoice_request(invoices, html_string))
+
+    assert cache_key('<p>Total</p>  \r\n<p>5.00</p>\n') == cache_key('<p>Total</p>\n<p>5.00</p>')
+    assert cache_key('<b>Total</b> <i>5.00</i>') != cache_key('<b>Total</b><i>5.00</i>')
+    assert cache_key('<pre>a  b\n  c</pre>') != cache_key('<pre>a b c</pre>')
+
+
+def test_batch_renders_repeated_items_once(invoices, monkeypatch):
+    monkeypatch.setattr(invoices.renderPool, 'ensure_size', lambda size: None)
+    first = {'html_string': '<p>First</p>', 'forename': 'Ada', 'surname': 'Lovelace', 'yearmonth': '202210'}
+    second = dict(first, html_string='<p>Second</p>')
+
+    results = invoices.create_invoice_batch([first, first, second, {'forename': 'Ada'}], 2)
+
+    assert [result['status'] for result in results] == ['created', 'duplicate', 'created', 'invalid']
+    assert results[1]['duplicate_of'] == 0 and results[1]['key'] == results[0]['key']
+    assert results[0]['key'] != results[2]['key']
+
+    # Both created invoices are indexed from their threads
+    indexed = invoices.indexTable.query(KeyConditionExpression=Key('client').eq('AdaLovelace'))['Items']
+    assert sorted(entry['object_key'] for entry in indexed) == sorted([results[0]['key'], results[2]['key']])
+
+
+def test_render_mode_defaults_to_the_warm_pool(invoices):
+    assert invoices.renderMode == 'file'
+
+
+def test_stream_mode_leaves_the_render_pool_stopped(invoices, monkeypatch):
+    monkeypatch.setattr(invoices, 'renderMode', 'stream')
+    monkeypatch.setattr(invoices, 'stream_invoice_to_s3',
+                        lambda invoiceRequest, upload_file, metadata: {'mode': 'stream', 'render_ms': 1.0,
+                                                                       'upload_ms': 1.0, 'pdf_bytes': 10})
+    item = {'html_string': '<p>First</p>', 'forename': 'Ada', 'surname': 'Lovelace', 'yearmonth': '202210'}
+
+    results = invoices.create_invoice_batch([item], 4)
+    assert results[0]['status'] == 'created'
+    assert invoices.lambda_handler({'action': 'render_health'}, None)['workers'] == []
+    assert invoices.renderPool.workers == []
+
+
+@pytest.mark.parametrize('objectKey, yearMonth, matches', [
+    ('invoices/AdaLovelace202210-20261018093000-0123456789ab.pdf', '202210', True),
+    ('invoices/AdaLovelace202210-20261018093000-0123456789ab.pdf', '2022', True),
+    ('invoices/AdaLovelace2022-10-20221001120000.pdf', '2022-10', True),
+    ('invoices/Ada2022Lovelace202301-20230101120000.pdf', '2022', False),
+    ('invoices/AdaLovelace202210-20261018093000-0123456789ab.pdf', '2026', False),
+    ('invoices/AdaLovelace202210-20261018093000-0123456789ab.pdf', '10', False),
+])
+def test_year_month_filter_only_matches_the_year_month(invoices, objectKey, yearMonth, matches):
+    assert invoices.invoice_matches_yearmonth(objectKey, yearMonth) is matches
+
+
+# Stand in for wkhtmltopdf --read-args-from-stdin. Each line is one
+# conversion, reported on stderr the way wkhtmltopdf reports progress
+fakeWkhtmltopdf = """#!{python}
+import shlex
+import sys
+
+for line in sys.stdin:
+    args = shlex.split(line)
+    with open(args[-2]) as html_file, open(args[-1], 'wb') as pdf_file:
+        pdf_file.write(b'%PDF-1.4 ' + ' '.join(args[:-2]).encode('utf-8') + b' ' + html_file.read().encode('utf-8'))
+    sys.stderr.write('Loading pages (1/6)\\r[======] 100%\\rDone\\n')
+    sys.stderr.flush()
+"""
+
+
+# A copy of the function that really renders, through the stand in binary
+@pytest.fixture
+def renderer(invoices, monkeypatch, tmp_path):
+    binary = tmp_path / 'wkhtmltopdf'
+    binary.write_text(fakeWkhtmltopdf.format(python=sys.executable))
+    binary.chmod(0o755)
+    monkeypatch.setenv('WKHTMLTOPDF_PATH', str(binary))
+    module = load_store_invoices()
+    yield module
+    module.renderPool.shutdown()
+
+
+def test_renders_reuse_one_warm_worker(renderer, tmp_path):
+    html_file = tmp_path / 'invoice.html'
+    html_file.write_text('<p>Total</p>')
+
+    options = renderer.map_wkhtmltopdf_options({'title': 'Ada "The" Countess \\ Invoice', 'orientation': 'Landscape'})
+    for number in range(2):
+        renderTiming = renderer.render_pdf(options, str(html_file), str(tmp_path / f'{number}.pdf'))
+        assert renderTiming['mode'] == 'pool'
+
+    # The title reached the worker as one argument despite its quotes
+    pdf = (tmp_path / '1.pdf').read_bytes()
+    assert b'--orientation landscape --title Ada "The" Countess \\ Invoice <p>' in pdf
+    assert [(worker['renders'], worker['restarts']) for worker in renderer.renderPool.health_check()] == [(2, 0)]
+
+    # A worker that has died is restarted by the health check
+    renderer.renderPool.workers[0].process.kill()
+    renderer.renderPool.workers[0].process.wait()
+    assert renderer.lambda_handler({'action': 'render_health'}, None)['workers'][0]['restarts'] == 1
+    assert renderer.render_pdf(options, str(html_file), str(tmp_path / '2.pdf'))['mode'] == 'pool'
+
+
+def test_presigned_urls_are_reused_while_enough_time_is_left(invoices, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(invoices.time, 'time', lambda: now[0])
+
+    url, expiresAt = invoices.presign_invoice('AdaLovelace202210-20221001120000.pdf', 120)
+    assert expiresAt == 1000120 and 'invoices/AdaLovelace202210' in url
+    assert invoices.presign_invoice('invoices/AdaLovelace202210-20221001120000.pdf', 120) == (url, expiresAt)
+
+    # Less than half of the lifetime left, so it is signed again
+    now[0] += 61
+    assert invoices.presign_invoice('AdaLovelace202210-20221001120000.pdf', 120)[1] == 1000181
+
+
+def download_bulk(invoices, body):
+    response = invoices.lambda_handler({'httpMethod': 'POST', 'path': '/download/bulk', 'body': json.dumps(body)},
+                                       None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def test_bulk_download_signs_every_key(invoices):
+    keys = ['AdaLovelace202210-20221001120000.pdf', 'invoices/GraceHopper202210-20221001120000.pdf']
+    statusCode, signed = download_bulk(invoices, {'keys': keys, 'expires': 300})
+    assert statusCode == '200'
+    assert sorted(signed['urls']) == sorted(keys) and sorted(signed['expires_at']) == sorted(keys)
+
+    assert download_bulk(invoices, {'keys': 'AdaLovelace.pdf'})[0] == '400'
+    assert download_bulk(invoices, {'keys': []})[0] == '400'
+    assert download_bulk(invoices, {'keys': keys, 'expires': invoices.presignMaxExpiry + 1})[0] == '400'
+
+
+def test_invoice_html_is_built_from_the_bundled_template(invoices):
+    invoiceRequest = invoices.read_invoice_request({
+        'forename': 'Ada', 'surname': 'Lovelace', 'yearmonth': '202210', 'template_id': 'invoice',
+        'template_data': {'client': {'forename': 'Ada', 'surname': '<Lovelace>'}, 'amount': '12.50',
+                          'lines': [{'description': 'Books', 'amount': '10.00'},
+                                    {'description': 'Postage', 'amount': '2.50'}]}})
+
+    assert '<h6>Ada &lt;Lovelace&gt;</h6>' in invoiceRequest['html_string']
+    assert '<h6>Books: 10.00</h6>\n<h6>Postage: 2.50</h6>' in invoiceRequest['html_string']
+    assert '<h6>Please pay 12.50</h6>' in invoiceRequest['html_string']
+
+
+def test_templates_are_read_from_the_bucket_once(invoices):
+    boto3.client('s3').put_object(Bucket='lwbespokeinvoices', Key='templates/receipt/v2.html',
+                                  Body=b'<p>{{#paid}}Paid by {{ name }}{{/paid}}</p>')
+    request = {'forename': 'Ada', 'surname': 'Lovelace', 'yearmonth': '202210', 'template_id': 'receipt',
+               'template_version': 'v2', 'template_data': {'paid': True, 'name': 'Ada'}}
+
+    assert invoices.read_invoice_request(request)['html_string'] == '<p>Paid by Ada</p>'
+    assert invoices.read_invoice_request(dict(request, template_data={'paid': False}))['html_string'] == '<p></p>'
+    assert invoices.load_template.cache_info().misses == 1
+
+
+@pytest.mark.parametrize('templateID, templateData, error', [
+    ('invoice', {'client': {'forename': 'Ada'}}, 'Missing client.surname from template_data.'),
+    ('missing', {}, 'Template missing version v1 does not exist.'),
+    ('../invoice', {}, 'template_id and template_version can only contain letters, numbers, - and _.'),
+])
+def test_template_errors_are_request_errors(invoices, templateID, templateData, error):
+    with pytest.raises(invoices.InvoiceRequestError, match=error.replace('.', '\\.')):
+        invoices.read_invoice_request({'forename': 'Ada', 'surname': 'Lovelace', 'yearmonth': '202210',
+                                       'template_id': templateID, 'template_data': templateData})
+
+
+def test_unclosed_template_sections_do_not_compile(invoices):
+    with pytest.raises(invoices.TemplateError):
+        invoices.InvoiceTemplate('{{#lines}}<p>{{ amount }}</p>')